@@ -4,21 +4,37 @@ import yaml
 _config_filename = "config.yaml"
 _config_path = os.path.dirname(os.path.realpath(__file__))
 data = None
+path = None  # path of the loaded config file
 
 
 def load():
-    global data
+    global data, path
     try:
         with open(_config_filename, 'r') as stream:
             # Note: The ability to construct an arbitrary Python object may be
             # dangerous. The function `yaml.safe_load` limits this ability to
             # simple Python objects like integers or lists.
             data = yaml.safe_load(stream)
+        path = os.path.abspath(_config_filename)
     except IOError:
-        with open(os.path.join(_config_path, _config_filename), 'r') as stream:
+        path = os.path.join(_config_path, _config_filename)
+        with open(path, 'r') as stream:
             data = yaml.safe_load(stream)
 
 
+def state_file(name):
+    """ Returns the path for a file that holds state between runs.
+
+    State files are stored in `state_dir` if configured, next to the config
+    file otherwise.
+    """
+    state_dir = os.path.expanduser(
+        data.get('state_dir') or os.path.dirname(path))
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+    return os.path.join(state_dir, name)
+
+
 
 def save():
     with open(_config_filename, 'w') as stream:
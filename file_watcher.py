@@ -5,17 +5,28 @@ Should support:
     - unix(inotify)
     - windows(https://msdn.microsoft.com/en-us/library/aa365261(VS.85).aspx)
     - mac(fsevents)
-    - polling?
+    - polling (network file systems)
 
 
 .. _Google Python Style Guide:
    http://google.github.io/styleguide/pyguide.html
    http://sphinxcontrib-napoleon.readthedocs.org/en/latest/example_google.html
 """
+from builtins import super
 import os
+import json
+import heapq
+import time
+import select
+import threading
+from collections import Counter, deque
+from queue import Empty
+from queue import Queue
 import pyinotify
 
-from utils.containers import OrderedSetQueue
+from utils.containers import PersistentOrderedSetQueue
+from utils.exclude import IGNORE_FILE
+from utils.exclude import watch_excludes
 from utils.log import log
 
 EVENTS = [
@@ -32,100 +43,1242 @@ EVENTS = [
     #'CLOSE_NOWRITE', # Unwritable file closed
     #'OPEN',          # File was opened
 ]
+# Besides these, `FileQueue` creates 'RESCAN' events: everything below the
+# folder of the event has to be compared, and 'RESCAN_DIR' events: only the
+# folder and its direct content have to be compared.
+
+
+def mask_type(mask, isdir):
+    """ Returns the event type (e.g. 'CREATE') of an inotify mask. """
+    if isdir and mask:
+        mask -= pyinotify.IN_ISDIR
+    return pyinotify.EventsCodes.ALL_VALUES.get(mask, 'IN_UNDEFINED')[3:]
+
+
+def _cached(compute):
+    """ Property that is computed once and stored in the slot named like
+    the property with a leading underscore.
+    """
+    slot = '_' + compute.__name__
+
+    def get(self):
+        try:
+            return getattr(self, slot)
+        except AttributeError:
+            value = compute(self)
+            object.__setattr__(self, slot, value)
+            return value
+    return property(get, doc=compute.__doc__)
 
 
 class InotifyEvent():
-    def __init__(self, event, watch_config, **kwargs):
-        self._mask = getattr(event, 'mask', None)
-        self.file_name = getattr(event, 'name', None)
-        # path without filename/foldername
-        self.base_path = getattr(event, 'path', None)
-        # path with filename/foldername
-        self.source_absolute = getattr(event, 'pathname', None)
-        self.isdir = getattr(event, 'dir', None)
-        self.type = self.get_type()
-        self.__dict__.update(kwargs)
-        self.target_base_dir = watch_config['target']  # target dir
-        self.source_base_dir = watch_config['source']  # source dir
-        self.syncers = watch_config['syncers']
-        self.config = watch_config
-
-        self.source_relative = os.path.join(
-            os.path.relpath(self.source_absolute, self.source_base_dir)
-        )
-        self.source_base_dir_relative = os.path.join(
-            os.path.relpath(self.base_path, self.source_base_dir)
-        )
-        self.target_absolute = os.path.join(
-            self.target_base_dir, self.source_relative
-        )
-        self.target_base_dir_absolute = os.path.normpath(os.path.join(
-            self.target_base_dir, self.source_base_dir_relative
-        ))
-        self.moved_from_path = getattr(event, 'src_pathname', None)
-        log.debug('EVENT %s (%s): %s ' % (
-            self.type, self.syncers, self.source_absolute))
+    """ Immutable change of a path below the source of a watch.
+
+    Only the path, type and the watch config are stored, the other paths
+    are derived when they are used first.
+
+    Args:
+        event (Optional[pyinotify.Event]): Event that is converted.
+        watch_config (dict): Config of the watch that contains the path.
+        source_absolute (Optional[str]): Path of the changed file/folder.
+        isdir (Optional[bool]): True for folders.
+        type (Optional[str]): Event type, one of `EVENTS` or 'RESCAN'.
+        moved_from (Optional[InotifyEvent]): The folded MOVED_FROM event if
+            this event is a rename.
+        moved_from_path (Optional[str]): Path of the inotify MOVED_FROM
+            event that belongs to a MOVED_TO event.
+    """
+    __slots__ = (
+        'source_absolute', 'isdir', 'type', 'moved_from', 'moved_from_path',
+        'config',
+        # cache of the derived paths
+        '_file_name', '_base_path', '_source_relative',
+        '_source_base_dir_relative', '_target_absolute',
+        '_target_base_dir_absolute', '_key_string',
+    )
+
+    def __init__(self, event, watch_config, source_absolute=None, isdir=None,
+                 type=None, moved_from=None, moved_from_path=None):
+        if event is not None:
+            source_absolute = source_absolute or event.pathname
+            isdir = event.dir if isdir is None else isdir
+            type = type or mask_type(event.mask, event.dir)
+            moved_from_path = moved_from_path or \
+                getattr(event, 'src_pathname', None)
+        assign = object.__setattr__
+        assign(self, 'source_absolute', source_absolute)
+        assign(self, 'isdir', isdir)
+        assign(self, 'type', type)
+        assign(self, 'moved_from', moved_from)
+        assign(self, 'moved_from_path', moved_from_path)
+        assign(self, 'config', watch_config)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('InotifyEvent is immutable, use replace()')
+
+    def __delattr__(self, name):
+        raise AttributeError('InotifyEvent is immutable')
+
+    @property
+    def syncers(self):
+        return self.config['syncers']
+
+    @property
+    def source_base_dir(self):
+        return self.config['source']
+
+    @property
+    def target_base_dir(self):
+        return self.config['target']
+
+    @_cached
+    def file_name(self):
+        return os.path.basename(self.source_absolute)
+
+    @_cached
+    def base_path(self):
+        """ path without filename/foldername """
+        return os.path.dirname(self.source_absolute)
 
-    def get_type(self):
-        mask = self._mask
-        if self.isdir and mask:
-            mask -= pyinotify.IN_ISDIR
-        return pyinotify.EventsCodes.ALL_VALUES.get(mask, 'IN_UNDEFINED')[3:]
+    @_cached
+    def source_relative(self):
+        """ path relative to the source of the watch, '.' for the source """
+        path = self.source_absolute
+        source = self.source_base_dir.rstrip(os.sep)
+        if path == source:
+            return '.'
+        if path.startswith(source + os.sep):
+            return path[len(source) + 1:]
+        return os.path.relpath(path, self.source_base_dir)
+
+    @_cached
+    def source_base_dir_relative(self):
+        return os.path.relpath(self.base_path, self.source_base_dir)
+
+    @_cached
+    def target_absolute(self):
+        return os.path.join(self.target_base_dir, self.source_relative)
+
+    @_cached
+    def target_base_dir_absolute(self):
+        return os.path.normpath(os.path.join(
+            self.target_base_dir, self.source_base_dir_relative))
+
+    def replace(self, **kwargs):
+        """ Returns a copy of the event with the given attributes replaced.
+        """
+        values = {
+            'source_absolute': self.source_absolute,
+            'isdir': self.isdir,
+            'type': self.type,
+            'moved_from': self.moved_from,
+            'moved_from_path': self.moved_from_path,
+        }
+        values.update(kwargs)
+        return InotifyEvent(None, self.config, **values)
+
+    def to_record(self):
+        """ Returns the event as dictionary of plain values.
+        """
+        return {
+            'source': self.source_base_dir,
+            'type': self.type,
+            'isdir': self.isdir,
+            'source_absolute': self.source_absolute,
+            'moved_from_path': self.moved_from_path,
+            'moved_from': self.moved_from and self.moved_from.to_record(),
+        }
+
+    @classmethod
+    def from_record(cls, record, watches):
+        """ Creates an event from the output of `to_record`.
+
+        Args:
+            record (dict): Output of `to_record`.
+            watches (list): Watch configs, the one with the same source as
+                the recorded event is used.
+        Returns:
+            InotifyEvent or None if the watch is not active anymore.
+        """
+        watch_config = next((
+            w for w in watches
+            if w['source'] == record['source'] and not w.get('disabled')
+        ), None)
+        if watch_config is None:
+            return None
+        moved_from = record['moved_from']
+        if moved_from is not None:
+            moved_from = cls.from_record(moved_from, watches)
+        return cls(
+            None, watch_config,
+            source_absolute=record['source_absolute'],
+            isdir=record['isdir'],
+            type=record['type'],
+            moved_from=moved_from,
+            moved_from_path=record['moved_from_path'],
+        )
 
     def _key(self):
-            return self.source_absolute + '__' + str(self.syncers)
+        try:
+            return self._key_string
+        except AttributeError:
+            key = self.source_absolute + '__' + str(self.syncers)
+            object.__setattr__(self, '_key_string', key)
+            return key
 
     def __eq__(self, other):
-            return self._key() == other._key()
+        if not isinstance(other, InotifyEvent):
+            return NotImplemented
+        return self._key() == other._key()
 
     def __ne__(self, other):
-            return self._key() != other._key()
+        if not isinstance(other, InotifyEvent):
+            return NotImplemented
+        return self._key() != other._key()
 
     def __hash__(self):
-            return hash(self._key())
+        return hash(self._key())
+
+
+def _parents(path):
+    parent = os.path.dirname(path)
+    while parent != path:
+        yield parent
+        path, parent = parent, os.path.dirname(parent)
+
+
+def _event_paths(event):
+    if event.moved_from is not None:
+        return (event.source_absolute, event.moved_from.source_absolute)
+    return (event.source_absolute,)
+
+
+# maximum number of queued events, can be set with `queue_size` in the
+# config (globally or per syncer). 0 means unbounded.
+DEFAULT_QUEUE_SIZE = 100000
+
+
+def _uncount(counter, keys):
+    """ Decrements counts, without keeping zero counts. """
+    for key in keys:
+        if counter[key] <= 1:
+            del counter[key]
+        else:
+            counter[key] -= 1
+
+
+def _inside(path, folder):
+    return path == folder or path.startswith(folder + os.sep)
+
+
+def _folder(event):
+    if event.isdir:
+        return event.source_absolute
+    return os.path.dirname(event.source_absolute)
+
+
+class FileQueue(PersistentOrderedSetQueue):
+    """ Queue of `InotifyEvent`s.
+
+    Is persistent if a `Journal` is given, see `PersistentOrderedSetQueue`.
+    Recorded events are put back into the queue with `replay(watches)`.
+
+    If `maxsize` is reached and `overflow` is 'collapse', the oldest queued
+    events below a folder are replaced by one RESCAN event for the folder, so
+    that `put` does not block. Events below a queued RESCAN are dropped. With
+    `overflow` 'block' `put` waits like `queue.Queue.put`.
+
+    With a `key` function, events with the same key are merged: a queued
+    event is replaced by a RESCAN_DIR event for the folder of both events
+    (e.g. one event per folder if the key is the folder).
+
+    Several consumers can share the queue: `get` skips events whose path
+    equals, contains or is contained in the path of an event that is still
+    being processed (until `task_done(event)`) or of an earlier skipped
+    event. Events for the same file and for a folder and its content are
+    therefore processed in order. A path that gets a new event while it is
+    being processed is dirty (see `is_dirty`) until the processing is done.
+    """
+
+    def __init__(self, maxsize=0, journal=None, name=None,
+                 overflow='collapse', key=None):
+        self.overflow = overflow
+        PersistentOrderedSetQueue.__init__(self, maxsize, journal, name, key)
+
+    def _init(self, maxsize):
+        PersistentOrderedSetQueue._init(self, maxsize)
+        self._inflight = Counter()  # paths of events being processed
+        self._inflight_parents = Counter()  # their parent folders
+        self._dirty = set()  # paths with new events while being processed
+        self._rescans = Counter()  # (folder, syncers) of queued RESCANs
+        # skipped events from the head of the queue (see `_next_index`),
+        # they go back when an event they could wait for is done
+        self._parked = deque()
+        self._parked_paths = Counter()
+        self._parked_parents = Counter()
+
+    def _qsize(self):
+        return len(self.queue) + len(self._parked)
+
+    def put(self, event, block=True, timeout=None):
+        if self.overflow == 'collapse' and self.maxsize > 0 and \
+                event is not None:
+            with self.mutex:
+                if self._rescans and \
+                        self._item_key(event) not in self._set_of_items and \
+                        self._rescanned(event):
+                    return  # covered by a queued RESCAN
+                while self._qsize() >= self.maxsize and self._collapse():
+                    pass
+        PersistentOrderedSetQueue.put(self, event, block, timeout)
+
+    def _put(self, event):
+        if event is None:
+            return PersistentOrderedSetQueue._put(self, event)
+        if self._inflight:
+            self._dirty.update(path for path in _event_paths(event)
+                               if path in self._inflight)
+        queued = self._set_of_items.get(self._item_key(event))
+        if queued is not None and queued != event:
+            self._merge(queued, event)
+        elif queued is not None or not self._rescans or \
+                not self._rescanned(event):
+            PersistentOrderedSetQueue._put(self, event)
+            if event.type == 'RESCAN':
+                self._rescans[
+                    (event.source_absolute, str(event.syncers))] += 1
+            return
+        # merged or covered by a queued RESCAN
+        if self._replay_seq is not None:
+            self.journal.remove(
+                self.name, self._journal_key(event), self._replay_seq)
+        self.unfinished_tasks -= 1  # see `OrderedSetQueue._put`
+
+    def _rescanned(self, event):
+        """ Tells if a queued RESCAN covers all paths of the event. """
+        syncers = str(event.syncers)
+        return all(
+            any((folder, syncers) in self._rescans
+                for folder in (path,) + tuple(_parents(path)))
+            for path in _event_paths(event)
+        )
+
+    def _collapse(self):
+        """ Replaces the oldest events below a folder by a RESCAN event. The
+        folder is the parent folder of the oldest event, or further up if
+        that does not shorten the queue.
+
+        Returns:
+            bool: False if the queue could not be shortened.
+        """
+        self._unpark()
+        oldest = next((e for e in self.queue if e is not None), None)
+        if oldest is None:
+            return False
+        root = oldest.source_base_dir.rstrip(os.sep)
+        folder = oldest.source_absolute
+        if oldest.type == 'RESCAN' or not oldest.isdir:
+            folder = os.path.dirname(folder)
+        while _inside(folder, root):
+            collapsed = [
+                index for index, event in enumerate(self.queue)
+                if event is not None and event.config is oldest.config and
+                all(_inside(path, folder) for path in _event_paths(event))
+            ]
+            if len(collapsed) > 1:
+                log.info('queue full, collapsing %s events into a rescan '
+                         'of %s' % (len(collapsed), folder))
+                self._replace(collapsed, InotifyEvent(
+                    None, oldest.config, source_absolute=folder,
+                    isdir=True, type='RESCAN'))
+                return True
+            folder = os.path.dirname(folder)
+        return False
+
+    def _merge(self, queued, event):
+        """ Replaces a queued event by a RESCAN_DIR (or RESCAN if one of them
+        is a RESCAN) event that covers the queued and the new event with the
+        same key. The key function must only return the same key for events
+        in the same folder and without `moved_from`.
+        """
+        folder = os.path.commonpath([_folder(queued), _folder(event)])
+        type = 'RESCAN' if 'RESCAN' in [queued.type, event.type] \
+            else 'RESCAN_DIR'
+        if queued.type == type and queued.source_absolute == folder:
+            return  # covered already
+        self._unpark()
+        log.debug('merging %s into a rescan of %s' % (
+            event.source_absolute, folder))
+        replay_seq, self._replay_seq = self._replay_seq, None
+        try:
+            # the rescan is a new record, even while replaying
+            # by identity, equal events can have other keys (renames)
+            index = next(index for index, event in enumerate(self.queue)
+                         if event is queued)
+            self._replace([index], InotifyEvent(
+                None, queued.config, source_absolute=folder, isdir=True,
+                type=type))
+        finally:
+            self._replay_seq = replay_seq
+
+    def _replace(self, indices, rescan):
+        for index in reversed(indices):
+            event = self.queue[index]
+            del self.queue[index]
+            key = self._item_key(event)
+            del self._set_of_items[key]
+            self._enqueued.pop(key, None)
+            if event.type == 'RESCAN':
+                self._rescans[
+                    (event.source_absolute, str(event.syncers))] -= 1
+                self._rescans += Counter()  # drop zero counts
+            PersistentOrderedSetQueue._done(self, event)
+            self.unfinished_tasks -= 1
+        if self._item_key(rescan) in self._set_of_items:
+            return  # queued already (same folder of another watch)
+        # takes the place of the first collapsed event
+        self.unfinished_tasks += 1
+        PersistentOrderedSetQueue._put(self, rescan)
+        self.queue.pop()
+        self.queue.insert(indices[0], rescan)
+        if rescan.type == 'RESCAN':
+            self._rescans[(rescan.source_absolute, str(rescan.syncers))] += 1
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if timeout is not None:
+                endtime = time.monotonic() + timeout
+            index = self._next_index()
+            while index is None:
+                if not block:
+                    raise Empty
+                elif timeout is None:
+                    self.not_empty.wait()
+                else:
+                    remaining = endtime - time.monotonic()
+                    if remaining <= 0.0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+                index = self._next_index()
+            item = self._get(index)
+            self.not_full.notify()
+            return item
+
+    def _next_index(self):
+        """ Parks the blocked events at the head of the queue, so every
+        event is skipped once until an event it waits for is done, instead
+        of once per `get`.
+        """
+        while self.queue:
+            event = self.queue[0]
+            if event is None or not self._blocked(event):
+                return 0
+            self._parked.append(self.queue.popleft())
+            paths = _event_paths(event)
+            self._parked_paths.update(paths)
+            self._parked_parents.update(
+                parent for path in paths for parent in _parents(path))
+        return None
+
+    def _blocked(self, event):
+        """ Tells if a path of the event equals, contains or is contained
+        in a path being processed or of a parked event.
+        """
+        for path in _event_paths(event):
+            if path in self._inflight or path in self._parked_paths or \
+                    path in self._inflight_parents or \
+                    path in self._parked_parents:
+                return True
+            for parent in _parents(path):
+                if parent in self._inflight or parent in self._parked_paths:
+                    return True
+        return False
+
+    def _unpark(self):
+        if not self._parked:
+            return
+        self.queue.extendleft(reversed(self._parked))
+        self._parked.clear()
+        self._parked_paths.clear()
+        self._parked_parents.clear()
+
+    def _get(self, index=0):
+        # same as `OrderedSetQueue._get` for an arbitrary position
+        event = self.queue[index]
+        del self.queue[index]
+        key = self._item_key(event)
+        del self._set_of_items[key]
+        self._taken[key] = self._enqueued.pop(key, None)
+        if event is not None:
+            paths = _event_paths(event)
+            self._inflight.update(paths)
+            self._inflight_parents.update(
+                parent for path in paths for parent in _parents(path))
+            if event.type == 'RESCAN':
+                self._rescans[
+                    (event.source_absolute, str(event.syncers))] -= 1
+                self._rescans += Counter()  # drop zero counts
+        return event
+
+    def _done(self, event):
+        PersistentOrderedSetQueue._done(self, event)
+        if event is not None:
+            paths = _event_paths(event)
+            _uncount(self._inflight, paths)
+            _uncount(self._inflight_parents,
+                     [parent for path in paths for parent in _parents(path)])
+            self._dirty.intersection_update(self._inflight)
+            if any(path in self._parked_paths or
+                   path in self._parked_parents or
+                   any(parent in self._parked_paths
+                       for parent in _parents(path))
+                   for path in paths):
+                # parked events might be ready now
+                self._unpark()
+            self.not_empty.notify_all()
+
+    def is_dirty(self, event):
+        """ Tells if a path of an event that is being processed got a new
+        event in the meantime, i.e. the processing is outdated.
+        """
+        with self.mutex:
+            return any(path in self._dirty for path in _event_paths(event))
+
+    def _serialize(self, event):
+        return json.dumps(event.to_record())
+
+    def _deserialize(self, payload, watches):
+        return InotifyEvent.from_record(json.loads(payload), watches)
+
+    def _journal_key(self, event):
+        # a rename can be queued next to another event for its path
+        if event.moved_from is not None:
+            return event._key() + '<' + event.moved_from.source_absolute
+        return event._key()
+
+
+# Seconds an event is held back, can be overridden per watch with
+# `quiet_period` in the watch config. 0 disables coalescing.
+DEFAULT_QUIET_PERIOD = 0.5
+
+# event types after which the path exists / before which it did not exist
+_EXISTING = ('CREATE', 'MODIFY', 'ATTRIB', 'MOVED_TO')
+_NEW = ('CREATE', 'MOVED_TO')
+
+
+class _PendingEvent():
+    __slots__ = ('event', 'first_type', 'types', 'moved_from', 'count',
+                 'deadline')
+
+    def __init__(self, event, deadline):
+        self.event = event
+        self.first_type = event.type
+        self.types = {event.type}
+        self.moved_from = event.moved_from
+        self.count = 1
+        self.deadline = deadline
+
+    def merge(self, event, deadline):
+        self.event = event
+        self.types.add(event.type)
+        self.count += 1
+        self.deadline = deadline
+
+    def net_event(self):
+        """ Returns the event that has the same effect as all merged events
+        or None if they cancel each other out.
+        """
+        existed_before = self.first_type not in _NEW
+        exists_now = self.event.type in _EXISTING
+        if not existed_before and not exists_now:
+            # e.g. CREATE+MODIFY+DELETE, a renamed file still has to vanish
+            # from its old location
+            return self.moved_from
+        if not existed_before:
+            net_type = self.first_type
+        elif exists_now:
+            net_type = 'ATTRIB' if self.types == {'ATTRIB'} else 'MODIFY'
+        else:
+            net_type = self.event.type
+        if net_type == self.event.type and \
+                self.moved_from is self.event.moved_from:
+            return self.event
+        return self.event.replace(type=net_type, moved_from=self.moved_from)
 
 
-class FileQueue(OrderedSetQueue):
+class EventCoalescer(threading.Thread):
+    """ Debounces events before they reach the `FileQueue`.
 
-    def save(self): raise NotImplementedError
+    Events for the same path are held until no new event arrived for the
+    quiet period of their watch and are then merged into one net event
+    (e.g. CREATE+MODIFY+DELETE cancels out, MOVED_FROM+MOVED_TO becomes a
+    MOVED_TO with `moved_from` set).
+
+    Has the same `put` interface as the queue so it can be handed to a
+    `FileWatcher` instead of the queue.
+
+    Args:
+        queue (FileQueue): Queue that receives the merged events.
+    """
+    def __init__(self, queue):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.raw_events = 0
+        self.folded_events = 0
+        self._pending = {}
+        self._deadlines = []  # heap of (deadline, path)
+        self._condition = threading.Condition()
+        self._running = True
+
+    def put(self, event):
+        quiet_period = event.config.get('quiet_period', DEFAULT_QUIET_PERIOD)
+        with self._condition:
+            self.raw_events += 1
+            # a held back RESCAN could be merged into e.g. a MODIFY
+            if not quiet_period or event.type in ['RESCAN', 'RESCAN_DIR']:
+                self.flush(event.source_absolute)
+                self.queue.put(event)
+                return
+            deadline = time.monotonic() + quiet_period
+            path = event.source_absolute
+            entry = self._pending.get(path)
+            if entry is not None:
+                entry.merge(event, deadline)
+            else:
+                entry = _PendingEvent(event, deadline)
+                renamed = self._pending.get(event.moved_from_path)
+                if event.type == 'MOVED_TO' and renamed is not None and \
+                        renamed.event.type == 'MOVED_FROM':
+                    del self._pending[event.moved_from_path]
+                    entry.count += renamed.count
+                    if renamed.first_type in _NEW:
+                        # created or renamed again within the quiet period
+                        entry.first_type = renamed.first_type
+                        entry.moved_from = renamed.moved_from
+                    else:
+                        entry.moved_from = renamed.net_event()
+                self._pending[path] = entry
+            heapq.heappush(self._deadlines, (deadline, path))
+            self._condition.notify()
+
+    def flush(self, path=None):
+        """ Emits pending events immediately.
+
+        Args:
+            path (Optional[str]): Only flush the event for this path.
+                Defaults to flushing all pending events.
+        """
+        with self._condition:
+            if path is not None:
+                self._emit(path)
+                return
+            for deadline, path in sorted(self._deadlines):
+                self._emit(path)
+            self._deadlines = []
+
+    def _emit(self, path):
+        entry = self._pending.pop(path, None)
+        if entry is None:
+            return
+        # parent folders have to be synced before their content
+        child, parent = path, os.path.dirname(path)
+        while parent != child:
+            self._emit(parent)
+            child, parent = parent, os.path.dirname(parent)
+        event = entry.net_event()
+        self.folded_events += entry.count - (event is not None)
+        if event is not None:
+            self.queue.put(event)
+
+    def run(self):
+        with self._condition:
+            while self._running:
+                now = time.monotonic()
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    deadline, path = heapq.heappop(self._deadlines)
+                    entry = self._pending.get(path)
+                    # the entry might have been extended in the meantime
+                    if entry is not None and entry.deadline <= now:
+                        self._emit(path)
+                timeout = None
+                if self._deadlines:
+                    timeout = self._deadlines[0][0] - now
+                self._condition.wait(timeout)
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self.flush()
+            self._condition.notify()
+        log.debug('coalesced %s of %s events' % (
+            self.folded_events, self.raw_events))
+
+
+def _subfolders(path, excluded):
+    """ Returns (mtime, path) of the folders in a folder that are not
+    `excluded(path)`.
+    """
+    folders = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False) and \
+                        not excluded(entry.path):
+                    folders.append((entry.stat().st_mtime_ns, entry.path))
+    except OSError:
+        pass  # deleted in the meantime
+    return folders
+
+
+# maximum number of folders that are rescanned instead of watched, see
+# `_common_folders`
+MAX_UNWATCHED = 100
+
+
+def _common_folders(folders, source, limit=MAX_UNWATCHED):
+    """ Replaces the deepest folders by their parents (but not above
+    `source`) until at most `limit` folders remain.
+    """
+    folders = set(folders)
+    while len(folders) > limit:
+        depth = max(folder.count(os.sep) for folder in folders)
+        folders = {
+            os.path.dirname(folder)
+            if folder.count(os.sep) == depth and folder != source
+            else folder for folder in folders
+        }
+        folders = {folder for folder in folders
+                   if not any(parent in folders
+                              for parent in _parents(folder))}
+    return sorted(folders)
+
+
+# inotify mask of `EVENTS`
+WATCH_MASK = sum(pyinotify.EventsCodes.ALL_FLAGS['IN_' + type]
+                 for type in EVENTS)
+
+
+class WatchService(threading.Thread):
+    """ Watches the sources of all `FileWatcher`s with one inotify instance.
+
+    A single thread waits with epoll on the inotify fd and dispatches every
+    event to the watchers of its path as soon as it can be read. (A
+    `pyinotify.ThreadedNotifier` per watch needs a thread and an inotify fd
+    per watch and polls with a fixed delay.)
+
+    The folders of a source are watched in the background, see `_register`.
+    Folders beyond the watch budget are rescanned regularly instead.
+
+    Args:
+        budget (Optional[int]): Maximum number of inotify watches, by
+            default only limited by `fs.inotify.max_user_watches`.
+        batch_size (Optional[int]): Folders that are watched at once.
+        rescan_interval (Optional[float]): Seconds between two rescans of
+            the folders that are not watched.
+    """
+    def __init__(self, budget=None, batch_size=1000, rescan_interval=300):
+        super().__init__(daemon=True, name='WatchService')
+        self.budget = budget
+        self.batch_size = batch_size
+        self.rescan_interval = rescan_interval
+        self.watch_manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(
+            self.watch_manager, self._unwatched_event)
+        self._watchers = []
+        # pyinotify is not thread-safe, auto_add changes the watches too
+        self._lock = threading.Lock()
+        self._running = True
+        self._wakeup = os.pipe()
+        self._epoll = select.epoll()
+        self._epoll.register(self.watch_manager.get_fd(), select.EPOLLIN)
+        self._epoll.register(self._wakeup[0], select.EPOLLIN)
+        self._registrations = Queue()
+        self._registrar = threading.Thread(
+            target=self._register_all, daemon=True, name='WatchRegistrar')
+        self._registrar.start()
+
+    def add(self, watcher):
+        """ Starts watching the source of `watcher` in the background. """
+        with self._lock:
+            self._watchers.append(watcher)
+        self._registrations.put(watcher)
+
+    def reregister(self, watcher):
+        """ Watches the folders of `watcher` that are not watched yet and
+        rescans its source.
+        """
+        watcher.registered.clear()
+        self._registrations.put(watcher)
+
+    def _register_all(self):
+        while self._running:
+            try:
+                watcher = self._registrations.get(
+                    timeout=self.rescan_interval)
+            except Empty:
+                for watcher in list(self._watchers):
+                    for folder in watcher.unwatched:
+                        watcher.rescan(folder)
+                continue
+            if watcher is not None and watcher in self._watchers:
+                self._register(watcher)
+
+    def _register(self, watcher):
+        """ Watches the folders below the source of `watcher`, shallow and
+        recently modified folders first, `batch_size` folders at a time, so
+        that events are delivered while huge trees are still registered.
+
+        Queues a RESCAN of the source when all folders are watched (or the
+        budget is used up), changes before the registration are synced by
+        it.
+        """
+        config = watcher.watch_config
+        excluded = watcher.excludes.excluded_folder
+        folders = [(0, 0, config['source'])]  # heap of (depth, -mtime, path)
+        watched = 0
+        full = False
+        while folders and not full and watcher in self._watchers:
+            batch = [heapq.heappop(folders)
+                     for _ in range(min(self.batch_size, len(folders)))]
+            with self._lock:
+                if self.budget is not None:
+                    free = self.budget - len(self.watch_manager.watches)
+                    if free < len(batch):
+                        full = True
+                        for folder in batch[max(free, 0):]:
+                            heapq.heappush(folders, folder)
+                        batch = batch[:max(free, 0)]
+                wds = self.watch_manager.add_watch(
+                    [path for _, _, path in batch], WATCH_MASK,
+                    auto_add=True, proc_fun=self._dispatch,
+                    exclude_filter=excluded, quiet=True) if batch else {}
+            for depth, mtime, path in batch:
+                if wds.get(path, -1) < 0:
+                    # e.g. ENOSPC, max_user_watches is used up
+                    full = True
+                    heapq.heappush(folders, (depth, mtime, path))
+                    continue
+                watched += 1
+                for mtime, subfolder in _subfolders(path, excluded):
+                    heapq.heappush(folders, (depth + 1, -mtime, subfolder))
+            log.info('watching %s: %s folders, %s queued' % (
+                config['source'], watched, len(folders)))
+        if watcher not in self._watchers:
+            return  # removed in the meantime
+        # subfolders of unwatched folders are not watched either
+        watcher.unwatched = _common_folders(
+            [path for _, _, path in folders], config['source'])
+        if watcher.unwatched:
+            log.warning(
+                'watch budget used up, %s folders below %s are rescanned '
+                'every %ss instead' % (len(watcher.unwatched),
+                                        config['source'],
+                                        self.rescan_interval))
+        watcher.registered.set()
+        watcher.rescan()
+
+    def remove(self, watcher):
+        """ Stops watching the folders that only `watcher` needs. """
+        with self._lock:
+            self._watchers.remove(watcher)
+            sources = [w.watch_config['source'] for w in self._watchers]
+            source = watcher.watch_config['source']
+            unused = [
+                wd for wd, watch in self.watch_manager.watches.items()
+                if _inside(watch.path, source) and
+                not any(_inside(watch.path, s) for s in sources)
+            ]
+            if unused:
+                self.watch_manager.rm_watch(unused, quiet=True)
+
+    def _dispatch(self, event):
+        for watcher in self._watchers:
+            if _inside(event.pathname, watcher.watch_config['source']):
+                watcher.process_event(event)
+
+    def _unwatched_event(self, event):
+        if not event.mask & pyinotify.IN_Q_OVERFLOW:
+            return
+        # the overflow has no path, the events of every watch can be lost
+        log.warning('inotify queue overflowed, rescanning all watches')
+        for watcher in self._watchers:
+            # folders created during the overflow are not watched yet
+            self.reregister(watcher)
+
+    def run(self):
+        inotify_fd = self.watch_manager.get_fd()
+        while self._running:
+            try:
+                ready = self._epoll.poll()
+            except InterruptedError:
+                continue
+            if not any(fd == inotify_fd for fd, _ in ready):
+                continue
+            with self._lock:
+                self.notifier.read_events()
+                self.notifier.process_events()
+
+    def stop(self):
+        self._running = False
+        os.write(self._wakeup[1], b'x')
+        if self.is_alive():
+            self.join()
+        self._registrations.put(None)
+        self._registrar.join()
+        self._epoll.close()
+        for fd in self._wakeup:
+            os.close(fd)
+        self.notifier.stop()
 
 
 class FileWatcher():
+    """ Puts an `InotifyEvent` for every change below the source of a watch
+    into a queue.
 
-    def __init__(self, queue, watch_config):
+    Args:
+        queue (FileQueue): Receives the events, or an `EventCoalescer`.
+        watch_config (dict): The watch.
+        service (Optional[WatchService]): Shared by all watchers, defaults
+            to a service of this watcher only.
+    """
+
+    def __init__(self, queue, watch_config, service=None):
         self.queue = queue
         self.watch_config = watch_config
-        # Instanciate a new WatchManager (will be used to store watches).
-        wm = pyinotify.WatchManager()
-        # Associate this WatchManager with a Notifier (will be used to report
-        # and process events).
-        self.notifier = pyinotify.ThreadedNotifier(
-            wm, self.process_event, read_freq=2)
-        self.notifier.start()
-
-        events = 0
-        for e in map(lambda x: 'IN_' + x, EVENTS):
-            events |= pyinotify.EventsCodes.ALL_FLAGS[e]
-
-        wm.add_watch(
-            self.watch_config['source'], events, rec=True, auto_add=True,
-            proc_fun=self.process_event,
-            exclude_filter=pyinotify.ExcludeFilter(
-                self.watch_config.get('exclude', []))
-        )
+        self.excludes = watch_excludes(watch_config)
+        # set when the folders are watched, see `WatchService._register`
+        self.registered = threading.Event()
+        # folders that are rescanned instead of watched
+        self.unwatched = []
+        self._own_service = service is None
+        if service is None:
+            service = WatchService()
+            service.start()
+        self.service = service
+        self.service.add(self)
 
     def process_event(self, event):
-        inotify_event = InotifyEvent(event, self.watch_config)
-        if inotify_event.type in EVENTS:  # Guard against undefined/ignored
-            self.queue.put(InotifyEvent(event, self.watch_config))
+        type = mask_type(event.mask, event.dir)
+        if type not in EVENTS:  # Guard against undefined/ignored
+            return
+        if event.name == IGNORE_FILE:
+            # paths below can be excluded or included now, see
+            # `PollingWatcher._poll`
+            self.excludes.changed(event.pathname)
+            self.service.reregister(self)
+        if self.excludes.excluded(event.pathname, event.dir):
+            return
+        log.debug('EVENT %s (%s): %s ' % (
+            type, self.watch_config['syncers'], event.pathname))
+        self.queue.put(InotifyEvent(event, self.watch_config, type=type))
+
+    def rescan(self, folder=None):
+        """ Queues a RESCAN of a folder, the syncers compare it with the
+        index (see `SyncBase.rescan_events`).
+
+        Args:
+            folder (Optional[str]): Defaults to the source.
+        """
+        self.queue.put(InotifyEvent(
+            None, self.watch_config,
+            source_absolute=folder or self.watch_config['source'],
+            isdir=True, type='RESCAN'))
 
     def stop(self):
-        self.notifier.stop()
+        self.service.remove(self)
+        if self._own_service:
+            self.service.stop()
+
+
+class _PolledFolder():
+    __slots__ = ('mtime', 'entries', 'listed', 'interval', 'due')
+
+    def __init__(self, mtime, entries, listed, interval, due):
+        self.mtime = mtime
+        # name -> (inode, size, mtime, isdir)
+        self.entries = entries
+        self.listed = listed  # time.time_ns() before the last listing
+        self.interval = interval
+        self.due = due
+
+
+class PollingWatcher(threading.Thread):
+    """ Finds the changes below the source of a watch by polling, for file
+    systems without inotify events (NFS, SMB, FUSE).
+
+    Every folder has a snapshot of its entries. A folder is listed again
+    only if its own mtime changed, otherwise only its files are stat'ed.
+    File systems with coarse timestamps (FAT and SMB: 2 seconds, some NFS
+    servers: 1 second) do not change the mtime for an entry created in the
+    same tick as the last listing. So a folder is also listed again while
+    its mtime is within `poll_mtime_granularity` of the last listing.
+    Folders are polled at their own interval: it is reset to
+    `poll_min_interval` when a change was found and doubles up to
+    `poll_max_interval` otherwise, so the work of a poll follows the changes
+    instead of the size of the tree. Renames within a folder are detected
+    by their inode.
+
+    Has the interface of `FileWatcher`.
+
+    Args:
+        queue (FileQueue): Receives the events, or an `EventCoalescer`.
+        watch_config (dict): The watch, `poll_min_interval`,
+            `poll_max_interval` and `poll_mtime_granularity` (seconds) can
+            be set in it.
+    """
+    def __init__(self, queue, watch_config):
+        super().__init__(daemon=True, name='PollingWatcher')
+        self.queue = queue
+        self.watch_config = watch_config
+        self.min_interval = watch_config.get('poll_min_interval', 2)
+        self.max_interval = watch_config.get('poll_max_interval', 120)
+        self.mtime_granularity = int(
+            watch_config.get('poll_mtime_granularity', 2) * 1e9)
+        self.registered = threading.Event()
+        self.unwatched = []
+        # number of 'stat' and 'scandir' calls
+        self.calls = Counter()
+        self.excludes = watch_excludes(watch_config)
+        self._folders = {}  # path -> _PolledFolder
+        self._due = []  # heap of (due, path)
+        self._stopped = threading.Event()
+        self.start()
+
+    def run(self):
+        self._add_tree(self.watch_config['source'], emit=False)
+        self.registered.set()
+        # changes before the first snapshot
+        self.rescan()
+        while True:
+            timeout = self._due[0][0] - time.monotonic() if self._due \
+                else self.max_interval
+            if self._stopped.wait(max(timeout, 0)):
+                return
+            now = time.monotonic()
+            while self._due and self._due[0][0] <= now:
+                due, path = heapq.heappop(self._due)
+                folder = self._folders.get(path)
+                if folder is not None and folder.due == due:
+                    self._poll(path, folder)
+
+    def _schedule(self, path, folder):
+        folder.due = time.monotonic() + folder.interval
+        heapq.heappush(self._due, (folder.due, path))
+
+    def _list(self, path):
+        """ Returns name -> (inode, size, mtime, isdir) of a folder. """
+        entries = {}
+        self.calls['scandir'] += 1
+        with os.scandir(path) as iterator:
+            for entry in iterator:
+                try:
+                    isdir = entry.is_dir(follow_symlinks=False)
+                    if self.excludes.excluded(entry.path, isdir):
+                        continue
+                    self.calls['stat'] += 1
+                    stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue  # deleted in the meantime
+                entries[entry.name] = (
+                    stat.st_ino, stat.st_size, stat.st_mtime_ns, isdir)
+        return entries
+
+    def _stat_files(self, path, entries):
+        """ Returns `entries` with the current state of the files. """
+        current = {}
+        for name, state in entries.items():
+            if state[3]:
+                current[name] = state  # polled on its own
+                continue
+            try:
+                self.calls['stat'] += 1
+                stat = os.lstat(os.path.join(path, name))
+            except OSError:
+                continue
+            current[name] = (
+                stat.st_ino, stat.st_size, stat.st_mtime_ns, False)
+        return current
+
+    def _add_tree(self, path, emit):
+        """ Takes snapshots of a folder and its subfolders. With `emit` a
+        CREATE event is queued for everything in them.
+        """
+        folders = [path]
+        while folders:
+            path = folders.pop(0)
+            listed = time.time_ns()
+            try:
+                self.calls['stat'] += 1
+                mtime = os.stat(path).st_mtime_ns
+                entries = self._list(path)
+            except OSError:
+                continue  # deleted in the meantime
+            folder = _PolledFolder(
+                mtime, entries, listed, self.min_interval, 0)
+            self._folders[path] = folder
+            self._schedule(path, folder)
+            for name, state in sorted(entries.items()):
+                child = os.path.join(path, name)
+                if emit:
+                    self._put(child, state[3], 'CREATE')
+                if state[3]:
+                    folders.append(child)
+
+    def _remove_tree(self, path):
+        for folder in [folder for folder in self._folders
+                       if _inside(folder, path)]:
+            del self._folders[folder]
+
+    def _move_tree(self, path, new_path):
+        for folder in [folder for folder in self._folders
+                       if _inside(folder, path)]:
+            moved = new_path + folder[len(path):]
+            self._folders[moved] = self._folders.pop(folder)
+            self._schedule(moved, self._folders[moved])
+
+    def _poll(self, path, folder):
+        now = time.time_ns()
+        try:
+            self.calls['stat'] += 1
+            mtime = os.stat(path).st_mtime_ns
+            # racy: changed in the tick of the last listing
+            if mtime != folder.mtime or \
+                    folder.listed - mtime < self.mtime_granularity:
+                entries = self._list(path)
+                folder.listed = now
+            else:
+                entries = self._stat_files(path, folder.entries)
+        except OSError:
+            # deleted, its parent reports it
+            self._folders.pop(path, None)
+            return
+        changed = self._diff(path, folder.entries, entries)
+        ignore_changed = \
+            folder.entries.get(IGNORE_FILE) != entries.get(IGNORE_FILE)
+        folder.mtime, folder.entries = mtime, entries
+        folder.interval = self.min_interval if changed else \
+            min(folder.interval * 2, self.max_interval)
+        self._schedule(path, folder)
+        if ignore_changed:
+            # paths below can be excluded or included now, the RESCAN
+            # syncs them like the target would have been synced with the
+            # new rules
+            self.excludes.changed(os.path.join(path, IGNORE_FILE))
+            self._remove_tree(path)
+            self._add_tree(path, emit=False)
+            self.rescan(path)
+
+    def _diff(self, path, old, new):
+        """ Queues the events that turn `old` into `new`.
+
+        Returns:
+            bool: True if something changed.
+        """
+        removed = {name: old[name] for name in old.keys() - new.keys()}
+        by_inode = {state[0]: name for name, state in removed.items()}
+        changed = bool(removed)
+        for name in sorted(new.keys() - old.keys()):
+            changed = True
+            state = new[name]
+            child = os.path.join(path, name)
+            source = by_inode.pop(state[0], None)
+            if source is not None and removed[source][3] == state[3]:
+                del removed[source]
+                source = os.path.join(path, source)
+                self._put(child, state[3], 'MOVED_TO', moved_from=self._event(
+                    source, state[3], 'MOVED_FROM'))
+                if state[3]:
+                    self._move_tree(source, child)
+                continue
+            self._put(child, state[3], 'CREATE')
+            if state[3]:
+                self._add_tree(child, emit=True)
+        for name, state in sorted(removed.items()):
+            child = os.path.join(path, name)
+            self._put(child, state[3], 'DELETE')
+            if state[3]:
+                self._remove_tree(child)
+        for name in old.keys() & new.keys():
+            if old[name] == new[name] or old[name][3] and new[name][3]:
+                continue  # folders are polled on their own
+            changed = True
+            child = os.path.join(path, name)
+            if old[name][3] != new[name][3]:
+                self._put(child, old[name][3], 'DELETE')
+                self._put(child, new[name][3], 'CREATE')
+                if old[name][3]:
+                    self._remove_tree(child)
+                else:
+                    self._add_tree(child, emit=True)
+            else:
+                self._put(child, False, 'MODIFY')
+        return changed
+
+    def _event(self, path, isdir, type, moved_from=None):
+        return InotifyEvent(
+            None, self.watch_config, source_absolute=path, isdir=isdir,
+            type=type, moved_from=moved_from)
+
+    def _put(self, path, isdir, type, moved_from=None):
+        log.debug('POLLED %s (%s): %s ' % (
+            type, self.watch_config['syncers'], path))
+        self.queue.put(self._event(path, isdir, type, moved_from))
+
+    def rescan(self, folder=None):
+        """ See `FileWatcher.rescan`. """
+        self.queue.put(self._event(
+            folder or self.watch_config['source'], True, 'RESCAN'))
+
+    def stop(self):
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+
+
+# file systems that do not report changes made by other hosts to inotify
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ncpfs',
+                       'afs', '9p', 'fuse')
+
+
+def _filesystem(path):
+    """ Returns the type of the file system of a path, e.g. 'ext4'. """
+    path = os.path.realpath(path)
+    best, type = '', None
+    try:
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                fields = line.split()
+                mount_point = fields[1].replace('\\040', ' ')
+                if len(mount_point) >= len(best) and (
+                        mount_point == os.sep or _inside(path, mount_point)):
+                    best, type = mount_point, fields[2]
+    except OSError:
+        pass
+    return type
+
+
+def create_watcher(queue, watch_config, service=None):
+    """ Returns a `FileWatcher`, or a `PollingWatcher` for sources on
+    network file systems. `watcher` ('inotify' or 'polling') in the watch
+    config overrides the choice.
+    """
+    method = watch_config.get('watcher')
+    if method is None:
+        type = _filesystem(watch_config['source']) or ''
+        method = 'polling' if type.split('.')[0] in NETWORK_FILESYSTEMS \
+            else 'inotify'
+    if method == 'polling':
+        return PollingWatcher(queue, watch_config)
+    return FileWatcher(queue, watch_config, service)
 
 
 if __name__ == '__main__':
     import config
     q = FileQueue()
+    coalescer = EventCoalescer(q)
+    coalescer.start()
+    service = WatchService()
+    service.start()
     for watch_config in config.data['watches']:
         if not watch_config.get('disabled'):
-            FileWatcher(q, watch_config)
+            create_watcher(coalescer, watch_config, service)
@@ -10,31 +10,81 @@ sys.dont_write_bytecode = True
 
 import signal
 import builtins
+from threading import Thread
 
 from PyQt4 import QtGui
 from PyQt4 import QtCore
 
 import config
+from file_watcher import DEFAULT_QUEUE_SIZE
+from file_watcher import EventCoalescer
 from file_watcher import FileQueue
-from file_watcher import FileWatcher
+from file_watcher import create_watcher
+from file_watcher import WatchService
 from sync_api import SyncManager
+from sync_index import SyncIndex
+from utils.blocks import BlockIndex
 from animated_system_tray import AnimatedSystemTrayIcon
+from utils.journal import Journal
+from utils.metrics import MetricsExporter
+from utils.metrics import metrics
 
 
 class Omnisync():
     def __init__(self, progress_callback):
-        self.file_queue = FileQueue()
+        # pending work is journaled and replayed after a restart
+        self.journal = Journal(config.state_file('queue.db'))
+        self.journal.start()
+        self.file_queue = FileQueue(
+            maxsize=config.data.get('queue_size', DEFAULT_QUEUE_SIZE),
+            journal=self.journal,
+            overflow=config.data.get('queue_overflow', 'collapse'))
+        self.file_queue.replay(config.data['watches'])
+        # merges bursts of events for the same file before they are queued
+        self.coalescer = EventCoalescer(self.file_queue)
+        self.coalescer.start()
+        # one inotify instance and thread for all watches, the folders are
+        # watched in the background
+        self.watch_service = WatchService(
+            budget=config.data.get('watch_budget'),
+            rescan_interval=config.data.get('watch_rescan_interval', 300))
+        self.watch_service.start()
         self.watchers = []
         for watch_config in config.data['watches']:
             if not watch_config.get('disabled'):
-                self.watchers.append(
-                    FileWatcher(self.file_queue, watch_config))
+                self.watchers.append(create_watcher(
+                    self.coalescer, watch_config, self.watch_service))
+        # last synced state of every file, makes fullsync incremental
+        self.index = SyncIndex(config.state_file('index.db'))
+        # block checksums, changed large files are not hashed completely
+        self.blocks = BlockIndex(config.state_file('blocks.db'))
         self.sync_manager = SyncManager(
-            self.file_queue, progress_callback=progress_callback)
+            self.file_queue, progress_callback=progress_callback,
+            journal=self.journal, index=self.index, blocks=self.blocks)
+        # e.g. {'file': '~/omnisync.prom', 'format': 'prometheus',
+        #       'port': 9477, 'interval': 10}
+        metrics_config = config.data.get('metrics')
+        self.metrics_exporter = None
+        if metrics_config:
+            self.metrics_exporter = MetricsExporter(
+                metrics,
+                path=metrics_config.get('file'),
+                format=metrics_config.get('format', 'prometheus'),
+                port=metrics_config.get('port'),
+                interval=metrics_config.get('interval', 10),
+            )
+            self.metrics_exporter.start()
 
     def stop(self):
         [w.stop() for w in self.watchers]
+        self.watch_service.stop()
+        self.coalescer.stop()
         self.sync_manager.stop()
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.stop()
+        self.journal.close()
+        self.index.close()
+        self.blocks.close()
 
 
 class Gui(QtGui.QApplication):
@@ -64,10 +114,18 @@ class Gui(QtGui.QApplication):
         for syncer, val in self.progress.items():
             item = self.progress_menu_items.get(syncer.name, None)
             if item:
-                item.setText(
-                    '%s: %0.0f%% (queue: %s)'
-                    % (syncer.name, val * 100, syncer.queue.qsize())
-                )
+                text = '%s: %0.0f%% (queue: %s)' % (
+                    syncer.name, val * 100, syncer.queue.qsize())
+                speed = sum(getattr(stats, 'speed', 0)
+                            for stats in list(syncer.stats.values()))
+                if speed:
+                    text += ' %0.1f MB/s' % (speed / 1024 ** 2)
+                item.setText(text)
+        coalescer = self.omni_sync.coalescer
+        self.coalesced_menu_item.setText(
+            'coalesced: %s of %s events'
+            % (coalescer.folded_events, coalescer.raw_events)
+        )
 
     def handle_sync_progress(self, syncer, file, progress):
         self.progress[syncer] = progress
@@ -83,6 +141,7 @@ class Gui(QtGui.QApplication):
         for (entry, action) in [
             ('start rotate', self.tray_icon.get_animator('rotate')),
             ('stop animation', self.tray_icon.stop_animation),
+            ('pull remote changes', self.pull),
             ('quit', self.quit),
         ]:
             q_action = QtGui.QAction(entry, self)
@@ -95,10 +154,16 @@ class Gui(QtGui.QApplication):
             q_action = QtGui.QAction(syncer.name, self)
             self.progress_menu_items[syncer.name] = q_action
             menu.addAction(q_action)
+        self.coalesced_menu_item = QtGui.QAction('coalesced: -', self)
+        menu.addAction(self.coalesced_menu_item)
 
         self.tray_icon.setContextMenu(menu)
         self.tray_icon.show()
 
+    def pull(self, *args, **kwargs):
+        # pulling can take long, keep the gui responsive
+        Thread(target=self.omni_sync.sync_manager.pull).start()
+
     def quit(self, *args, **kwargs):
         self.omni_sync.stop()
         QtGui.qApp.quit()
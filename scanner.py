@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+""" Parallel walk of a local tree.
+
+`os.scandir` gets the names and types of a folder's entries in one call,
+and only the stat of each entry needs a syscall. Both release the GIL, so
+a pool of threads scans many folders at the same time.
+Used for the RESCAN events after startup and after an
+inotify queue overflow, see `sync_index.local_state`.
+
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+   http://sphinxcontrib-napoleon.readthedocs.org/en/latest/example_google.html
+"""
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.exclude import Excludes
+
+# threads that scan folders, with a warm cache a scan is CPU bound and more
+# threads than cores only contend for the GIL
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def _scan_folder(path, relative, excludes):
+    """ Returns the states of the entries of a folder, its subfolders as
+    (path, relative path) pairs and the relative paths of its excluded
+    entries.
+    """
+    entries, folders, excluded = [], [], []
+    try:
+        iterator = os.scandir(path)
+    except OSError:
+        return entries, folders, excluded  # deleted in the meantime
+    with iterator:
+        for entry in iterator:
+            name = entry.name if relative is None else \
+                relative + os.sep + entry.name
+            try:
+                # like `os.walk`: a link to a folder is a folder that is not
+                # entered
+                isdir = entry.is_dir()
+                if excludes.excluded(entry.path, isdir):
+                    excluded.append(name)
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue  # deleted in the meantime
+            entries.append((name, (stat.st_size, stat.st_mtime_ns, isdir)))
+            if isdir and not entry.is_symlink():
+                folders.append((entry.path, name))
+    return entries, folders, excluded
+
+
+def scan(source, exclude=None, recursive=True, workers=DEFAULT_WORKERS,
+         pruned=None):
+    """ Walks the local tree with a pool of threads. Excluded folders are
+    not entered.
+
+    Args:
+        source (str): Root of the tree.
+        exclude (Optional[Union[Excludes, list]]): Exclude rules of the
+            watch or regular expressions of absolute paths that are skipped.
+        recursive (Optional[bool]): False to only list the direct content of
+            `source`.
+        workers (Optional[int]): Number of threads.
+        pruned (Optional[list]): Receives the relative paths of the excluded
+            entries.
+    Returns:
+        dict: path relative to `source` -> (size, mtime, isdir)
+    """
+    excludes = exclude if isinstance(exclude, Excludes) else \
+        Excludes(source, exclude)
+    state = {}
+
+    def add(result):
+        entries, folders, excluded = result
+        state.update(entries)
+        if pruned is not None:
+            pruned.extend(excluded)
+        return folders if recursive else []
+    if not recursive or workers <= 1:
+        folders = [(source, None)]
+        while folders:
+            folders.extend(add(_scan_folder(*folders.pop(), excludes)))
+        return state
+    done = queue.Queue()
+    with ThreadPoolExecutor(workers) as pool:
+        def submit(path, relative):
+            pool.submit(_scan_folder, path, relative, excludes) \
+                .add_done_callback(done.put)
+        submit(source, None)
+        pending = 1
+        while pending:
+            folders = add(done.get().result())
+            pending -= 1
+            for path, relative in folders:
+                submit(path, relative)
+            pending += len(folders)
+    return state
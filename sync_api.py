@@ -11,48 +11,205 @@ Should support: google drive, dropbox, rsync
 from builtins import super
 import builtins
 
+import os
+import time
+from queue import Empty
+from threading import Lock
 from threading import Thread
-from importlib import import_module
-import pkgutil
-import pyclbr
+from concurrent.futures import ThreadPoolExecutor
 
 import syncers
-from utils.packages import find_modules_with_super_class
+from file_watcher import DEFAULT_QUEUE_SIZE
+from file_watcher import FileQueue
+from file_watcher import InotifyEvent
+from sync_index import IndexEntry
+from sync_index import changes
+from sync_index import local_state
+from utils.blocks import BLOCK_SIZE
+from utils.exclude import watch_excludes
+from utils.files import file_hash
+from utils.files import PART_SUFFIX
+from utils.containers import LRUCache
 from utils.containers import OrderedSetQueue
 from utils.log import log
+from utils.metrics import metrics
 from utils.strings import underscore
 import config
 
 
+def change_events(watch_config, changed):
+    """ Creates events for the output of `sync_index.changes`.
+
+    Args:
+        watch_config (dict): The watch the changed paths are relative to.
+        changed (iterable): (path, event type, isdir)
+    Returns:
+        generator: InotifyEvent for every change.
+    """
+    source = watch_config['source']
+    for path, type, isdir in changed:
+        source_absolute = os.path.join(source, path)
+        yield InotifyEvent(
+            None, watch_config,
+            source_absolute=source_absolute,
+            isdir=isdir,
+            type=type,
+        )
+
+
+class TransferCancelled(Exception):
+    """ Raised by a syncer that aborts an outdated transfer, see
+    `SyncBase.cancelled`.
+    """
+
+
 class QueueConsumer(Thread):
-    def __init__(self, queue=None):
+    # maximum number of queued items that are passed to `consume_batch`
+    batch_size = 1
+
+    def __init__(self, queue=None, workers=1):
+        """
+        Args:
+            queue (Optional[queue.Queue]): Queue with items to consume.
+            workers (Optional[int]): Number of threads that consume items in
+                parallel. The queue must take care of the order (see
+                `FileQueue`).
+        """
         self.queue = queue or OrderedSetQueue()
+        self.workers = workers
         super().__init__()
+        self.labels = {'syncer': self.__class__.__name__}
+        metrics.gauge_callback(
+            'omnisync_queue_depth', self.labels, self.queue.qsize)
         log.debug(self.__class__.__name__ + " init")
 
     def run(self):
         log.debug(self.__class__.__name__ + " running")
+        for _ in range(self.workers - 1):
+            Thread(target=self.work).start()
+        self.work()
+
+    def work(self):
         while True:
-            item = self.queue.get()
-            if item is None:  # trick to break out of while
+            items = [self.queue.get()]
+            # take what is already queued, up to `batch_size` items
+            while len(items) < self.batch_size and items[-1] is not None:
+                try:
+                    items.append(self.queue.get(block=False))
+                except Empty:
+                    break
+            stop = items[-1] is None  # trick to break out of while
+            if stop:
+                items.pop()
+                self.queue.put(None)  # stop the other workers as well
+            started = time.monotonic()
+            try:
+                batch = self.prepare_batch(items)
+                if batch:
+                    self.consume_batch(batch)
+            finally:
+                # items queued again while they were consumed are taken
+                # after this, see `SyncBase.cancelled`
+                finished = time.monotonic()
+                for item in items:
+                    self.queue.task_done(item)
+                    self.record_timing(item, started, finished)
+                if items:
+                    # once per batch, the items were processed together
+                    metrics.observe('omnisync_sync_seconds', self.labels,
+                                    finished - started)
+            if stop:
                 break
-            self.consume_item(item)
-            # TODO what if a file gets added again while syncing in progress?
-            self.queue.task_done()
+
+    def record_timing(self, item, started, finished):
+        enqueued = self.queue.enqueue_time(item)
+        metrics.inc('omnisync_events_total', self.labels)
+        if enqueued is not None:
+            metrics.observe(
+                'omnisync_queue_wait_seconds', self.labels,
+                started - enqueued)
+            metrics.observe(
+                'omnisync_event_latency_seconds', self.labels,
+                finished - enqueued)
 
     def stop(self):
         self.queue.put(None)  # trick to break out of while
         log.debug(self.__class__.__name__ + " stopped")
 
+    def prepare_batch(self, items):
+        """ Returns the items to pass to `consume_batch`.
+        """
+        return items
+
+    def consume_batch(self, items):
+        """ Consumes several items at once, override to save round trips.
+        """
+        for item in items:
+            self.consume_item(item)
+
     def consume_item(self, item): raise NotImplementedError
 
 
 class SyncBase(QueueConsumer):
-    def __init__(self):
-        super().__init__()
+    download_chunk_size = 1024 * 1024
+    # compare the content of changed files with the index before uploading
+    # them, see `shortcut_batch`
+    hash_uploads = False
+    # smallest file that is copied at the target instead of uploaded
+    server_copy_min_size = 1024 * 1024
+    # smallest file that is hashed block by block, see `utils.blocks`
+    block_hash_min_size = 16 * BLOCK_SIZE
+
+    def __init__(self, journal=None, index=None, blocks=None):
+        """
+        Args:
+            journal (Optional[Journal]): Makes the queue persistent.
+            index (Optional[SyncIndex]): Records the synced state of files,
+                see `synced`.
+            blocks (Optional[BlockIndex]): Block checksums of large files,
+                see `content_hash`.
+        """
+        configuration = config.data['configuration'].get(
+            self.__class__.__name__, {})
+        super().__init__(
+            queue=FileQueue(
+                maxsize=configuration.get('queue_size', config.data.get(
+                    'queue_size', DEFAULT_QUEUE_SIZE)),
+                journal=journal, name=self.__class__.__name__,
+                overflow=configuration.get('queue_overflow', config.data.get(
+                    'queue_overflow', 'collapse')),
+                key=self.event_key,
+            ),
+            workers=configuration.get('workers', 1)
+        )
+        self.batch_size = configuration.get('batch_size', self.batch_size)
+        self.download_chunk_size = configuration.get(
+            'download_chunk_size', self.download_chunk_size)
+        self.hash_uploads = configuration.get(
+            'hash_uploads', self.hash_uploads)
+        self.server_copy_min_size = configuration.get(
+            'server_copy_min_size', self.server_copy_min_size)
+        self.block_hash_min_size = configuration.get(
+            'block_hash_min_size', self.block_hash_min_size)
+        self.blocks = blocks
+        self._hasher = ThreadPoolExecutor(
+            max_workers=configuration.get('hash_workers', 4))
+        # (path, size, mtime) -> content hash
+        self._hashes = LRUCache(maxsize=10000)
+        # path -> (size, mtime) before the transfer, see `update_index`
+        self._sent = LRUCache(maxsize=10000)
+        self.index = index
         self.name = self.__class__.__name__
         self.progress = 1.0
         self.progress_callbacks = []
+        self._transfers = {}  # file -> progress of the running transfers
+        metrics.gauge_callback(
+            'omnisync_throughput_bytes_per_second', self.labels,
+            self.throughput)
+        # file -> details of the running transfers if the syncer has any
+        # (e.g. `syncers.rsync.RsyncProgress`)
+        self.stats = {}
+        self._progress_lock = Lock()
 
     def register_progress_callback(self, callback):
         """
@@ -60,18 +217,374 @@ class SyncBase(QueueConsumer):
             callback (callable):
                 Is called regularly with the progress of the syncing process.
                 Range: 0.0 - 1.0
+                The progress is the average over all running transfers of
+                the workers.
         """
         self.progress_callbacks.append(callback)
 
-    def send_progress(self, event, progress):
-        self.progress = progress
+    def send_progress(self, event, progress, stats=None):
+        """
+        Args:
+            event (str): The transferred file.
+            progress (float): Range: 0.0 - 1.0
+            stats (Optional[object]): Details of the transfer, available in
+                `stats` until the transfer is finished.
+        """
+        with self._progress_lock:
+            if progress >= 1.0:
+                self._transfers.pop(event, None)
+                self.stats.pop(event, None)
+            else:
+                self._transfers[event] = progress
+                if stats is not None:
+                    self.stats[event] = stats
+            if self._transfers:
+                progress = sum(self._transfers.values()) / len(self._transfers)
+            else:
+                progress = 1.0
+            self.progress = progress
         for callback in self.progress_callbacks:
             callback(self, event, progress)
 
 
+    def synced(self, event, remote_id=None, uploaded=True):
+        """ Records the local state of a successfully synced event in the
+        index. Must be called by every syncer for each synced event.
+
+        Args:
+            event (InotifyEvent): The synced event.
+            remote_id (Optional[str]): Id of the file at the target.
+            uploaded (Optional[bool]): False if the content was not
+                transferred, see `shortcut_batch`.
+        """
+        metrics.inc('omnisync_events_synced_total',
+                    dict(self.labels, type=event.type))
+        if not uploaded:
+            metrics.inc('omnisync_uploads_avoided_total', self.labels)
+        elif not event.isdir and event.type not in ['DELETE', 'MOVED_FROM']:
+            try:
+                metrics.inc('omnisync_uploaded_bytes_total', self.labels,
+                            os.path.getsize(event.source_absolute))
+            except OSError:
+                pass
+        if self.blocks is not None and not event.isdir and \
+                event.type in ['DELETE', 'MOVED_FROM']:
+            self.blocks.remove(event.source_absolute)
+        if self.index is None:
+            return
+        watch = event.source_base_dir
+        if event.moved_from is not None:
+            self.index.remove(
+                self.name, watch, event.moved_from.source_relative)
+        if event.type in ['DELETE', 'MOVED_FROM']:
+            self.index.remove(self.name, watch, event.source_relative)
+            return
+        self.update_index(watch, event.source_relative, remote_id)
+
+    def synced_move(self, event, remote_id=None):
+        """ Records a rename that was done at the target (see `remote_move`)
+        without uploading, the index entries below the old path move along.
+        """
+        if self.index is not None:
+            self.index.move(
+                self.name, event.source_base_dir,
+                event.moved_from.source_relative, event.source_relative)
+        self.synced(event, remote_id, uploaded=False)
+
+    def synced_content(self, event, paths=None):
+        """ Records the content of a folder that was transferred together
+        with the folder, e.g. after it was created or moved into place.
+        Otherwise every rescan queues the content again.
+
+        Args:
+            event (InotifyEvent): The synced folder event.
+            paths (Optional[iterable]): Paths relative to the folder, its
+                current local content by default.
+        """
+        if self.index is None:
+            return
+        if paths is None:
+            paths = local_state(
+                event.source_absolute, watch_excludes(event.config))
+        for path in paths:
+            self.update_index(event.source_base_dir,
+                              os.path.join(event.source_relative, path))
+
+    def prepare_batch(self, events):
+        """ Replaces RESCAN and RESCAN_DIR events (see `FileQueue`) by events
+        for the changes below their folder. With `hash_uploads` the events
+        that do not need an upload are synced right away.
+        """
+        batch = []
+        for event in events:
+            if event.type in ['RESCAN', 'RESCAN_DIR']:
+                batch.extend(self.rescan_events(event))
+            else:
+                batch.append(event)
+        for event in batch:
+            if not event.isdir and event.type not in ['DELETE', 'MOVED_FROM']:
+                try:
+                    stat = os.lstat(event.source_absolute)
+                except OSError:
+                    continue
+                self._sent[event.source_absolute] = (
+                    stat.st_size, stat.st_mtime_ns)
+        if self.hash_uploads and self.index is not None:
+            batch = self.shortcut_batch(batch)
+        return batch
+
+    def shortcut_batch(self, events):
+        """ Hashes the changed files of a batch in parallel and syncs events
+        without uploading content where the index allows it:
+
+        - files with the content they had when they were synced (e.g. after
+          chmod or touch) are skipped,
+        - renamed files and folders and new files with the content of a file
+          that is deleted in the same batch are moved at the target,
+        - new files with the content of another synced file are copied at the
+          target (from `server_copy_min_size` on).
+
+        Returns:
+            list: The events that still have to be synced.
+        """
+        changed = [event for event in events if not event.isdir and
+                   event.type not in ['DELETE', 'MOVED_FROM']]
+        contents = dict(zip(changed, self._hasher.map(self._hash, changed)))
+        deleted = {}  # (watch, hash) -> DELETE event of a synced file
+        for event in events:
+            if event.type != 'DELETE' or event.isdir:
+                continue
+            entry = self.index.get(
+                self.name, event.source_base_dir, event.source_relative)
+            if entry is not None and entry.hash is not None:
+                deleted.setdefault(
+                    (event.source_base_dir, entry.hash), event)
+        moved = set()  # ids of the DELETE events that became moves
+        batch = [event for event in events
+                 if not self._shortcut(event, contents.get(event), deleted,
+                                       moved)]
+        return [event for event in batch if id(event) not in moved]
+
+    def _hash(self, event):
+        try:
+            stat = os.stat(event.source_absolute)
+            return self.content_hash(event.source_absolute, stat), \
+                stat.st_size
+        except OSError:
+            return None  # already gone, the DELETE event follows
+
+    def _shortcut(self, event, content, deleted, moved):
+        """ Syncs an event without uploading its content if possible, see
+        `shortcut_batch`.
+
+        Args:
+            content (Optional[tuple]): Hash and size of the file.
+        Returns:
+            bool: True if the event was synced.
+        """
+        watch = event.source_base_dir
+        try:
+            if event.moved_from is not None:
+                old = event.moved_from.source_relative
+                entry = self.index.get(self.name, watch, old)
+                if entry is None or not event.isdir and (
+                        content is None or entry.hash != content[0]):
+                    return False
+                remote_id = self.remote_move(
+                    event.moved_from.target_absolute, event.target_absolute)
+                self.index.move(self.name, watch, old, event.source_relative)
+            elif event.isdir or content is None:
+                return False
+            else:
+                content_hash, size = content
+                entry = self.index.get(
+                    self.name, watch, event.source_relative)
+                if entry is not None and entry.hash == content_hash:
+                    remote_id = entry.remote_id
+                elif (watch, content_hash) in deleted:
+                    source = deleted.pop((watch, content_hash))
+                    remote_id = self.remote_move(
+                        source.target_absolute, event.target_absolute)
+                    self.index.move(self.name, watch, source.source_relative,
+                                    event.source_relative)
+                    moved.add(id(source))
+                elif size >= self.server_copy_min_size:
+                    copies = self.index.with_hash(
+                        self.name, watch, content_hash)
+                    if not copies:
+                        return False
+                    remote_id = self.remote_copy(
+                        os.path.join(event.target_base_dir, copies[0]),
+                        event.target_absolute)
+                else:
+                    return False
+        except NotImplementedError:
+            return False
+        except IOError as e:
+            log.warning('%s: no shortcut for %s, uploading it: %s' % (
+                self.name, event.source_absolute, e))
+            return False
+        log.debug('%s: %s synced without upload' % (
+            self.name, event.source_absolute))
+        self.synced(event, remote_id, uploaded=False)
+        return True
+
+    def rescan_events(self, event):
+        """ Returns events for everything below the folder of a RESCAN event
+        (only the direct content for RESCAN_DIR) that changed since it was
+        synced. Without an index that is everything.
+        """
+        folder = event.source_relative  # '.' for the source of the watch
+        # a removed folder takes its whole content with it
+        recursive = event.type == 'RESCAN' or \
+            not os.path.isdir(event.source_absolute)
+        local = local_state(
+            event.source_absolute, watch_excludes(event.config), recursive)
+        if folder != '.':
+            local = {os.path.join(folder, path): state
+                     for path, state in local.items()}
+            if os.path.isdir(event.source_absolute):
+                stat = os.stat(event.source_absolute)
+                local[folder] = (stat.st_size, stat.st_mtime_ns, True)
+        indexed = {}
+        if self.index is not None:
+            indexed = self.index.entries(
+                self.name, event.source_base_dir,
+                None if folder == '.' else folder)
+            if not recursive:
+                parent = '' if folder == '.' else folder
+                indexed = {path: entry for path, entry in indexed.items()
+                           if path == folder or
+                           os.path.dirname(path) == parent}
+        log.info('%s: rescanning %s' % (self.name, event.source_absolute))
+        return list(change_events(event.config, changes(local, indexed)))
+
+    def cancelled(self, event):
+        """ Tells if the event was queued again while it is synced. Syncers
+        check this during long transfers and abort them (raising
+        `TransferCancelled`), the queued event syncs the latest content.
+        """
+        return self.queue.is_dirty(event)
+
+    def throughput(self):
+        """ Returns the synced bytes per second of processing time.
+        """
+        seconds = metrics.get('omnisync_sync_seconds', self.labels)
+        uploaded = metrics.get('omnisync_uploaded_bytes_total', self.labels)
+        return uploaded / seconds if seconds else 0.0
+
+    def update_index(self, watch, path, remote_id=None):
+        """ Records the current local state of a path in the index.
+
+        A file that changed since `prepare_batch` is not recorded, the
+        target may have the old content. The event of the change syncs it.
+
+        Args:
+            watch (str): Source of the watch.
+            path (str): Path relative to `watch`.
+            remote_id (Optional[str]): Id of the file at the target.
+        """
+        if self.index is None:
+            return
+        source_absolute = os.path.join(watch, path)
+        sent = self._sent.get(source_absolute)
+        self._sent.discard(source_absolute)
+        try:
+            stat = os.lstat(source_absolute)
+            isdir = os.path.isdir(source_absolute)
+            if not isdir and sent is not None and \
+                    sent != (stat.st_size, stat.st_mtime_ns):
+                log.info('%s: %s changed while it was synced' % (
+                    self.name, source_absolute))
+                return
+            content_hash = None if isdir else \
+                self.content_hash(source_absolute, stat)
+        except OSError:
+            return  # already gone, the DELETE event follows
+        self.index.update(self.name, watch, path, IndexEntry(
+            stat.st_size, stat.st_mtime_ns, isdir, content_hash, remote_id))
+
+    def content_hash(self, path, stat):
+        """ Returns the md5 hex digest of a file, cached by path, size and
+        mtime.
+
+        Files from `block_hash_min_size` on get the hash of their block
+        checksums (see `BlockIndex`), only their changed blocks are hashed.
+        """
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        content_hash = self._hashes.get(key)
+        if content_hash is not None:
+            return content_hash
+        if self.blocks is not None and \
+                stat.st_size >= self.block_hash_min_size:
+            update = self.blocks.update(path, stat)
+            if update.changed:
+                log.debug('%s: changed %s' % (path, ', '.join(
+                    '%s+%s' % change for change in update.changed)))
+            content_hash = update.hash
+        else:
+            content_hash = file_hash(path)
+        self._hashes[key] = content_hash
+        return content_hash
+
+    def stream_download(self, local, chunks):
+        """ Writes a download chunk by chunk, so memory usage does not depend
+        on the file size.
+
+        The content goes to a `PART_SUFFIX` file that replaces `local` when
+        the download is complete. A partial download is resumed if the
+        remote file has the version (e.g. rev or md5) it was started with,
+        which is kept in `version_file(local)`.
+
+        Args:
+            local (str): Local file.
+            chunks (callable): Called with the offset to resume at and the
+                version of the partial download (None if unknown), returns
+                (offset, size, version, iterator over the content from
+                offset on). Returns offset 0 if the download can not be
+                resumed.
+        """
+        part = local + PART_SUFFIX
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        version = None
+        if offset:
+            try:
+                with open(self.version_file(local)) as f:
+                    version = f.read()
+            except OSError:
+                pass
+        offset, size, version, content = chunks(offset, version)
+        if not offset:
+            with open(self.version_file(local), 'w') as f:
+                f.write(version or '')
+        self.send_progress(local, 0.0)
+        try:
+            with open(part, 'ab' if offset else 'wb') as out:
+                out.truncate(offset)
+                for chunk in content:
+                    out.write(chunk)
+                    offset += len(chunk)
+                    metrics.inc('omnisync_downloaded_bytes_total',
+                                self.labels, len(chunk))
+                    self.send_progress(local, min(offset / size, 0.99))
+            os.replace(part, local)
+            os.remove(self.version_file(local))
+        finally:
+            self.send_progress(local, 1.0)
+
     @staticmethod
-    def event_hash_function(event):
-        return None
+    def version_file(local):
+        """ Returns the file with the remote version of a partial download,
+        see `stream_download`.
+        """
+        return local + '.version' + PART_SUFFIX
+
+    @staticmethod
+    def event_key(event):
+        """ Queued events with the same key are merged (see `FileQueue`),
+        by default only events for the same file.
+        """
+        return event
 
     def init(self):
         raise NotImplementedError
@@ -103,6 +616,22 @@ class SyncBase(QueueConsumer):
         """
         raise NotImplementedError
 
+    def remote_move(self, remote, new_remote):
+        """ Moves a file or folder at the target.
+
+        Returns:
+            The remote id of the moved file, see `synced`.
+        """
+        raise NotImplementedError
+
+    def remote_copy(self, remote, new_remote):
+        """ Copies a file at the target.
+
+        Returns:
+            The remote id of the copy, see `synced`.
+        """
+        raise NotImplementedError
+
     def pull(self, local, remote):
         """
 
@@ -118,13 +647,20 @@ class SyncBase(QueueConsumer):
 class SyncManager(QueueConsumer):
     """ Manages the different file uploaders.
     """
-    def __init__(self, file_queue, progress_callback=None):
+    def __init__(self, file_queue, progress_callback=None, journal=None,
+                 index=None, blocks=None):
         """
         Args:
             file_queue (queue.Queue): Queue with files to sync.
+            journal (Optional[Journal]): Makes the queues of the syncers
+                persistent, recorded items are replayed before the syncers
+                start.
+            index (Optional[SyncIndex]): Makes `fullsync` incremental.
+            blocks (Optional[BlockIndex]): Block checksums of large files.
         """
         super().__init__(queue=file_queue)
         self.progress_callback = progress_callback
+        self.index = index
 
         def syncer_is_enabled(syncer):
             for watch in config.data['watches']:
@@ -132,26 +668,29 @@ class SyncManager(QueueConsumer):
                         syncer in watch['syncers']:
                     return True
             return False
-        self.syncers = self.get_syncer_instances(filter=syncer_is_enabled)
+        self.syncers = self.get_syncer_instances(
+            filter=syncer_is_enabled, journal=journal, index=index,
+            blocks=blocks)
 
+        # the replayed items go first, before the manager adds new ones
+        for syncer in self.syncers.values():
+            syncer.queue.replay(config.data['watches'])
         for syncer in self.syncers.values():
             syncer.start()
             syncer.register_progress_callback(self.handle_sync_progress)
         self.start()
 
     @staticmethod
-    def get_syncer_instances(filter=lambda: True):
-        # Import syncers from 'syncers' package and start them.
-        # Does something like: from syncers.dropbox import Dropbox
+    def get_syncer_instances(filter=lambda syncer: True, journal=None,
+                             index=None, blocks=None):
+        """ Creates the syncers declared in `syncers.SYNCERS` that pass
+        `filter`, only their modules are imported.
+        """
         syncer_instances = {}
-        # find classes inside syncers package that have the superclass SyncBase
-        available_syncers = dict(find_modules_with_super_class(
-                syncers, SyncBase))
-        log.debug('available_syncers: %s' % list(available_syncers.keys()))
-
-        for syncer in builtins.filter(filter, available_syncers.keys()):
-            syncer_instances[syncer] = getattr(
-                import_module(available_syncers[syncer]), syncer)()
+        for syncer in builtins.filter(filter, syncers.SYNCERS):
+            syncer_instances[syncer] = syncers.syncer_class(syncer)(
+                journal=journal, index=index, blocks=blocks)
+        log.debug('syncers: %s' % list(syncer_instances))
         return syncer_instances
 
     def handle_sync_progress(self, syncer, file, progress):
@@ -163,12 +702,40 @@ class SyncManager(QueueConsumer):
         super().stop()
 
     def fullsync(self):
-        for syncer in self.syncers.values():
-            syncer.fullsync()
+        """ Queues everything that changed since it was last synced.
+
+        Without an index every syncer does its own (expensive) fullsync.
+        """
+        if self.index is None:
+            for syncer in self.syncers.values():
+                syncer.fullsync()
+            return
+        for watch_config in config.data['watches']:
+            if watch_config.get('disabled'):
+                continue
+            source = watch_config['source']
+            local = local_state(source, watch_excludes(watch_config))
+            for name in watch_config['syncers']:
+                syncer = self.syncers[name]
+                indexed = self.index.entries(name, source)
+                for event in change_events(
+                        watch_config, changes(local, indexed)):
+                    syncer.queue.put(event)
+
+    def pull(self):
+        """ Pulls the remote changes of all watches from the syncers that
+        support it.
+        """
+        for watch_config in config.data['watches']:
+            if watch_config.get('disabled'):
+                continue
+            for name in watch_config['syncers']:
+                try:
+                    self.syncers[name].pull(
+                        watch_config['source'], watch_config['target'])
+                except NotImplementedError:
+                    log.debug('%s can not pull' % name)
 
     def consume_item(self, event):
         for syncer in event.syncers:
-            if self.syncers[syncer].event_hash_function(event) is not None:
-                # monkey patch the event hash function
-                event.__hash__ = self.syncers[syncer].event_hash_function
             self.syncers[syncer].queue.put(event)
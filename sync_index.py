@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+""" Index of the last synced state of every file.
+
+For every syncer and watch the index stores size, mtime, content hash and
+remote id of each synced path (relative to the source of the watch). A
+fullsync only has to compare the local tree against it.
+
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+   http://sphinxcontrib-napoleon.readthedocs.org/en/latest/example_google.html
+"""
+import re
+import sqlite3
+import threading
+from collections import namedtuple
+
+from scanner import scan
+
+IndexEntry = namedtuple(
+    'IndexEntry', ['size', 'mtime', 'isdir', 'hash', 'remote_id'])
+
+
+class SyncIndex():
+    """
+    Args:
+        path (str): SQLite database file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # the index can always be rebuilt, no need to fsync every update
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'syncer TEXT, watch TEXT, path TEXT, size INTEGER, '
+            'mtime INTEGER, isdir INTEGER, hash TEXT, remote_id TEXT, '
+            'PRIMARY KEY (syncer, watch, path))'
+        )
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS files_hash '
+            'ON files (syncer, watch, hash)')
+
+    def get(self, syncer, watch, path):
+        """
+        Returns:
+            IndexEntry or None if the path was not synced.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT size, mtime, isdir, hash, remote_id FROM files '
+                'WHERE syncer = ? AND watch = ? AND path = ?',
+                (syncer, watch, path)
+            ).fetchone()
+        return row and IndexEntry(*row)
+
+    def entries(self, syncer, watch, folder=None):
+        """
+        Args:
+            folder (Optional[str]): Only return the folder and its content.
+        Returns:
+            dict: path -> IndexEntry of all synced paths of the watch.
+        """
+        query = 'SELECT path, size, mtime, isdir, hash, remote_id ' \
+            'FROM files WHERE syncer = ? AND watch = ?'
+        args = (syncer, watch)
+        if folder is not None:
+            query += ' AND (path = ? OR path LIKE ? ESCAPE "\\")'
+            args += (folder, _like_prefix(folder))
+        with self._lock:
+            rows = self._db.execute(query, args).fetchall()
+        return {row[0]: IndexEntry(*row[1:]) for row in rows}
+
+    def update(self, syncer, watch, path, entry):
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (syncer, watch, path) + tuple(entry)
+            )
+
+    def remove(self, syncer, watch, path):
+        """ Removes a path and everything below it.
+        """
+        like = _like_prefix(path)
+        with self._lock, self._db:
+            self._db.execute(
+                'DELETE FROM files WHERE syncer = ? AND watch = ? AND '
+                '(path = ? OR path LIKE ? ESCAPE "\\")',
+                (syncer, watch, path, like)
+            )
+
+    def move(self, syncer, watch, path, new_path):
+        """ Moves a path and everything below it to `new_path`, entries at
+        the new location are replaced.
+        """
+        self.remove(syncer, watch, new_path)
+        like = _like_prefix(path)
+        with self._lock, self._db:
+            self._db.execute(
+                'UPDATE files SET path = ? || substr(path, ?) '
+                'WHERE syncer = ? AND watch = ? AND '
+                '(path = ? OR path LIKE ? ESCAPE "\\")',
+                (new_path, len(path) + 1, syncer, watch, path, like)
+            )
+
+    def with_hash(self, syncer, watch, content_hash):
+        """
+        Returns:
+            list: Paths of the synced files with this content.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT path FROM files '
+                'WHERE syncer = ? AND watch = ? AND hash = ?',
+                (syncer, watch, content_hash)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _like_prefix(path):
+    """ Returns a LIKE pattern (with escape character '\\') for everything
+    below `path`.
+    """
+    return re.sub(r'([%_\\])', r'\\\1', path) + '/%'
+
+
+def local_state(source, exclude=None, recursive=True, pruned=None):
+    """ Walks the local tree, see `scanner.scan`.
+
+    Args:
+        source (str): Root of the tree.
+        exclude (Optional[Union[Excludes, list]]): Exclude rules of the
+            watch or regular expressions of absolute paths that are skipped.
+        recursive (Optional[bool]): False to only list the direct content of
+            `source`.
+        pruned (Optional[list]): Receives the relative paths of the excluded
+            entries.
+    Returns:
+        dict: path relative to `source` -> (size, mtime, isdir)
+    """
+    return scan(source, exclude, recursive, pruned=pruned)
+
+
+def changes(local, indexed):
+    """ Compares the local state with the indexed one.
+
+    Args:
+        local (dict): Output of `local_state`.
+        indexed (dict): Output of `SyncIndex.entries`.
+    Returns:
+        generator: (path, event type, isdir) for every changed path, parent
+            folders come before their content.
+    """
+    for path in sorted(local):
+        size, mtime, isdir = local[path]
+        entry = indexed.get(path)
+        if entry is None:
+            yield path, 'CREATE', isdir
+        elif bool(entry.isdir) != isdir:
+            yield path, 'MODIFY', isdir
+        elif not isdir and (entry.size, entry.mtime) != (size, mtime):
+            yield path, 'MODIFY', isdir
+    deleted = None
+    for path in sorted(set(indexed) - set(local)):
+        # the content of a deleted folder is deleted with it
+        if deleted is not None and path.startswith(deleted + '/'):
+            continue
+        deleted = path
+        yield path, 'DELETE', bool(indexed[path].isdir)
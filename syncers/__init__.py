@@ -0,0 +1,25 @@
+""" Syncers, one `sync_api.SyncBase` subclass per kind of target.
+
+Every syncer is declared in `SYNCERS`, so starting omniSync imports only
+the modules of the enabled syncers instead of parsing all of them. A new
+syncer needs an entry here.
+"""
+from importlib import import_module
+
+# class name -> module
+SYNCERS = {
+    'Dropbox': 'syncers.dropbox_sync',
+    'GoogleDrive': 'syncers.google_drive',
+    'Rsync': 'syncers.rsync',
+}
+
+
+def syncer_class(name):
+    """ Imports a syncer.
+
+    Args:
+        name (str): Class name of the syncer, as used in the config.
+    Raises:
+        KeyError: The syncer is not declared in `SYNCERS`.
+    """
+    return getattr(import_module(SYNCERS[name]), name)
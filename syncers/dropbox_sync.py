@@ -2,18 +2,50 @@
 import sys
 import os
 sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
-
-import dropbox
+import json
+import time
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from sync_api import SyncBase
+from sync_api import TransferCancelled
+from sync_index import local_state
+from utils.exclude import watch_excludes
 import config
 from utils.log import log
+from utils.files import load_json
+from utils.files import save_json
+from utils.packages import LazyModule
+
+# imported by the syncer thread when it logs in
+dropbox = LazyModule('dropbox')
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_RETRY_DELAY = 60  # seconds
 
 
 class Dropbox(SyncBase):
+    hash_uploads = True
+    # the files of a batch are hashed in parallel before they are uploaded
+    batch_size = 10
+
     def __init__(self, *args, **kwargs):
         self.configuration = config.data['configuration'][
             self.__class__.__name__]
+        self.chunk_size = self.configuration.get(
+            'chunk_size', DEFAULT_CHUNK_SIZE)
+        self.max_retries = self.configuration.get('max_retries', 5)
+        self.retry_delay = self.configuration.get('retry_delay', 1)
+        # dropbox path -> state of an unfinished chunked upload, survives
+        # restarts so that big uploads continue where they stopped
+        self._uploads_file = config.state_file('dropbox_uploads.json')
+        self._uploads = load_json(self._uploads_file, {})
+        self._uploads_lock = threading.Lock()
+        # 'local -> remote' -> delta cursor of the last pull
+        self._cursors_file = config.state_file('dropbox_cursors.json')
+        self._cursors = load_json(self._cursors_file, {})
+        self._cursors_lock = threading.Lock()
         super().__init__(*args, **kwargs)
 
     # region overrides
@@ -30,10 +62,21 @@ class Dropbox(SyncBase):
 
         self.send_progress(event.source_absolute, 0.0)
         try:
-            self._upload(event, event.target_absolute)
+            if event.isdir and event.type == 'MOVED_TO':
+                self._put_folder(event)
+            else:
+                metadata = self._upload(event, event.target_absolute)
+                self.synced(event, remote_id=metadata and metadata['rev'])
+        except TransferCancelled:
+            log.info('%s changed during the upload, starting over' %
+                     event.source_absolute)
         except IOError as e:
             # file was deleted immediatily
             log.warning('upload failed' + str(e))
+        except dropbox.rest.ErrorResponse as e:
+            # unfinished chunked uploads are resumed with the next attempt
+            log.warning('upload failed' + str(e))
+        finally:
             self.send_progress(event.source_absolute, 1.0)
 
     def walk(self, start='/'):
@@ -43,9 +86,40 @@ class Dropbox(SyncBase):
             response = self.client.delta(
                     cursor=response['cursor'], path_prefix=start
             )
-            files.append([x[1]['path'] for x in response['entries']])
+            files.extend([x[1]['path'] for x in response['entries']])
         return files
 
+    def pull(self, local, remote):
+        """ Applies the remote changes since the last pull to `local`.
+
+        The delta cursor is stored per watch, so only the first pull has to
+        list everything. After a reset the synced local paths that are not
+        listed anymore are removed.
+        """
+        key = '%s -> %s' % (local, remote)
+        with self._cursors_lock:
+            cursor = self._cursors.get(key)
+        listed = None  # lower case paths of a reset listing
+        has_more = True
+        while has_more:
+            response = self.client.delta(cursor=cursor, path_prefix=remote)
+            if response['reset']:
+                log.info('pulling everything from Dropbox: ' + remote)
+                listed = set()
+            for path, metadata in response['entries']:
+                if listed is not None and metadata is not None:
+                    listed.add(path)
+                self._apply_delta_entry(local, remote, path, metadata)
+            cursor, has_more = response['cursor'], response['has_more']
+            if listed is not None and has_more:
+                continue  # a restart lists everything again
+            if listed is not None:
+                self._remove_unlisted(local, remote, listed)
+            # the entries are applied, the next pull continues from here
+            with self._cursors_lock:
+                self._cursors[key] = cursor
+                save_json(self._cursors_file, self._cursors)
+
     def rm(self, path, *args, **kwargs):
         if path == '/':
             log.critical('prevented delete / (root)')
@@ -58,16 +132,54 @@ class Dropbox(SyncBase):
                 raise e
 
     def download(self, local, remote):
-        out = open(local, 'wb')
-        with self.client.get_file(
-            remote, rev=None, start=None, length=None
-        ) as file:
-            out.write(file.read())
+        def chunks(offset, version):
+            if version is None:
+                offset = 0
+            try:
+                response = self.client.get_file(
+                    remote, rev=None, start=offset or None, length=None)
+            except dropbox.rest.ErrorResponse as e:
+                if e.status != 416:
+                    raise
+                # the partial download is bigger than the file now
+                offset = 0
+                response = self.client.get_file(remote)
+            metadata = json.loads(response.getheader('x-dropbox-metadata'))
+            if offset and metadata['rev'] != version:
+                # changed since the partial download, start over
+                response.close()
+                offset = 0
+                response = self.client.get_file(remote)
+                metadata = json.loads(
+                    response.getheader('x-dropbox-metadata'))
+
+            def read():
+                with response:
+                    yield from iter(
+                        lambda: response.read(self.download_chunk_size), b'')
+            return offset, metadata['bytes'], metadata['rev'], read()
+        self.stream_download(local, chunks)
 
     def upload(self, local, remote):
         with open(local, 'rb') as file:
             self._put_file(file, local, remote)
 
+    def remote_move(self, remote, new_remote):
+        try:
+            self.rm(new_remote)
+            return self._retry(
+                self.client.file_move, remote, new_remote).get('rev')
+        except dropbox.rest.ErrorResponse as e:
+            raise IOError(e)
+
+    def remote_copy(self, remote, new_remote):
+        try:
+            self.rm(new_remote)
+            return self._retry(
+                self.client.file_copy, remote, new_remote).get('rev')
+        except dropbox.rest.ErrorResponse as e:
+            raise IOError(e)
+
     # endregion
 
     # region authorization
@@ -106,33 +218,256 @@ class Dropbox(SyncBase):
     # endregion
 
     # region file operations
-    def _put_file(self, file, local_path, dropbox_path):
-        size = os.stat(file.fileno()).st_size
-        if size < 1000: # kb
-            self.client.put_file(dropbox_path, file, overwrite=True)
+    def _put_file(self, file, local_path, dropbox_path, event=None):
+        stat = os.stat(file.fileno())
+        if stat.st_size < self.chunk_size:
+            def put_file():
+                file.seek(0)
+                return self.client.put_file(
+                    dropbox_path, file, overwrite=True)
+            metadata = self._retry(put_file)
             self.send_progress(local_path, 1.0)
-        else:
-            chunk_size = 1024 * 1024
-            offset = 0
-            upload_id = None
-            last_block = None
-            while offset < size:
-                next_chunk_size = min(chunk_size, size - offset)
-                if last_block is None:
-                    last_block = file.read(next_chunk_size)
+            return metadata
+
+        upload = {'local': local_path, 'size': stat.st_size,
+                  'mtime': stat.st_mtime_ns, 'upload_id': None, 'offset': 0}
+        with self._uploads_lock:
+            previous = self._uploads.get(dropbox_path, {})
+        if all(previous.get(key) == upload[key]
+               for key in ['local', 'size', 'mtime']):
+            log.info('resuming upload of %s at %s' % (
+                local_path, previous['offset']))
+            upload = dict(previous)
+        try:
+            self._upload_chunks(file, upload, dropbox_path, event)
+        except dropbox.rest.ErrorResponse as e:
+            if e.status != 404 or upload['upload_id'] is None:
+                raise
+            # the upload expired on the server, start over
+            upload.update(upload_id=None, offset=0)
+            self._upload_chunks(file, upload, dropbox_path, event)
+        except TransferCancelled:
+            # can not be resumed, the content changed
+            self._save_upload(dropbox_path, None)
+            raise
+        metadata = self._retry(
+            self.client.commit_chunked_upload,
+            'auto' + dropbox_path, upload['upload_id'],
+            overwrite=True, parent_rev=None
+        )
+        self._save_upload(dropbox_path, None)
+        return metadata
+
+    def _upload_chunks(self, file, upload, dropbox_path, event=None):
+        """ Sends the file from `upload['offset']` on in chunks of
+        `chunk_size`. The next chunk is read while the current one is sent.
+
+        Args:
+            upload (dict): State of the upload, updated after every chunk.
+            event (Optional[InotifyEvent]): The upload is aborted with
+                `TransferCancelled` if the event is queued again.
+        """
+        size = upload['size']
+        with ThreadPoolExecutor(max_workers=1) as read_ahead:
+            def read_at(offset):
+                file.seek(offset)
+                return read_ahead.submit(file.read, self.chunk_size)
+            next_chunk = read_at(upload['offset'])
+            while upload['offset'] < size:
+                if event is not None and self.cancelled(event):
+                    raise TransferCancelled(upload['local'])
+                chunk = next_chunk.result()
+                if not chunk:
+                    raise IOError('file shrank during upload')
+                next_chunk = read_ahead.submit(file.read, self.chunk_size)
                 try:
-                    (offset, upload_id) = self.client.upload_chunk(
-                        last_block, next_chunk_size, offset, upload_id)
-                    self.last_block = None
-                    self.send_progress(local_path, min(offset, size) / size)
+                    offset, upload_id = self._retry(
+                        self.client.upload_chunk, chunk, len(chunk),
+                        upload['offset'], upload['upload_id'])
                 except dropbox.rest.ErrorResponse as e:
-                    log.exception(e)
-            self.client.commit_chunked_upload(
-                'auto' + dropbox_path, upload_id,
-                overwrite=True, parent_rev=None
-            )
+                    if e.status != 400 or 'offset' not in (e.body or {}):
+                        raise
+                    # the server expects a different offset (e.g. when the
+                    # response of a successful chunk got lost)
+                    offset, upload_id = e.body['offset'], e.body['upload_id']
+                    next_chunk.result()
+                    next_chunk = read_at(offset)
+                upload.update(offset=offset, upload_id=upload_id)
+                self._save_upload(dropbox_path, upload)
+                self.send_progress(upload['local'], min(offset, size) / size)
+
+    def _save_upload(self, dropbox_path, upload):
+        """ Persists the state of an unfinished upload, None removes it.
+        """
+        with self._uploads_lock:
+            if upload is None:
+                self._uploads.pop(dropbox_path, None)
+            else:
+                self._uploads[dropbox_path] = dict(upload)
+            save_json(self._uploads_file, self._uploads)
+
+    def _retry(self, function, *args, **kwargs):
+        """ Calls `function`, retries failed requests with exponential
+        backoff up to `max_retries` times.
+
+        Only network errors, server errors and rate limiting are retried.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                return function(*args, **kwargs)
+            except (dropbox.rest.RESTSocketError,
+                    dropbox.rest.ErrorResponse) as e:
+                retry = isinstance(e, dropbox.rest.RESTSocketError) or \
+                    e.status == 429 or e.status >= 500
+                if not retry or attempt == self.max_retries:
+                    raise
+                delay = min(self.retry_delay * 2 ** attempt, MAX_RETRY_DELAY)
+                log.warning('%s, retrying in %ss' % (e, delay))
+                time.sleep(delay)
+
+    def _apply_delta_entry(self, local, remote, path, metadata):
+        """
+        Args:
+            path (str): Lower case dropbox path of the entry.
+            metadata (dict): None if the path was deleted.
+        """
+        if metadata is None:
+            local_path = self._local_path(local, path[len(remote):])
+            if local_path is None:
+                return
+            if os.path.normpath(local_path) == os.path.normpath(local):
+                log.critical('prevented delete of the watch source ' + local)
+                return
+            log.info('deleting pulled path: ' + local_path)
+            if os.path.isdir(local_path) and not os.path.islink(local_path):
+                shutil.rmtree(local_path)
+            else:
+                os.remove(local_path)
+            if self.index is not None:
+                self.index.remove(
+                    self.name, local, os.path.relpath(local_path, local))
+            return
+        relative = metadata['path'][len(remote):].lstrip('/')
+        local_path = os.path.join(local, relative)
+        if metadata['is_dir']:
+            os.makedirs(local_path, exist_ok=True)
+            return
+        if self.index is not None:
+            entry = self.index.get(self.name, local, relative)
+            if entry is not None and entry.remote_id == metadata['rev']:
+                return  # uploaded from here
+        log.info('pulling from Dropbox: %s -> %s' % (
+            metadata['path'], local_path))
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        self.download(local_path, metadata['path'])
+        self.update_index(local, relative, remote_id=metadata['rev'])
+
+    def _remove_unlisted(self, local, remote, listed):
+        """ Removes the synced paths below `local` that are not in the
+        listing of a reset. Files that changed since they were synced and
+        folders with other content are kept, they are uploaded again.
+
+        Args:
+            listed (set): Lower case dropbox paths of the listing.
+        """
+        if self.index is None:
+            log.warning('no index, paths deleted from Dropbox during the '
+                        'reset are kept: ' + local)
+            return
+        entries = self.index.entries(self.name, local)
+        # the content of a folder comes first
+        for relative in sorted(entries, reverse=True):
+            if (remote.rstrip('/') + '/' + relative).lower() in listed:
+                continue
+            local_path = os.path.join(local, relative)
+            entry = entries[relative]
+            try:
+                if entry.isdir:
+                    os.rmdir(local_path)
+                else:
+                    stat = os.lstat(local_path)
+                    if (stat.st_size, stat.st_mtime_ns) != \
+                            (entry.size, entry.mtime):
+                        continue
+                    os.remove(local_path)
+                log.info('deleting pulled path: ' + local_path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            self.index.remove(self.name, local, relative)
+
+    @staticmethod
+    def _local_path(local, relative):
+        """ Finds the local path of a (lower case) dropbox path, dropbox
+        paths are case insensitive.
+
+        Returns:
+            str: None if the path does not exist locally.
+        """
+        path = local
+        for name in filter(None, relative.split('/')):
+            candidate = os.path.join(path, name)
+            if not os.path.lexists(candidate):
+                try:
+                    matches = [n for n in os.listdir(path)
+                               if n.lower() == name.lower()]
+                except OSError:
+                    return None
+                if not matches:
+                    return None
+                candidate = os.path.join(path, matches[0])
+            path = candidate
+        return path
+
+    def _put_folder(self, event):
+        """ Syncs a folder that was moved into place. The old folder is
+        moved at the target with its content, if it is not there the local
+        content is uploaded.
+        """
+        if event.moved_from is not None:
+            try:
+                rev = self.remote_move(
+                    event.moved_from.target_absolute, event.target_absolute)
+            except IOError as e:
+                log.info('%s: uploading the content of %s' % (
+                    e, event.source_absolute))
+            else:
+                self.synced_move(event, rev)
+                return
+        self._create_folder(event.target_absolute)
+        uploaded = []
+        local = local_state(
+            event.source_absolute, watch_excludes(event.config))
+        for path in sorted(local):
+            dropbox_path = os.path.join(event.target_absolute, path)
+            try:
+                if local[path][2]:
+                    self._create_folder(dropbox_path)
+                else:
+                    self.upload(
+                        os.path.join(event.source_absolute, path),
+                        dropbox_path)
+            except (IOError, dropbox.rest.ErrorResponse) as e:
+                log.warning('upload failed' + str(e))
+                continue
+            uploaded.append(path)
+        if event.moved_from is not None:
+            self.rm(event.moved_from.target_absolute)
+        self.synced(event)
+        self.synced_content(event, uploaded)
+
+    def _create_folder(self, dropbox_path):
+        try:
+            self.client.file_create_folder(dropbox_path)
+        except dropbox.rest.ErrorResponse as e:
+            if e.status != 403:  # exists already
+                raise
 
     def _upload(self, event, dropbox_path):
+        if event.type in ['DELETE', 'MOVED_FROM']:
+            self.rm(dropbox_path)
+            return
         if event.isdir:
             if event.type != 'CREATE': return
             try:
@@ -142,7 +477,12 @@ class Dropbox(SyncBase):
             finally: return
 
         with open(event.source_absolute, 'rb') as file:
-            self._put_file(file, event.source_absolute, dropbox_path)
+            metadata = self._put_file(
+                file, event.source_absolute, dropbox_path, event)
+        if event.moved_from is not None:
+            # renamed, but not moved at the target (see `shortcut_batch`)
+            self.rm(event.moved_from.target_absolute)
+        return metadata
     # endregion
 
 if __name__ == '__main__':
@@ -4,33 +4,67 @@ import os
 sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
 import time
 import mimetypes
-import httplib2
-
-# google drive stuff
-from apiclient import discovery
-import oauth2client
+import threading
 from argparse import ArgumentParser
-from oauth2client.client import OAuth2WebServerFlow
-from apiclient.http import MediaFileUpload
-from apiclient.http import MediaIoBaseUpload
 
 import config
 from utils.log import log
+from utils.containers import LRUCache
+from utils.files import load_json
+from utils.files import save_json
+from utils.packages import LazyModule
 from sync_api import SyncBase
+from sync_api import TransferCancelled
+from sync_index import local_state
+from utils.exclude import watch_excludes
+
+# google drive stuff, imported by the syncer thread when it authorizes
+httplib2 = LazyModule('httplib2')
+apiclient = LazyModule('apiclient')
+oauth2client = LazyModule('oauth2client')
 
 SCOPES = 'https://www.googleapis.com/auth/drive'
 APPLICATION_NAME = 'omniSync'
 MIME_FOLDER = "application/vnd.google-apps.folder"
+# maximum number of requests in one batch request
+BATCH_LIMIT = 100
+_FAILED = object()
+_PENDING = object()
 
 
 class GoogleDrive(SyncBase):
+    batch_size = BATCH_LIMIT
+    hash_uploads = True
 
     def __init__(self, *args, **kwargs):
         self.configuration = config.data['configuration'][
             self.__class__.__name__]
-        self.service = None
+        self.credentials = None
+        self._local = threading.local()
+        # '/path/to/file' -> id, saves one request per path segment
+        self.path_cache = LRUCache(
+            self.configuration.get('path_cache_size', 10000))
+        if self.configuration.get('persist_path_cache'):
+            self._path_cache_file = config.state_file(
+                'google_drive_ids.json')
+            for path, file_id in load_json(self._path_cache_file, []):
+                self.path_cache[path] = file_id
         super().__init__(*args, **kwargs)
 
+    @property
+    def service(self):
+        """ httplib2 is not thread safe, so every worker builds its own
+        service.
+        """
+        if getattr(self._local, 'service', None) is None and \
+                self.credentials is not None:
+            self.authorize()
+        return getattr(self._local, 'service', None)
+
+    @service.setter
+    def service(self, service):
+        self._local.service = service
+
     # region overrides
     def run(self):
         self.get_credentials()
@@ -42,23 +76,75 @@ class GoogleDrive(SyncBase):
         self.get_credentials()
         self.authorize()
 
+    def stop(self):
+        super().stop()
+        if self.configuration.get('persist_path_cache'):
+            save_json(self._path_cache_file, self.path_cache.items())
+
     def consume_item(self, event):
         log.info('uploading to GoogleDrive: %s -> %s' %
                  (event.source_absolute, event.target_absolute))
 
         self.send_progress(event.source_absolute, 0.0)
-        # TODO handle dir/file removal
         try:
-            if event.isdir:
-                self._path_to_ids(event.target_absolute, create_missing=True)
+            if event.isdir and event.type == 'MOVED_TO':
+                self._put_folder(event)
+                return
+            if event.moved_from is not None:
+                self.rm(event.moved_from.target_absolute)
+            if event.type in ['DELETE', 'MOVED_FROM']:
+                self.rm(event.target_absolute)
+                remote_id = None
+            elif event.isdir:
+                remote_id = self._path_to_ids(
+                    event.target_absolute, create_missing=True)[-1]
             else:
-                self._put_file(event.source_absolute, event.target_absolute)
+                remote_id = self._put_file(
+                    event.source_absolute, event.target_absolute,
+                    event=event)['id']
+            self.synced(event, remote_id=remote_id)
+        except TransferCancelled:
+            log.info('%s changed during the upload, starting over' %
+                     event.source_absolute)
         except IOError as e:
             # file was deleted immediatily?
             log.warning('upload failed' + str(e))
         finally:
             self.send_progress(event.source_absolute, 1.0)
 
+    def consume_batch(self, events):
+        """ Bundles the metadata requests (lookups, trashing and folder
+        creation) of several events into batch requests. Only file content is
+        uploaded one by one, and renamed folders are moved one by one. If a
+        batch fails the events that were not synced yet are consumed one by
+        one.
+        """
+        for event in events:
+            if event.isdir and event.type == 'MOVED_TO':
+                self.consume_item(event)
+        events = [event for event in events
+                  if not (event.isdir and event.type == 'MOVED_TO')]
+        if not events:
+            return
+        if len(events) == 1:
+            return self.consume_item(events[0])
+        log.info('syncing %s events with GoogleDrive' % len(events))
+        for event in events:
+            self.send_progress(event.source_absolute, 0.0)
+        remote_ids = [_PENDING] * len(events)
+        try:
+            self._consume_batch(events, remote_ids)
+        except (IOError, apiclient.errors.HttpError) as e:
+            log.warning('batch failed, syncing %s events one by one: %s' % (
+                remote_ids.count(_PENDING), e))
+        for event, remote_id in zip(events, remote_ids):
+            if remote_id is _PENDING:
+                self.consume_item(event)
+                continue
+            if remote_id is not _FAILED:
+                self.synced(event, remote_id=remote_id)
+            self.send_progress(event.source_absolute, 1.0)
+
     def walk(self, start='/'):
         return (x['path'] + x['title'] for x in self._walk(start=start))
 
@@ -70,24 +156,90 @@ class GoogleDrive(SyncBase):
             self.service.files().trash(fileId=path_ids[-1]).execute()
         else:
             self.service.files().delete(fileId=path_ids[-1]).execute()
+        self._forget(path)
 
     def download(self, local, remote):
-        url = self._get_file(remote)['downloadUrl']
-        resp, content = self.service._http.request(url)
-        if resp.status == 200:
-            with open(local, 'wb') as file:
-                file.write(content)
-        else:
-            raise IOError
+        file = self._get_file(remote)
+        if file is None:
+            raise IOError('not found: ' + remote)
+        size = int(file.get('fileSize', 0))
+
+        def read(offset):
+            # one range request per chunk
+            while offset < size:
+                end = min(offset + self.download_chunk_size, size) - 1
+                resp, content = self.service._http.request(
+                    file['downloadUrl'],
+                    headers={'Range': 'bytes=%s-%s' % (offset, end)})
+                if resp.status not in (200, 206) or \
+                        len(content) != end - offset + 1:
+                    raise IOError('download failed: %s' % resp.status)
+                offset += len(content)
+                yield content
+
+        # the etag also changes with the metadata, md5 is only missing for
+        # Google documents
+        version = file.get('md5Checksum') or file.get('etag')
+
+        def chunks(offset, resumed_version):
+            if offset > size or resumed_version != version:
+                offset = 0
+            return offset, size, version, read(offset)
+        self.stream_download(local, chunks)
 
     def upload(self, local, remote):
         self._put_file(local, remote)
 
+    def remote_move(self, remote, new_remote):
+        try:
+            ids = self._path_to_ids(remote)
+            if not ids:
+                raise IOError('not found: ' + remote)
+            parent_id, title = self._free_target(new_remote)
+            file = self.service.files().patch(
+                fileId=ids[-1], body={'title': title},
+                addParents=parent_id, removeParents=ids[-2]).execute()
+        except apiclient.errors.HttpError as e:
+            raise IOError(e)
+        self._forget(remote)
+        self.path_cache[self._cache_key(new_remote)] = file['id']
+        return file['id']
+
+    def remote_copy(self, remote, new_remote):
+        try:
+            ids = self._path_to_ids(remote)
+            if not ids:
+                raise IOError('not found: ' + remote)
+            parent_id, title = self._free_target(new_remote)
+            file = self.service.files().copy(
+                fileId=ids[-1],
+                body={'title': title, 'parents': [{'id': parent_id}]}
+            ).execute()
+        except apiclient.errors.HttpError as e:
+            raise IOError(e)
+        self.path_cache[self._cache_key(new_remote)] = file['id']
+        return file['id']
+
+    def _free_target(self, remote):
+        """ Trashes the file at `remote` if there is one, Drive would keep
+        both files with the same title.
+
+        Returns:
+            tuple: Id of the (created) parent folder and title of `remote`.
+        """
+        basedir, title = os.path.split(remote)
+        parent_id = self._path_to_ids(basedir, create_missing=True)[-1]
+        existing = self._path_to_ids(remote)
+        if existing:
+            self.service.files().trash(fileId=existing[-1]).execute()
+            self._forget(remote)
+        return parent_id, title
+
     # endregion
 
     # region authorization
     def authorize(self):
-        self.service = discovery.build(
+        self.service = apiclient.discovery.build(
             'drive', 'v2',
             http=self.credentials.authorize(httplib2.Http())
         )
@@ -109,7 +261,7 @@ class GoogleDrive(SyncBase):
         credentials = store.get()
         if not credentials or credentials.invalid:
             client_config = self.configuration['client_config']
-            flow = OAuth2WebServerFlow(
+            flow = oauth2client.client.OAuth2WebServerFlow(
                 client_config['client_id'],
                 client_config['client_secret'],
                 SCOPES,
@@ -128,7 +280,75 @@ class GoogleDrive(SyncBase):
     # endregion authorization
 
     # region file operations
-    def _put_file(self, source_absolute, target_absolute):
+    def _put_file(self, source_absolute, target_absolute, _retry=True,
+                  event=None):
+        basedir, file_name = os.path.split(target_absolute)
+        try:
+            file_ids = self._path_to_ids(target_absolute)
+            if file_ids:
+                file = self._send_file(
+                    source_absolute, file_id=file_ids[-1], event=event)
+            else:
+                folder_ids = self._path_to_ids(basedir, create_missing=True)
+                file = self._send_file(
+                    source_absolute, title=file_name,
+                    parent_id=folder_ids[-1], event=event)
+        except apiclient.errors.HttpError as e:
+            if e.resp.status != 404 or not _retry:
+                raise
+            # a cached id was removed by someone else
+            self._forget(basedir)
+            return self._put_file(
+                source_absolute, target_absolute, _retry=False, event=event)
+        self.path_cache[self._cache_key(target_absolute)] = file['id']
+        return file
+
+    def _put_folder(self, event):
+        """ Syncs a folder that was moved into place. The old folder is
+        moved at the target with its content, if it is not there the local
+        content is uploaded.
+        """
+        if event.moved_from is not None:
+            try:
+                remote_id = self.remote_move(
+                    event.moved_from.target_absolute, event.target_absolute)
+            except IOError as e:
+                log.info('%s: uploading the content of %s' % (
+                    e, event.source_absolute))
+            else:
+                self.synced_move(event, remote_id)
+                return
+        remote_id = self._path_to_ids(
+            event.target_absolute, create_missing=True)[-1]
+        uploaded = []
+        local = local_state(
+            event.source_absolute, watch_excludes(event.config))
+        for path in sorted(local):
+            target_absolute = os.path.join(event.target_absolute, path)
+            try:
+                if local[path][2]:
+                    self._path_to_ids(target_absolute, create_missing=True)
+                else:
+                    self._put_file(os.path.join(event.source_absolute, path),
+                                   target_absolute)
+            except IOError as e:
+                log.warning('upload failed' + str(e))
+                continue
+            uploaded.append(path)
+        if event.moved_from is not None:
+            self.rm(event.moved_from.target_absolute)
+        self.synced(event, remote_id=remote_id)
+        self.synced_content(event, uploaded)
+
+    def _send_file(self, source_absolute, file_id=None, title=None,
+                   parent_id=None, event=None):
+        """ Uploads the content of a file chunk by chunk.
+
+        Updates the file `file_id` if given, otherwise creates the file
+        `title` in the folder `parent_id`. The upload is aborted with
+        `TransferCancelled` if `event` is queued again in the meantime, the
+        remote file keeps its previous content then.
+        """
         mimetype = mimetypes.guess_type(source_absolute)[0]
         mimetype = mimetype or 'application/octet-stream'
         #media = MediaFileUpload(
@@ -136,26 +356,123 @@ class GoogleDrive(SyncBase):
             #mimetype=mimetype,
             #chunksize=1024 * 1024, resumable=True
         #)
-        media = MediaIoBaseUpload(
-            open(source_absolute, 'rb'), mimetype,
-            chunksize=1024 * 1024, resumable=True
-        )
-        file = self._get_file(target_absolute)
-        if file:
-            self.service.files().update(
-                fileId=file['id'], media_body=media).execute()
-        else:
-            basedir, file_name = os.path.split(target_absolute)
-            folder_ids = self._path_to_ids(basedir, create_missing=True)
-            self.service.files().insert(
-                body={
-                    'title': file_name,
-                    'parents': [{'id': folder_ids[-1]}]
-                },
-                media_body=media
-            ).execute()
-
-    def _create_folder(self, folder_name, parent_id=None):
+        with open(source_absolute, 'rb') as file:
+            media = apiclient.http.MediaIoBaseUpload(
+                file, mimetype, chunksize=1024 * 1024, resumable=True)
+            if file_id is not None:
+                request = self.service.files().update(
+                    fileId=file_id, media_body=media)
+            else:
+                request = self.service.files().insert(
+                    body={'title': title, 'parents': [{'id': parent_id}]},
+                    media_body=media)
+            response = None
+            while response is None:
+                if event is not None and self.cancelled(event):
+                    raise TransferCancelled(source_absolute)
+                status, response = request.next_chunk()
+                if status is not None:
+                    self.send_progress(source_absolute, status.progress())
+            return response
+
+    def _consume_batch(self, events, remote_ids):
+        """
+        Args:
+            events (list): Events without renamed folders.
+            remote_ids (list): Receives the remote id for every event as soon
+                as it is synced, `_FAILED` if it could not be synced. The
+                events that are still `_PENDING` when a batch request fails
+                were not synced.
+        """
+        removed_types = ['DELETE', 'MOVED_FROM']
+
+        # trash removed files, including the old location of renamed ones
+        trashed = {}  # path -> index of the event
+        for i, event in enumerate(events):
+            if event.moved_from is not None:
+                trashed[event.moved_from.target_absolute] = i
+            if event.type in removed_types:
+                trashed[event.target_absolute] = i
+        ids = self._lookup(trashed)
+        responses = self._batch({
+            path: self.service.files().trash(fileId=file_id)
+            for path, file_id in ids.items() if file_id is not None
+        })
+        for path, (response, exception) in responses.items():
+            if exception is not None:
+                log.warning('trashing %s failed: %s' % (path, exception))
+                remote_ids[trashed[path]] = _FAILED
+            else:
+                self._forget(path)
+        for i, event in enumerate(events):
+            if event.type in removed_types and remote_ids[i] is _PENDING:
+                remote_ids[i] = None
+
+        # create folders level by level, parents must exist first
+        folders = [i for i, event in enumerate(events)
+                   if event.isdir and event.type not in removed_types]
+        depth = lambda i: self._cache_key(events[i].target_absolute).count('/')
+        for level in sorted(set(map(depth, folders))):
+            created = {}  # path -> index of the event
+            requests = {}
+            paths = [events[i].target_absolute
+                     for i in folders if depth(i) == level]
+            ids = self._lookup(paths, create_parents=True)
+            for i in folders:
+                path = events[i].target_absolute
+                if depth(i) != level:
+                    continue
+                if ids[path] is not None:
+                    remote_ids[i] = ids[path]
+                    continue
+                basedir, folder_name = os.path.split(self._cache_key(path))
+                created[path] = i
+                requests[path] = self.service.files().insert(body={
+                    'title': folder_name,
+                    'mimeType': MIME_FOLDER,
+                    'parents': [{'id': self._path_to_ids(basedir)[-1]}],
+                })
+            for path, (response, exception) in self._batch(requests).items():
+                if exception is not None:
+                    log.warning('creating %s failed: %s' % (path, exception))
+                    remote_ids[created[path]] = _FAILED
+                    continue
+                self.path_cache[self._cache_key(path)] = response['id']
+                remote_ids[created[path]] = response['id']
+
+        # upload the content of files
+        files = [i for i, event in enumerate(events)
+                 if not event.isdir and event.type not in removed_types]
+        ids = self._lookup(
+            [events[i].target_absolute for i in files], create_parents=True)
+        for i in files:
+            event = events[i]
+            basedir, file_name = os.path.split(event.target_absolute)
+            try:
+                if ids[event.target_absolute] is not None:
+                    file = self._send_file(
+                        event.source_absolute,
+                        file_id=ids[event.target_absolute], event=event)
+                else:
+                    file = self._send_file(
+                        event.source_absolute, title=file_name,
+                        parent_id=self._path_to_ids(basedir)[-1],
+                        event=event)
+            except TransferCancelled:
+                log.info('%s changed during the upload, starting over' %
+                         event.source_absolute)
+                remote_ids[i] = _FAILED
+                continue
+            except IOError as e:
+                # file was deleted immediatily?
+                log.warning('upload failed' + str(e))
+                remote_ids[i] = _FAILED
+                continue
+            self.path_cache[self._cache_key(event.target_absolute)] = \
+                file['id']
+            remote_ids[i] = file['id']
+
+    def _create_folder(self, folder_name, parent_id=None, path=None):
         body = {
             'title': folder_name,
             'mimeType': MIME_FOLDER
@@ -165,6 +482,8 @@ class GoogleDrive(SyncBase):
         response = self.service.files().insert(
             body=body
         ).execute()
+        if path is not None:
+            self.path_cache[self._cache_key(path)] = response['id']
         return response['id']
 
     def _get_file(self, target_absolute):
@@ -184,6 +503,8 @@ class GoogleDrive(SyncBase):
         files = self._list_folder(_folder_id)
         for file in files:
             file['path'] = start
+            self.path_cache[self._cache_key(start + file['title'])] = \
+                file['id']
             yield file
             if file['mimeType'] == MIME_FOLDER:
                 yield from self._walk(
@@ -202,18 +523,25 @@ class GoogleDrive(SyncBase):
         id_list = ['root']
         #if folder_list == ['']:
             #return id_list
+        current_path = ''
         for folder in folder_list:
+            current_path += '/' + folder
+            cached_id = self.path_cache.get(current_path)
+            if cached_id is not None:
+                id_list.append(cached_id)
+                continue
             response = self.service.children().list(
                 folderId=id_list[-1],
                 q='title = "%s" and trashed = false' % (folder)
             ).execute()['items']
-            if len(response) is 1:
+            if len(response) == 1:
                 id_list.append(response[0]['id'])
-            elif len(response) is 0:
+                self.path_cache[current_path] = response[0]['id']
+            elif len(response) == 0:
                 if create_missing:
                     print('creating folder: ', folder)
                     id_list.append(self._create_folder(
-                        folder, parent_id=id_list[-1]))
+                        folder, parent_id=id_list[-1], path=current_path))
                 else:
                     return None  # folder not found
             else:
@@ -222,6 +550,76 @@ class GoogleDrive(SyncBase):
                 raise IOError  # TODO make custom exception
         return id_list
 
+    @staticmethod
+    def _cache_key(path):
+        # '/path/to/folder/' and 'path/to/folder' -> '/path/to/folder'
+        return '/' + '/'.join(filter(None, path.split(os.sep)))
+
+    def _forget(self, path):
+        """ Removes path and everything below it from the path cache.
+        """
+        key = self._cache_key(path)
+        self.path_cache.discard(key)
+        self.path_cache.discard_prefix(key.rstrip('/') + '/')
+
+    def _lookup(self, paths, create_parents=False):
+        """ Resolves the ids of several paths. Paths that are not cached are
+        looked up with one batch request.
+
+        Args:
+            paths (iterable): Remote paths.
+            create_parents (Optional[bool]): Create missing parent folders.
+        Returns:
+            dict: path -> id or None if the path does not exist.
+        """
+        ids = {}
+        requests = {}
+        for path in paths:
+            key = self._cache_key(path)
+            ids[path] = 'root' if key == '/' else self.path_cache.get(key)
+            if ids[path] is not None:
+                continue
+            basedir, name = os.path.split(key)
+            parent_ids = self._path_to_ids(
+                basedir, create_missing=create_parents)
+            if parent_ids:
+                requests[path] = self.service.children().list(
+                    folderId=parent_ids[-1],
+                    q='title = "%s" and trashed = false' % (name)
+                )
+        for path, (response, exception) in self._batch(requests).items():
+            if exception is not None:
+                raise exception
+            items = response['items']
+            if len(items) > 1:
+                raise IOError  # same name more than once, see _path_to_ids
+            if items:
+                ids[path] = items[0]['id']
+                self.path_cache[self._cache_key(path)] = items[0]['id']
+        return ids
+
+    def _batch(self, requests):
+        """ Sends requests as batch requests of at most `BATCH_LIMIT`
+        requests each.
+
+        Args:
+            requests (dict): key -> HttpRequest
+        Returns:
+            dict: key -> (response, exception) for every request.
+        """
+        keys = list(requests)
+        results = {}
+
+        def callback(request_id, response, exception):
+            results[keys[int(request_id)]] = (response, exception)
+
+        for start in range(0, len(keys), BATCH_LIMIT):
+            batch = self.service.new_batch_http_request(callback=callback)
+            for i in range(start, min(start + BATCH_LIMIT, len(keys))):
+                batch.add(requests[keys[i]], request_id=str(i))
+            batch.execute()
+        return results
+
     def _list_folder(self, folder_id='root'):
         results = self.service.files().list(
             maxResults=None,
@@ -238,9 +636,6 @@ if __name__ == '__main__':
         {'source': '/home/h4ct1c/omnisync/local/',
          'syncers': ['GoogleDrive'],
          'target': '/omniSync'},
-        mask=None,
-        file_name=os.path.basename(test_file_name),
-        base_path=os.path.dirname(test_file_name),
         source_absolute=test_file_name,
         isdir=False
     )
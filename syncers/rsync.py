@@ -7,42 +7,252 @@ sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
 
 import subprocess
 import re
+import time
+import shlex
+from collections import OrderedDict
+from collections import namedtuple
+from threading import Thread
 
 from sync_api import SyncBase
+from sync_api import TransferCancelled
+from sync_index import local_state
+from utils.exclude import watch_excludes
 import config
 from utils.log import log
 
 
+# progress line of --info=progress1/progress2, e.g.
+# '  1,234,567  45%   12.34MB/s    0:00:05 (xfr#3, to-chk=10/20)'
+PROGRESS_LINE = re.compile(
+    rb'\s*([\d,]+)\s+(\d+)%\s+([\d.]+)([kMGT]?)B/s\s+(\d+):(\d\d):(\d\d)'
+    rb'(?:\s+\(xfr#(\d+), (?:to|ir)-chk=(\d+)/(\d+)\))?')
+# report unchanged percentages at most that often (seconds)
+REPORT_INTERVAL = 0.5
+UNITS = {b'': 1, b'k': 1024, b'M': 1024 ** 2, b'G': 1024 ** 3, b'T': 1024 ** 4}
+
+RsyncProgress = namedtuple('RsyncProgress', [
+    'bytes',        # transferred bytes
+    'percent',
+    'speed',        # bytes per second
+    'eta',          # seconds
+    'files_done',   # None if unknown
+    'files_total',  # grows while rsync scans incrementally (ir-chk)
+])
+
+
+def parse_progress(line):
+    """
+    Args:
+        line (bytes): A line of rsync output.
+    Returns:
+        RsyncProgress or None if it is no progress line.
+    """
+    if b'%' not in line:
+        return None
+    match = PROGRESS_LINE.match(line)
+    if match is None:
+        return None
+    (transferred, percent, speed, unit, hours, minutes, seconds,
+     _, to_check, total) = match.groups()
+    return RsyncProgress(
+        bytes=int(transferred.replace(b',', b'')),
+        percent=int(percent),
+        speed=float(speed) * UNITS[unit],
+        eta=int(hours) * 3600 + int(minutes) * 60 + int(seconds),
+        files_done=total and int(total) - int(to_check),
+        files_total=total and int(total),
+    )
+
+
+class OutputParser():
+    """ Splits rsync output into lines, incrementally.
+
+    Progress lines end with '\\r', all others with '\\n'.
+    """
+
+    def __init__(self):
+        self._rest = b''
+
+    def feed(self, data):
+        """
+        Args:
+            data (bytes): The next chunk of output.
+        Returns:
+            list: The completed, non empty lines.
+        """
+        lines = re.split(rb'[\r\n]', self._rest + data)
+        self._rest = lines.pop()
+        return [line for line in lines if line]
+
+    def close(self):
+        """ Returns the unterminated rest of the output as last lines. """
+        rest, self._rest = self._rest, b''
+        return [rest] if rest else []
+
+
+def exclude_rule(path, source):
+    """ Returns an rsync exclude rule for exactly one path relative to the
+    source, wildcards in it are escaped.
+
+    Rules are anchored at the transfer root, which is the source itself
+    only with a trailing slash. Otherwise rsync transfers the folder and
+    names start with its name.
+    """
+    if not source.endswith('/'):
+        # also the path of `[user@]host:path` and `rsync://host/module`
+        name = re.split(r'[/:]', source)[-1]
+        path = name + '/' + path if name else path
+    if re.search(r'[*?\[]', path):
+        path = re.sub(r'([*?\[\\])', r'\\\1', path)
+    return '/' + path
+
+
+def parse_target(target):
+    """ Tells how rsync reaches a target, following rsync's own rules.
+
+    Returns:
+        tuple: (kind, host), kind is 'local', 'ssh' (`[user@]host:path`) or
+            'daemon' (`host::module/path` or `rsync://host/module/path`).
+    """
+    if target.startswith('rsync://'):
+        return 'daemon', target[len('rsync://'):].split('/')[0]
+    match = re.match(r'([^/:]+)(::?)', target)
+    if match is None:
+        return 'local', None
+    return 'ssh' if match.group(2) == ':' else 'daemon', match.group(1)
+
+
 class Rsync(SyncBase):
-    def __init__(self, progress_callback=None):
-        builtins.super(self.__class__, self).__init__(progress_callback)
+    # events are cheap to batch, one rsync call syncs all of them
+    batch_size = 1000
+
+    def __init__(self, *args, **kwargs):
+        builtins.super(self.__class__, self).__init__(*args, **kwargs)
+        self.configuration = config.data['configuration'][self.name]
+
+    def transport_arguments(self, target):
+        """ Returns the rsync arguments to reach `target`.
+
+        All calls for an ssh target share one multiplexed connection
+        (ControlMaster) that stays open `ssh_persist` seconds after its last
+        use, so only the first call pays for the ssh handshake. Daemon
+        targets and local paths need no setup.
+        """
+        kind, host = parse_target(target)
+        if kind == 'ssh':
+            control_path = os.path.join(
+                config.state_file('ssh'), 'rsync-%C')
+            if not os.path.exists(os.path.dirname(control_path)):
+                os.makedirs(os.path.dirname(control_path), mode=0o700)
+            ssh = ['ssh', '-o', 'ControlMaster=auto',
+                   '-o', 'ControlPath=' + control_path,
+                   '-o', 'ControlPersist=%s' %
+                   self.configuration.get('ssh_persist', 600)] + \
+                self.configuration.get('ssh_arguments', [])
+            return ['-e', ' '.join(shlex.quote(x) for x in ssh)]
+        if kind == 'daemon' and 'password_file' in self.configuration:
+            return ['--password-file=' + os.path.expanduser(
+                self.configuration['password_file'])]
+        return []
 
     @staticmethod
-    def event_hash_function(event):
-        # use base_path as hash in order to prevent overflowing the queue
-        if event.isdir:
-            return event.source_absolute
-        return event.base_path
-
-    def push_dir(self, event):
-        self.progress_callback(self, event.source_absolute, 0.0)
-        cmd = ['rsync', '--no-r'] + \
-            config.data['configuration'][self.name]['arguments'] + \
-            [event.base_path, event.target_base_dir_absolute]
-        log.info(cmd)
+    def event_key(event):
+        """ One queued event per folder: further events for the content of
+        a folder are merged into a RESCAN_DIR event, which keeps the queue
+        short during bursts. Renames are not merged, the old path can be in
+        another folder.
+        """
+        if event.moved_from is not None:
+            return event
+        folder = event.source_absolute if event.isdir else event.base_path
+        return folder, event.target_base_dir
+
+    def push_paths(self, source, target, events, contents=None):
+        """ Syncs the paths of several events of a watch.
+
+        Args:
+            contents (Optional[dict]): Receives the paths (relative to the
+                folder) that are transferred with each created or moved
+                folder, by event.
+        Returns:
+            bool: True if rsync succeeded.
+        """
+        files = OrderedDict()  # path relative to source -> events
+        folders = []
+        for event in events:
+            if event.moved_from is not None:
+                # renames are folded into the MOVED_TO event
+                files.setdefault(
+                    event.moved_from.source_relative, []).append(event)
+            files.setdefault(event.source_relative, []).append(event)
+            if event.isdir and event.type in ['CREATE', 'MOVED_TO']:
+                folders.append(event)
+        for event in folders:
+            # the folder might have content already, its progress is
+            # reported for the folder
+            folder_events = files[event.source_relative]
+            local = local_state(
+                event.source_absolute, watch_excludes(event.config))
+            for path, (size, mtime, isdir) in local.items():
+                files.setdefault(os.path.join(
+                    event.source_relative, path), folder_events)
+                if not isdir:
+                    # see `update_index`
+                    self._sent[os.path.join(event.source_absolute, path)] = \
+                        (size, mtime)
+            if contents is not None:
+                contents[event] = list(local)
+        return self.rsync_files(source, target, list(files), files)
+
+    def rsync_files(self, source, target, paths, files, arguments=()):
+        """ Runs one rsync for a list of paths. Paths that do not exist
+        anymore are deleted at the target.
+
+        Args:
+            paths (list): Paths relative to `source`.
+            files (dict): Path -> events, for progress reporting.
+            arguments (Optional[list]): Additional rsync arguments.
+        """
+        cmd = ['rsync'] + self.configuration['arguments'] + \
+            self.transport_arguments(target) + list(arguments) + [
+                '--files-from=-', '--from0', '--delete-missing-args',
+                '--force', '--info=name1,progress1',
+                source.rstrip('/') + '/', target.rstrip('/') + '/',
+            ]
+        log.info('%s (%s paths)' % (cmd, len(paths)))
         process = subprocess.Popen(
             cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
         )
-        self.parse_output(process, event.source_absolute)
+
+        def write_paths():
+            # in a thread, rsync writes output while it reads the list
+            try:
+                with process.stdin:
+                    process.stdin.write(
+                        b'\0'.join(os.fsencode(path) for path in paths))
+            except BrokenPipeError:
+                pass  # rsync was aborted
+        writer = Thread(target=write_paths)
+        writer.start()
+        try:
+            self.parse_output(process, source, files)
+        finally:
+            writer.join()
+            process.wait()
+        # 24: some files vanished before they were transferred
+        if process.wait() not in [0, 24]:
+            log.error('%s failed with %s' % (cmd, process.returncode))
+            return False
+        return True
 
     def push_file(self, event):
         # currently not used
         if not event.isdir:
             print('dir skipped (TODO)')
             return
-        self.progress_callback(self, event.source_absolute, 0.0)
+        self.send_progress(event.source_absolute, 0.0)
         cmd = ['rsync', '--relative'] + \
-            config.data['configuration'][self.name]['arguments'] + \
+            self.configuration['arguments'] + \
             [event.source_relative, event.target_base_dir]
         #log.info(cmd)
         process = subprocess.Popen(
@@ -51,43 +261,103 @@ class Rsync(SyncBase):
         )
         self.parse_output(process, event.source_absolute)
 
-    def parse_output(self, process, name):
-        # parse rsync output
-        line = ''
-        progress = None
-        while process.poll() is None:
-            byte = process.stdout.read(1)
-            line += byte.decode('utf-8')
-            if byte == b'\r' or byte == b'\n':
-                #speed = next(iter(re.findall(r'\S*/s', line)), None)
-                #files = next(iter(re.findall(r'(\d)/(\d+)', line)), None)
-                new_progress = next(iter(re.findall(r'(\d+)%', line)), None)
-                if new_progress and new_progress != progress:
-                    progress = new_progress
-                    self.progress_callback(
-                        self, name, float(progress) / 100)
-                line = ''
-        if progress != '100':
-            self.progress_callback(self, name, 1.0)
-
-    def delete(self, event):
-
-        self.progress_callback(self, event.source_absolute, 0.0)
-        cmd = [
-            'rm', os.path.join(event.target_base_dir, event.source_relative)
-        ]
-        if event.isdir:
-            cmd = ['rm', '-rf'] + cmd[1:]
-        log.info(cmd)
-        subprocess.check_call(cmd)
-        self.progress_callback(self, event.source_absolute, 1.0)
+    def parse_output(self, process, name, files=None):
+        """
+        Args:
+            name (str): Progress is reported for this name.
+            files (Optional[dict]): Path relative to the source -> events.
+                If given, the progress of each file is reported for the
+                source path of its events instead, and rsync is aborted
+                with `TransferCancelled` if all events are queued again.
+        """
+        parser = OutputParser()
+        last = None  # last reported progress
+        reported = 0  # time of the last report
+        current = []  # events of the file that is transferred
 
-    def consume_item(self, event):
-        if event.type in ['DELETE', 'MOVED_FROM']:
-            self.delete(event)
+        def handle(line):
+            nonlocal last, reported, current
+            progress = parse_progress(line)
+            if progress is None:
+                if not files:
+                    return
+                path = line.decode('utf-8', 'replace').strip()
+                if path.startswith('deleting '):
+                    path = path[len('deleting '):]
+                if path.rstrip('/') in files:
+                    self._send_events_progress(current, 1.0)
+                    current = files[path.rstrip('/')]
+                    last = None
+                return
+            now = time.monotonic()
+            if last is not None and progress.percent == last.percent and \
+                    now - reported < REPORT_INTERVAL:
+                return
+            last, reported = progress, now
+            if files is None:
+                self.send_progress(name, progress.percent / 100, progress)
+            else:
+                self._send_events_progress(
+                    current, progress.percent / 100, progress)
+
+        cancelled = False
+        checked = time.monotonic()
+        # read whatever is available, until rsync closes its output
+        for data in iter(lambda: process.stdout.read1(65536), b''):
+            for line in parser.feed(data):
+                handle(line)
+            if files and not cancelled and \
+                    time.monotonic() - checked >= REPORT_INTERVAL:
+                checked = time.monotonic()
+                if all(self.cancelled(event)
+                       for events in files.values() for event in events):
+                    log.info('%s paths changed again, aborting rsync' %
+                             len(files))
+                    process.terminate()
+                    cancelled = True
+        for line in parser.close():
+            handle(line)
+        if files is not None:
+            # the content of new folders shares the events of the folder
+            for events in {id(e): e for e in files.values()}.values():
+                self._send_events_progress(events, 1.0)
         else:
-            #self.push_file(event)
-            self.push_dir(event)
+            self.send_progress(name, 1.0)
+        if cancelled:
+            raise TransferCancelled(name)
+
+    def _send_events_progress(self, events, progress, stats=None):
+        for event in events:
+            self.send_progress(event.source_absolute, progress, stats)
+
+    def consume_item(self, event):
+        self.consume_batch([event])
+
+    def consume_batch(self, events):
+        """ Syncs the events of each watch with a single rsync call.
+
+        The paths are passed with `--files-from`, paths that were removed
+        are deleted at the target by `--delete-missing-args`.
+        """
+        watches = OrderedDict()  # (source, target) -> events
+        for event in events:
+            watches.setdefault(
+                (event.source_base_dir, event.target_base_dir), []
+            ).append(event)
+        for (source, target), watch_events in watches.items():
+            for event in watch_events:
+                self.send_progress(event.source_absolute, 0.0)
+            contents = {}
+            try:
+                success = self.push_paths(
+                    source, target, watch_events, contents)
+            except TransferCancelled:
+                continue  # the queued events sync the latest content
+            if success:
+                for event in watch_events:
+                    self.synced(event)
+                    if event in contents:
+                        self.synced_content(event, contents[event])
 
     def fullsync(self, pull=False):
         """
@@ -97,25 +367,26 @@ class Rsync(SyncBase):
             lambda x: self.name in x['syncers'] and not x.get('disabled'),
             config.data['watches']
         ):
-            self.progress_callback(self, watch_config['source'], 0.0)
-            excludes = ' '.join(
-                ['--exclude=' + x for x in watch_config.get('exclude', [])])
-            cmd = ' '.join([
-                'rsync', '--info=progress2', excludes,
-                config.data['configuration'][self.name]['arguments']
-            ]) + ' '
+            self.send_progress(watch_config['source'], 0.0)
+            # rsync patterns can not express the exclude rules, the paths
+            # they exclude locally are passed instead
+            excluded = []
+            local_state(watch_config['source'],
+                        watch_excludes(watch_config), pruned=excluded)
+            cmd = ['rsync', '--info=progress2', '--exclude-from=-'] + \
+                self.configuration['arguments'] + \
+                self.transport_arguments(watch_config['target'])
             if pull:
-                cmd += ' '.join([
-                    watch_config['target'], watch_config['source']
-                ])
+                cmd += [watch_config['target'], watch_config['source']]
             else:
-                cmd += ' '.join([
-                    watch_config['source'], watch_config['target']
-                ])
-            log.info(cmd)
+                cmd += [watch_config['source'], watch_config['target']]
+            log.info('%s (%s excluded paths)' % (cmd, len(excluded)))
             process = subprocess.Popen(
-                cmd, shell=True,
-                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
             )
+            with process.stdin:
+                process.stdin.write(b''.join(
+                    os.fsencode(exclude_rule(path, cmd[-2])) + b'\n'
+                    for path in excluded))
             self.parse_output(process, 'fullsync')
-            self.progress_callback(self, watch_config['source'], 1.0)
+            self.send_progress(watch_config['source'], 1.0)
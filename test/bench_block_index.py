@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+""" Compares hashing a large modified file completely with updating its
+block checksums, see `utils.blocks`.
+
+Usage: python3 test/bench_block_index.py [file size in MB] [modified MB]
+"""
+import sys
+import os
+import time
+import shutil
+import tempfile
+sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
+
+from utils.blocks import BlockIndex
+from utils.blocks import BLOCK_SIZE
+from utils.files import file_hash
+
+
+def modify(path, offsets):
+    """ Overwrites a block at every offset in place, like a VM image. """
+    with open(path, 'r+b') as f:
+        for offset in offsets:
+            f.seek(offset)
+            f.write(os.urandom(BLOCK_SIZE))
+
+
+def measure(update):
+    start = time.perf_counter()
+    read, hashed = update()
+    return time.perf_counter() - start, read, hashed
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    modified = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_dir, 'image')
+        with open(path, 'wb') as f:
+            for _ in range(size):
+                f.write(os.urandom(1024 * 1024))
+        index = BlockIndex(os.path.join(temp_dir, 'blocks.db'))
+        index.update(path)
+        step = size * 1024 * 1024 // modified
+        modify(path, range(step // 2, size * 1024 * 1024 - BLOCK_SIZE, step))
+        print('%s MB file, %s MB modified' % (size, modified))
+
+        def whole():
+            file_hash(path)
+            return (os.path.getsize(path),) * 2
+
+        def blocks():
+            update = index.update(path)
+            print('changed ranges: %s' % len(update.changed))
+            return update.read, update.hashed
+
+        def unchanged():
+            update = index.update(path)
+            return update.read, update.hashed
+        for name, update in [('whole file', whole),
+                             ('blocks', blocks),
+                             ('unchanged', unchanged)]:
+            seconds, read, hashed = measure(update)
+            print('%-11s %7.3fs  %8.1f MB read  %8.1f MB hashed' % (
+                name, seconds, read / 1e6, hashed / 1e6))
+        index.close()
+    finally:
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+""" Compares the match throughput of the compiled exclude rules with
+`pyinotify.ExcludeFilter`, which tries one regular expression after the
+other.
+
+Usage: python3 test/bench_exclude.py [number of patterns] [number of paths]
+"""
+import sys
+import os
+import re
+import time
+import random
+sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
+
+import pyinotify
+
+from utils.exclude import Rules
+from utils.exclude import translate
+
+SOURCE = '/home/user/sync'
+
+
+def patterns(count):
+    """ A mix of the usual .gitignore patterns. """
+    result = []
+    for i in range(count):
+        kind = i % 5
+        if kind == 0:
+            result.append('*.ext%s' % i)
+        elif kind == 1:
+            result.append('build%s/' % i)
+        elif kind == 2:
+            result.append('/top%s' % i)
+        elif kind == 3:
+            result.append('doc%s/**/*.tmp' % i)
+        else:
+            result.append('cache%s' % i)
+    return result
+
+
+def paths(count, patterns):
+    random.seed(0)
+    words = ['src', 'lib', 'test', 'doc3', 'data', 'cache4', 'build1']
+    result = []
+    for i in range(count):
+        depth = random.randint(1, 6)
+        folders = [random.choice(words) for _ in range(depth)]
+        name = 'file%s.%s' % (i, random.choice(['py', 'txt', 'ext0', 'c']))
+        result.append('/'.join(folders + [name]))
+    return result
+
+
+def measure(match, paths):
+    start = time.perf_counter()
+    excluded = sum(1 for path in paths if match(path))
+    return time.perf_counter() - start, excluded
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    number = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    rules = patterns(count)
+    relative = paths(number, rules)
+    absolute = [SOURCE + '/' + path for path in relative]
+    # the same rules as regular expressions of absolute paths, anchored at
+    # the source like the compiled rules
+    regexes = [re.escape(SOURCE + '/') + translate(rule)[0] + '$'
+               for rule in rules]
+    exclude_filter = pyinotify.ExcludeFilter(regexes)
+    compiled = Rules([('', rule) for rule in rules])
+    print('%s patterns, %s paths' % (count, number))
+    for name, match, inputs in [
+            ('ExcludeFilter', exclude_filter, absolute),
+            ('compiled', lambda path: compiled.excluded(path, False),
+             relative)]:
+        seconds, excluded = measure(match, inputs)
+        print('%-14s %7.3fs  %9.0f paths/s  %s excluded' % (
+            name, seconds, number / seconds, excluded))
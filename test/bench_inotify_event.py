@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+""" Compares the construction rate and memory of `InotifyEvent` with the
+previous dict based class that computed all paths eagerly.
+
+Usage: python3 test/bench_inotify_event.py [number of events]
+"""
+import sys
+import os
+import time
+import tracemalloc
+sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
+
+import pyinotify
+
+from file_watcher import InotifyEvent
+from file_watcher import mask_type
+
+WATCH = {'source': '/home/user/omnisync', 'target': '/backup/omnisync',
+         'syncers': ['Rsync']}
+
+
+class LegacyInotifyEvent():
+    def __init__(self, event, watch_config, **kwargs):
+        self._mask = getattr(event, 'mask', None)
+        self.file_name = getattr(event, 'name', None)
+        self.base_path = getattr(event, 'path', None)
+        self.source_absolute = getattr(event, 'pathname', None)
+        self.isdir = getattr(event, 'dir', None)
+        self.type = self.get_type()
+        self.moved_from = None
+        self.moved_from_path = getattr(event, 'src_pathname', None)
+        self.__dict__.update(kwargs)
+        self.target_base_dir = watch_config['target']
+        self.source_base_dir = watch_config['source']
+        self.syncers = watch_config['syncers']
+        self.config = watch_config
+        self.source_relative = os.path.join(
+            os.path.relpath(self.source_absolute, self.source_base_dir))
+        self.source_base_dir_relative = os.path.join(
+            os.path.relpath(self.base_path, self.source_base_dir))
+        self.target_absolute = os.path.join(
+            self.target_base_dir, self.source_relative)
+        self.target_base_dir_absolute = os.path.normpath(os.path.join(
+            self.target_base_dir, self.source_base_dir_relative))
+
+    def get_type(self):
+        mask = self._mask
+        if self.isdir and mask:
+            mask -= pyinotify.IN_ISDIR
+        return pyinotify.EventsCodes.ALL_VALUES.get(mask, 'IN_UNDEFINED')[3:]
+
+
+def legacy_process_event(event):
+    # constructed twice, once for the type check
+    if LegacyInotifyEvent(event, WATCH).type:
+        return LegacyInotifyEvent(event, WATCH)
+
+
+def process_event(event):
+    type = mask_type(event.mask, event.dir)
+    if type:
+        return InotifyEvent(event, WATCH, type=type)
+
+
+def raw_events(count):
+    """ pyinotify events as delivered by the notifier. """
+    events = []
+    for i in range(count):
+        path = '%s/project%s/src/module%s' % (WATCH['source'], i % 50, i % 7)
+        events.append(pyinotify.Event({
+            'wd': 1, 'mask': pyinotify.IN_MODIFY, 'cookie': 0,
+            'name': 'file%s.py' % i, 'path': path,
+            'pathname': '%s/file%s.py' % (path, i), 'dir': False}))
+    return events
+
+
+def measure(process, events):
+    start = time.process_time()
+    for event in events:
+        process(event)
+    seconds = time.process_time() - start
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    # keep the events alive like a full queue
+    queued = [process(event) for event in events]
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del queued
+    return seconds, size
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    events = raw_events(count)
+    for name, process in [('dict, eager', legacy_process_event),
+                          ('slots, lazy', process_event)]:
+        seconds, size = measure(process, events)
+        print('%-12s %9.0f events/s  %5.0f bytes/event' % (
+            name, count / seconds, size / count))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+""" Counts the stat() calls of the `PollingWatcher` on a tree where only
+one folder changes, compared with polling the whole tree.
+
+Usage: python3 test/bench_polling.py [folders] [files per folder] [seconds]
+"""
+import sys
+import os
+import time
+import queue
+import shutil
+import tempfile
+sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
+
+from file_watcher import PollingWatcher
+
+MIN_INTERVAL = 0.05
+MAX_INTERVAL = 1.6
+
+
+if __name__ == '__main__':
+    folders = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    files = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for i in range(folders):
+            folder = os.path.join(temp_dir, 'd%s' % (i % 100), 'd%s' % i)
+            os.makedirs(folder)
+            for j in range(files):
+                open(os.path.join(folder, 'f%s' % j), 'w').close()
+        entries = folders * (files + 1) + min(folders, 100)
+        events = queue.Queue()
+        watcher = PollingWatcher(events, {
+            'source': temp_dir, 'syncers': [],
+            'poll_min_interval': MIN_INTERVAL,
+            'poll_max_interval': MAX_INTERVAL})
+        watcher.registered.wait()
+        # let the intervals of the idle folders grow
+        time.sleep(MAX_INTERVAL * 4)
+        active = os.path.join(temp_dir, 'd0', 'd0', 'f0')
+        calls = watcher.calls['stat']
+        cpu = time.process_time()
+        start = time.monotonic()
+        changes = 0
+        while time.monotonic() - start < seconds:
+            with open(active, 'w') as f:
+                f.write('x' * changes)
+            changes += 1
+            time.sleep(0.1)
+        calls = watcher.calls['stat'] - calls
+        cpu = time.process_time() - cpu
+        watcher.stop()
+        print('%s entries, %s changes in %ss' % (entries, changes, seconds))
+        print('polling the whole tree every %ss: %9.0f stat/s' % (
+            MIN_INTERVAL, entries / MIN_INTERVAL))
+        print('adaptive polling:                 %9.0f stat/s  '
+              '%0.0f%% cpu  %s events' % (
+                  calls / seconds, 100 * cpu / seconds, events.qsize()))
+    finally:
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+""" Compares the CPU time of the rsync output parser with the previous one
+that read stdout one byte at a time.
+
+Usage: python3 test/bench_rsync_parser.py [number of progress lines]
+"""
+import sys
+import os
+import io
+import re
+import time
+sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
+
+from syncers.rsync import Rsync
+
+
+class FakeProcess():
+    """ Replays recorded output like a finished `subprocess.Popen`. """
+
+    def __init__(self, output):
+        self.stdout = io.BufferedReader(io.BytesIO(output))
+
+    def poll(self):
+        return None if self.stdout.peek(1) else 0
+
+
+class Recorder():
+    """ Takes the place of the syncer, counts the progress reports. """
+    parse_output = Rsync.parse_output
+    _send_events_progress = Rsync._send_events_progress
+
+    def __init__(self):
+        self.reports = 0
+
+    def send_progress(self, event, progress, stats=None):
+        self.reports += 1
+
+
+def legacy_parse_output(self, process, name):
+    line = ''
+    progress = None
+    while process.poll() is None:
+        byte = process.stdout.read(1)
+        line += byte.decode('utf-8')
+        if byte == b'\r' or byte == b'\n':
+            new_progress = next(iter(re.findall(r'(\d+)%', line)), None)
+            if new_progress and new_progress != progress:
+                progress = new_progress
+                self.send_progress(name, float(progress) / 100)
+            line = ''
+    if progress != '100':
+        self.send_progress(name, 1.0)
+
+
+def progress2_output(lines):
+    """ Output of `rsync --info=progress2` for a fullsync. """
+    output = [b'sending incremental file list\n']
+    for i in range(lines):
+        output.append((
+            '    {:,}  {}%   12.34MB/s    0:00:{:02d} (xfr#{}, ir-chk={}/{})\r'
+        ).format(i * 4096, i * 100 // lines, i % 60, i // 10, lines - i,
+                 lines).encode())
+    output.append(b'\nsent 1,234 bytes  received 56 bytes\n')
+    return b''.join(output)
+
+
+def measure(parse, output):
+    recorder = Recorder()
+    start = time.process_time()
+    parse(recorder, FakeProcess(output), 'fullsync')
+    return time.process_time() - start, recorder.reports
+
+
+if __name__ == '__main__':
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    output = progress2_output(lines)
+    print('%s progress lines, %0.1f MB output' % (lines, len(output) / 1e6))
+    for name, parse in [('byte by byte', legacy_parse_output),
+                        ('buffered', Rsync.parse_output)]:
+        seconds, reports = measure(parse, output)
+        print('%-14s %6.3fs cpu  %8.0f lines/s  %s reports' % (
+            name, seconds, lines / seconds, reports))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+""" Compares the parallel scandir scanner with the previous `os.walk` based
+walk on a generated tree.
+
+Usage: python3 test/bench_scanner.py [number of entries] [folder]
+
+The tree is generated in `folder` (a temp folder by default) and reused if
+it exists, generating 1M entries takes a while.
+"""
+import sys
+import os
+import re
+import time
+import shutil
+import tempfile
+sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
+
+from scanner import DEFAULT_WORKERS
+from scanner import scan
+from utils.files import PART_PATTERN
+
+FILES_PER_FOLDER = 50
+FOLDERS_PER_FOLDER = 8
+
+
+def generate(root, entries):
+    """ Creates a tree of empty files and folders with `entries` entries.
+    """
+    folders = [root]
+    created = 0
+    while created < entries:
+        folder = folders.pop(0)
+        for i in range(FOLDERS_PER_FOLDER):
+            path = os.path.join(folder, 'd%s' % i)
+            os.mkdir(path)
+            folders.append(path)
+        for i in range(FILES_PER_FOLDER):
+            open(os.path.join(folder, 'f%s' % i), 'w').close()
+        created += FOLDERS_PER_FOLDER + FILES_PER_FOLDER
+
+
+def legacy_local_state(source, exclude=None):
+    excluded = re.compile('|'.join((exclude or []) + [PART_PATTERN])).match
+    state = {}
+    for root, dirs, files in os.walk(source):
+        dirs[:] = [d for d in dirs if not excluded(os.path.join(root, d))]
+        for names, isdir in ((dirs, True), (files, False)):
+            for name in names:
+                path = os.path.join(root, name)
+                if excluded(path):
+                    continue
+                try:
+                    stat = os.lstat(path)
+                except OSError:
+                    continue
+                state[os.path.relpath(path, source)] = (
+                    stat.st_size, stat.st_mtime_ns, isdir)
+    return state
+
+
+if __name__ == '__main__':
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    root = sys.argv[2] if len(sys.argv) > 2 else None
+    temp_dir = None
+    if root is None:
+        root = temp_dir = tempfile.mkdtemp()
+    try:
+        if not os.listdir(root):
+            start = time.perf_counter()
+            generate(root, entries)
+            print('generated in %0.1fs' % (time.perf_counter() - start))
+        exclude = ['.*/d7/d7$']
+        for name, walk in [
+                ('os.walk', lambda: legacy_local_state(root, exclude)),
+                ('scandir x1', lambda: scan(root, exclude, workers=1)),
+                ('scandir x%s' % DEFAULT_WORKERS,
+                 lambda: scan(root, exclude))]:
+            start = time.perf_counter()
+            state = walk()
+            seconds = time.perf_counter() - start
+            print('%-11s %7.2fs  %9.0f entries/s  %s entries' % (
+                name, seconds, len(state) / seconds, len(state)))
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
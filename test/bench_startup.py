@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+""" Measures the startup of the sync manager: the time to import `sync_api`
+and create the enabled syncers, and the peak RSS afterwards.
+
+Usage: python3 test/bench_startup.py [runs]
+
+Every run is a fresh interpreter with a generated config, once with only
+Rsync enabled and once with all syncers.
+"""
+import sys
+import os
+import json
+import shutil
+import tempfile
+import subprocess
+
+ROOT = os.path.abspath(sys.path[0] + os.sep + '..')
+
+CHILD = '''
+import sys, time, resource
+start = time.perf_counter()
+sys.path.append(%r)
+import config
+from sync_api import SyncManager
+enabled = %r
+syncers = SyncManager.get_syncer_instances(
+    filter=lambda syncer: syncer in enabled)
+assert sorted(syncers) == sorted(enabled)
+print(time.perf_counter() - start,
+      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+      len(sys.modules))
+'''
+
+
+def write_config(folder, enabled):
+    with open(os.path.join(folder, 'config.yaml'), 'w') as f:
+        json.dump({  # json is valid yaml
+            'state_dir': folder,
+            'configuration': {
+                'Rsync': {'arguments': ['-a']},
+                'Dropbox': {'token_file': os.path.join(folder, 'dropbox')},
+                'GoogleDrive': {'token_file': os.path.join(folder, 'drive')},
+            },
+            'watches': [{'source': folder, 'target': folder + '.target',
+                         'syncers': enabled}],
+        }, f)
+
+
+def run(folder, enabled):
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHILD % (ROOT, enabled)], cwd=folder,
+        stderr=subprocess.DEVNULL)
+    seconds, rss, modules = output.splitlines()[-1].split()
+    return float(seconds), int(rss), int(modules)
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    folder = tempfile.mkdtemp()
+    try:
+        for enabled in [['Rsync'], ['Rsync', 'Dropbox', 'GoogleDrive']]:
+            write_config(folder, enabled)
+            run(folder, enabled)  # warm up the file system cache
+            results = [run(folder, enabled) for _ in range(runs)]
+            seconds = sorted(r[0] for r in results)[runs // 2]
+            rss = sorted(r[1] for r in results)[runs // 2]
+            print('%-26s %7.1fms  %7.1fMiB  %4s modules' % (
+                ', '.join(enabled), seconds * 1000, rss / 1024,
+                results[0][2]))
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,49 @@
+import sys
+import os
+import tempfile
+import shutil
+
+import pytest
+
+sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
+from utils.blocks import BlockIndex
+
+
+@pytest.fixture()
+def temp_dir(request):
+    temp_dir = tempfile.mkdtemp()
+    # make sure temp files are cleaned.
+    request.addfinalizer(lambda: shutil.rmtree(temp_dir))
+    return temp_dir
+
+
+@pytest.fixture()
+def blocks(request, temp_dir):
+    blocks = BlockIndex(os.path.join(temp_dir, 'blocks.db'), block_size=4)
+    request.addfinalizer(blocks.close)
+    return blocks
+
+
+def write(path, content, mtime):
+    with open(path, 'wb') as f:
+        f.write(content)
+    os.utime(path, ns=(mtime, mtime))
+
+
+class TestBlockIndex():
+    def test_update(self, blocks, temp_dir):
+        path = os.path.join(temp_dir, 'a')
+        write(path, b'aaaabbbbccccdd', 1)
+        first = blocks.update(path)
+        assert first.changed == [(0, 14)]
+        assert (first.read, first.hashed) == (14, 14)
+        # not read again
+        assert blocks.update(path) == (first.hash, [], 0, 0)
+        write(path, b'aaaaXbbbXcccdd', 2)
+        update = blocks.update(path)
+        assert update.changed == [(4, 8)]
+        assert (update.read, update.hashed) == (14, 8)
+        write(path, b'aaaabbbbccccdd', 3)
+        assert blocks.update(path).hash == first.hash
+        write(path, b'aaaab', 4)
+        assert blocks.update(path).changed == [(4, 1), (5, 9)]
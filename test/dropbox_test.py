@@ -0,0 +1,411 @@
+import sys
+import os
+import io
+import json
+import tempfile
+import shutil
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
+from utils.files import write_random_file
+from utils.files import PART_SUFFIX
+import config
+from sync_index import SyncIndex
+from file_watcher import InotifyEvent
+from syncers import dropbox_sync
+from syncers.dropbox_sync import Dropbox
+
+
+class ErrorResponse(Exception):
+    def __init__(self, status, reason='', body=None):
+        super().__init__(status, reason)
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+class RESTSocketError(Exception):
+    pass
+
+
+# the parts of the (v1) Dropbox SDK the syncer uses
+FAKE_SDK = SimpleNamespace(rest=SimpleNamespace(
+    ErrorResponse=ErrorResponse, RESTSocketError=RESTSocketError))
+
+
+class FakeResponse(io.BytesIO):
+    def __init__(self, content, metadata):
+        super().__init__(content)
+        self.metadata = metadata
+
+    def getheader(self, name):
+        assert name == 'x-dropbox-metadata'
+        return json.dumps(self.metadata)
+
+
+class FakeDropboxClient():
+    """ Answers the calls of the syncer from memory.
+
+    Every call is recorded in `calls` as (method, args). `failures` maps a
+    method to exceptions that the next calls raise, one per call.
+    `deltas` maps a cursor to the response of `delta`.
+    """
+
+    def __init__(self):
+        self.files = {}  # lower case path -> (path, content, rev)
+        self.folders = set()
+        self.uploads = {}  # upload id -> content
+        self.calls = []
+        self.failures = {}
+        self.deltas = {}
+        self.on_chunk = None  # called with the offset of every chunk
+
+    def _call(self, method, *args):
+        self.calls.append((method, args))
+        failures = self.failures.get(method)
+        if failures:
+            raise failures.pop(0)
+
+    def _store(self, path, content):
+        rev = str(len(self.calls))
+        self.files[path.lower()] = (path, content, rev)
+        return {'path': path, 'rev': rev, 'bytes': len(content),
+                'is_dir': False}
+
+    def put_file(self, path, file, overwrite=False):
+        self._call('put_file', path)
+        return self._store(path, file.read())
+
+    def upload_chunk(self, chunk, length, offset=0, upload_id=None):
+        self._call('upload_chunk', offset, upload_id)
+        if self.on_chunk is not None:
+            self.on_chunk(offset)
+        upload_id = upload_id or 'u%s' % len(self.uploads)
+        content = self.uploads.get(upload_id, b'')
+        if offset != len(content):
+            raise ErrorResponse(400, body={
+                'offset': len(content), 'upload_id': upload_id})
+        self.uploads[upload_id] = content + chunk[:length]
+        return offset + length, upload_id
+
+    def commit_chunked_upload(self, full_path, upload_id, overwrite=False,
+                              parent_rev=None):
+        self._call('commit_chunked_upload', full_path, upload_id)
+        assert full_path.startswith('auto/')
+        return self._store(full_path[4:], self.uploads.pop(upload_id))
+
+    def file_delete(self, path):
+        self._call('file_delete', path)
+        if self.files.pop(path.lower(), None) is None:
+            raise ErrorResponse(404, 'Not Found')
+
+    def file_create_folder(self, path):
+        self._call('file_create_folder', path)
+        if path.lower() in self.folders:
+            raise ErrorResponse(403, 'Forbidden')
+        self.folders.add(path.lower())
+
+    def file_move(self, from_path, to_path):
+        self._call('file_move', from_path, to_path)
+        prefix, new_prefix = from_path.lower(), to_path.lower()
+        if prefix not in self.folders and prefix not in self.files:
+            raise ErrorResponse(404, 'Not Found')
+
+        def moved(path):
+            if path == prefix or path.startswith(prefix + '/'):
+                return new_prefix + path[len(prefix):]
+            return path
+        self.folders = set(map(moved, self.folders))
+        files = {}
+        for key, (path, content, rev) in self.files.items():
+            if moved(key) != key:
+                path = to_path + path[len(from_path):]
+            files[moved(key)] = (path, content, rev)
+        self.files = files
+        return {'path': to_path, 'rev': 'm%s' % len(self.calls)}
+
+    def get_file(self, path, rev=None, start=None, length=None):
+        self._call('get_file', path, start)
+        path, content, rev = self.files[path.lower()]
+        return FakeResponse(content[start or 0:], {
+            'path': path, 'rev': rev, 'bytes': len(content)})
+
+    def delta(self, cursor=None, path_prefix=None):
+        self._call('delta', cursor, path_prefix)
+        return self.deltas[cursor]
+
+    def content(self, path):
+        return self.files[path.lower()][1]
+
+
+@pytest.fixture()
+def temp_dir(request):
+    temp_dir = tempfile.mkdtemp()
+    # make sure temp files are cleaned.
+    request.addfinalizer(lambda: shutil.rmtree(temp_dir))
+    return temp_dir
+
+
+@pytest.fixture()
+def make_syncer(monkeypatch, temp_dir):
+    """ Creates Dropbox syncers that share their state files, like
+    restarts of omniSync.
+    """
+    monkeypatch.setattr(dropbox_sync, 'dropbox', FAKE_SDK)
+    monkeypatch.setattr(config, 'data', {
+        'state_dir': os.path.join(temp_dir, 'state'),
+        'configuration': {'Dropbox': {'chunk_size': 4, 'retry_delay': 1}}})
+    delays = []
+    monkeypatch.setattr(
+        dropbox_sync, 'time', SimpleNamespace(sleep=delays.append))
+
+    def make_syncer(client=None, index=None):
+        syncer = Dropbox(index=index)
+        syncer.client = client or FakeDropboxClient()
+        syncer.delays = delays
+        return syncer
+    return make_syncer
+
+
+def make_event(watch_dir, path, type='CREATE', isdir=False, size=10,
+               **kwargs):
+    source_absolute = os.path.join(watch_dir, path)
+    if type in ['CREATE', 'MODIFY', 'MOVED_TO']:
+        if isdir:
+            os.makedirs(source_absolute)
+        else:
+            os.makedirs(os.path.dirname(source_absolute), exist_ok=True)
+            write_random_file(source_absolute, size)
+    return InotifyEvent(
+        None,
+        {'source': watch_dir, 'syncers': ['Dropbox'], 'target': '/t'},
+        source_absolute=source_absolute,
+        isdir=isdir,
+        type=type,
+        **kwargs
+    )
+
+
+class TestDropbox():
+    def test_delete(self, make_syncer, temp_dir):
+        watch = os.path.join(temp_dir, 'w')
+        syncer = make_syncer(index=SyncIndex(
+            os.path.join(temp_dir, 'index.db')))
+        syncer.consume_item(make_event(watch, 'a', size=2))
+        assert syncer.client.content('/t/a')
+        os.remove(os.path.join(watch, 'a'))
+        syncer.consume_item(make_event(watch, 'a', type='DELETE'))
+        assert syncer.client.files == {}
+        assert syncer.index.entries('Dropbox', watch) == {}
+
+    def test_retry(self, make_syncer, temp_dir):
+        syncer = make_syncer()
+        local = make_event(temp_dir, 'a', size=2).source_absolute
+        syncer.client.failures['put_file'] = [
+            ErrorResponse(503), RESTSocketError(), ErrorResponse(429)]
+        syncer.upload(local, '/t/a')
+        # exponential backoff
+        assert syncer.delays == [1, 2, 4]
+        assert syncer.client.content('/t/a') == open(local, 'rb').read()
+        # client errors are not retried
+        syncer.client.failures['put_file'] = [ErrorResponse(403)]
+        with pytest.raises(ErrorResponse):
+            syncer.upload(local, '/t/a')
+        # up to max_retries times
+        syncer.max_retries = 1
+        syncer.client.failures['put_file'] = [ErrorResponse(500)] * 2
+        with pytest.raises(ErrorResponse):
+            syncer.upload(local, '/t/a')
+        assert syncer.delays == [1, 2, 4, 1]
+
+    def test_resume_saved_upload(self, make_syncer, temp_dir):
+        syncer = make_syncer()
+        local = make_event(temp_dir, 'a', size=10).source_absolute
+
+        def fail(offset):
+            if offset == 4:
+                raise ErrorResponse(403)
+        syncer.client.on_chunk = fail
+        with pytest.raises(ErrorResponse):
+            syncer.upload(local, '/t/a')
+        # restarted
+        client = syncer.client
+        client.on_chunk = None
+        syncer = make_syncer(client)
+        del client.calls[:]
+        syncer.upload(local, '/t/a')
+        assert client.calls[0] == ('upload_chunk', (4, 'u0'))
+        assert client.content('/t/a') == open(local, 'rb').read()
+        assert syncer._uploads == {}
+
+    def test_resume_behind_server(self, make_syncer, temp_dir):
+        syncer = make_syncer()
+        local = make_event(temp_dir, 'a', size=10).source_absolute
+
+        def fail(offset):
+            if offset == 8:
+                raise ErrorResponse(403)
+        syncer.client.on_chunk = fail
+        with pytest.raises(ErrorResponse):
+            syncer.upload(local, '/t/a')
+        # the response of the second chunk got lost
+        upload = dict(syncer._uploads['/t/a'], offset=4)
+        syncer._save_upload('/t/a', upload)
+        syncer.client.on_chunk = None
+        del syncer.client.calls[:]
+        syncer.upload(local, '/t/a')
+        # the server tells where to continue
+        assert [args[0] for method, args in syncer.client.calls
+                if method == 'upload_chunk'] == [4, 8]
+        assert syncer.client.content('/t/a') == open(local, 'rb').read()
+
+    def test_file_shrank(self, make_syncer, temp_dir):
+        syncer = make_syncer()
+        # chunks bigger than the buffer of the file are read from disk
+        syncer.chunk_size = io.DEFAULT_BUFFER_SIZE
+        local = make_event(
+            temp_dir, 'a', size=4 * syncer.chunk_size).source_absolute
+
+        def truncate(offset):
+            if offset == 0:
+                os.truncate(local, 2)
+        syncer.client.on_chunk = truncate
+        with pytest.raises(IOError):
+            syncer.upload(local, '/t/a')
+        assert 'a' not in syncer.client.files
+
+    def test_pull(self, make_syncer, temp_dir):
+        watch = os.path.join(temp_dir, 'w')
+        os.makedirs(watch)
+        index = SyncIndex(os.path.join(temp_dir, 'index.db'))
+        syncer = make_syncer(index=index)
+        client = syncer.client
+        client.files = {'/r/d/a': ('/r/D/a', b'a', '2'),
+                        '/r/b': ('/r/b', b'b', '3')}
+
+        def metadata(path, rev, is_dir=False):
+            return {'path': path, 'rev': rev, 'is_dir': is_dir}
+        client.deltas = {
+            None: {'reset': True, 'cursor': 'c1', 'has_more': True,
+                   'entries': [['/r/d', metadata('/r/D', '1', True)],
+                               ['/r/d/a', metadata('/r/D/a', '2')]]},
+            'c1': {'reset': False, 'cursor': 'c2', 'has_more': False,
+                   'entries': [['/r/b', metadata('/r/b', '3')]]},
+        }
+        syncer.pull(watch, '/r')
+        assert open(os.path.join(watch, 'D', 'a'), 'rb').read() == b'a'
+        assert open(os.path.join(watch, 'b'), 'rb').read() == b'b'
+        assert index.get('Dropbox', watch, 'b').remote_id == '3'
+        # the cursor survives a restart
+        syncer = make_syncer(client, index)
+        assert syncer._cursors == {watch + ' -> /r': 'c2'}
+
+        # deleted with another case, an entry of an already pulled rev
+        client.deltas['c2'] = {
+            'reset': False, 'cursor': 'c3', 'has_more': False,
+            'entries': [['/r/d/a', None], ['/r/b', metadata('/r/b', '3')]]}
+        del client.calls[:]
+        syncer.pull(watch, '/r')
+        assert client.calls == [('delta', ('c2', '/r'))]
+        assert os.listdir(os.path.join(watch, 'D')) == []
+        assert index.get('Dropbox', watch, 'D/a') is None
+
+        # after a reset everything is listed again
+        client.files['/r/b'] = ('/r/b', b'B', '4')
+        client.deltas['c3'] = {
+            'reset': True, 'cursor': 'c4', 'has_more': False,
+            'entries': [['/r/b', metadata('/r/b', '4')]]}
+        syncer.pull(watch, '/r')
+        assert open(os.path.join(watch, 'b'), 'rb').read() == b'B'
+        assert syncer._cursors == {watch + ' -> /r': 'c4'}
+
+    def test_local_path(self, temp_dir):
+        os.makedirs(os.path.join(temp_dir, 'A', 'b'))
+        assert Dropbox._local_path(temp_dir, '/a/B') == \
+            os.path.join(temp_dir, 'A', 'b')
+        assert Dropbox._local_path(temp_dir, '/a/c') is None
+
+    def test_download_resume(self, make_syncer, temp_dir):
+        syncer = make_syncer()
+        client = syncer.client
+        client.files['/r/a'] = ('/r/a', b'0123456789', '1')
+        local = os.path.join(temp_dir, 'a')
+        for rev, start in [('1', 4), ('0', None)]:
+            with open(local + PART_SUFFIX, 'wb') as part:
+                part.write(b'0123')
+            with open(syncer.version_file(local), 'w') as version:
+                version.write(rev)
+            del client.calls[:]
+            syncer.download(local, '/r/a')
+            assert open(local, 'rb').read() == b'0123456789'
+            # only the same rev is resumed
+            assert client.calls[-1] == ('get_file', ('/r/a', start))
+        assert sorted(os.listdir(temp_dir)) == ['a', 'state']
+
+    def test_pull_reset(self, make_syncer, temp_dir):
+        watch = os.path.join(temp_dir, 'w')
+        index = SyncIndex(os.path.join(temp_dir, 'index.db'))
+        syncer = make_syncer(index=index)
+        client = syncer.client
+        client.files = {'/r/' + name: ('/r/' + name, name.encode(), '1')
+                        for name in ['a', 'b', 'c']}
+        client.deltas = {None: {
+            'reset': True, 'cursor': 'c1', 'has_more': False,
+            'entries': [['/r/' + name, {'path': '/r/' + name, 'rev': '1',
+                                        'is_dir': False}]
+                        for name in ['a', 'b', 'c']]}}
+        os.makedirs(watch)
+        syncer.pull(watch, '/r')
+        write_random_file(os.path.join(watch, 'new'), 10)
+        with open(os.path.join(watch, 'c'), 'ab') as f:
+            f.write(b'changed')
+        # a and c were deleted remotely, the cursor is outdated
+        client.deltas['c1'] = {
+            'reset': True, 'cursor': 'c2', 'has_more': True,
+            'entries': []}
+        client.deltas['c2'] = {
+            'reset': False, 'cursor': 'c3', 'has_more': False,
+            'entries': [['/r/b', {'path': '/r/b', 'rev': '1',
+                                  'is_dir': False}]]}
+        syncer.pull(watch, '/r')
+        # changed and unsynced files are kept
+        assert sorted(os.listdir(watch)) == ['b', 'c', 'new']
+        assert sorted(index.entries(syncer.name, watch)) == ['b', 'c']
+        assert syncer._cursors == {watch + ' -> /r': 'c3'}
+
+        # the root of the watch itself is never deleted
+        client.deltas['c3'] = {'reset': False, 'cursor': 'c4',
+                               'has_more': False, 'entries': [['/r', None]]}
+        syncer.pull(watch, '/r')
+        assert sorted(os.listdir(watch)) == ['b', 'c', 'new']
+
+    def test_folder_rename(self, make_syncer, temp_dir):
+        watch = os.path.join(temp_dir, 'w')
+        index = SyncIndex(os.path.join(temp_dir, 'index.db'))
+        syncer = make_syncer(index=index)
+        client = syncer.client
+        folder = make_event(watch, 'd', isdir=True)
+        syncer.consume_item(folder)
+        syncer.consume_item(make_event(watch, 'd/a', size=2))
+
+        def rename(old, new):
+            os.rename(old.source_absolute, os.path.join(watch, new))
+            return old.replace(
+                source_absolute=os.path.join(watch, new), type='MOVED_TO',
+                moved_from=old.replace(type='MOVED_FROM'))
+        e = rename(folder, 'e')
+        syncer.consume_item(e)
+        # moved with its content
+        assert sorted(client.files) == ['/t/e/a']
+        assert client.folders == {'/t/e'}
+        assert sorted(index.entries(syncer.name, watch)) == ['e', 'e/a']
+        # missing at the target, the local content is uploaded
+        client.files.clear()
+        client.folders.clear()
+        syncer.consume_item(rename(e, 'f'))
+        assert client.content('/t/f/a') == \
+            open(os.path.join(watch, 'f', 'a'), 'rb').read()
+        assert client.folders == {'/t/f'}
+        assert sorted(index.entries(syncer.name, watch)) == ['f', 'f/a']
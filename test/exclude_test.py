@@ -0,0 +1,84 @@
+import sys
+import os
+import weakref
+import tempfile
+import shutil
+
+import pytest
+
+sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
+from utils.exclude import Excludes
+from utils.exclude import IGNORE_FILE
+from utils.exclude import Rules
+from utils.exclude import watch_excludes
+from scanner import scan
+
+
+@pytest.fixture()
+def temp_dir(request):
+    temp_dir = tempfile.mkdtemp()
+    # make sure temp files are cleaned.
+    request.addfinalizer(lambda: shutil.rmtree(temp_dir))
+    return temp_dir
+
+
+@pytest.mark.parametrize('pattern, path, isdir, excluded', [
+    ('*.pyc', 'a.pyc', False, True),
+    ('*.pyc', 'd/a.pyc', False, True),
+    ('build/', 'd/build', True, True),
+    ('build/', 'build', False, False),
+    ('/top', 'top', False, True),
+    ('/top', 'd/top', False, False),
+    ('doc/*.txt', 'doc/a.txt', False, True),
+    ('doc/*.txt', 'doc/x/a.txt', False, False),
+    ('doc/*.txt', 'x/doc/a.txt', False, False),
+    ('**/logs', 'a/b/logs', True, True),
+    ('a/**/b', 'a/b', False, True),
+    ('a/**/b', 'a/x/y/b', False, True),
+    ('x/**', 'x', True, False),
+    ('x/**', 'x/y/z', False, True),
+    ('f[0-9]', 'f1', False, True),
+    ('f[!0-9]', 'f1', False, False),
+    ('\\#a', '#a', False, True),
+    ('# comment', '# comment', False, False),
+])
+def test_patterns(pattern, path, isdir, excluded):
+    assert Rules([('', pattern)]).excluded(path, isdir) is excluded
+
+
+def test_last_pattern_wins():
+    rules = Rules([('', '*.log'), ('', '!keep.log'), ('', 'd/keep.log')])
+    assert rules.excluded('a.log', False)
+    assert not rules.excluded('keep.log', False)
+    assert rules.excluded('d/keep.log', False)
+
+
+def test_ignore_files(temp_dir):
+    os.makedirs(os.path.join(temp_dir, 'd', 'e', 'skip'))
+    for path in ['a.log', 'a.tmp', 'd/a.log', 'd/keep.log', 'd/e/a.log',
+                 'd/e/skip/b', 'd/only', 'd/e/only']:
+        open(os.path.join(temp_dir, path), 'w').close()
+    with open(os.path.join(temp_dir, 'd', IGNORE_FILE), 'w') as f:
+        f.write('*.log\n!keep.log\n/only\nskip/\n')
+    excludes = Excludes(temp_dir, ['.*\\.tmp$'], ['*.bak'])
+    assert sorted(scan(temp_dir, excludes)) == [
+        'a.log', 'd', 'd/.omnisyncignore', 'd/e', 'd/e/only', 'd/keep.log']
+    with open(os.path.join(temp_dir, 'd', IGNORE_FILE), 'w') as f:
+        f.write('e/\n')
+    excludes.changed(os.path.join(temp_dir, 'd', IGNORE_FILE))
+    assert excludes.excluded(os.path.join(temp_dir, 'd', 'e'), True)
+    assert not excludes.excluded(os.path.join(temp_dir, 'd', 'a.log'), False)
+
+
+def test_watch_excludes(temp_dir):
+    # plain dicts can not be referenced weakly
+    config = type('Config', (dict,), {})(
+        source=temp_dir, exclude=['.*\\.o$'])
+    reference = weakref.ref(config)
+    excludes = watch_excludes(config)
+    assert watch_excludes(config) is excludes
+    assert watch_excludes(dict(config)) is not excludes
+    del config
+    assert reference() is not None  # used by the excludes
+    del excludes
+    assert reference() is None
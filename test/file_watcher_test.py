@@ -0,0 +1,494 @@
+import sys
+import os
+import weakref
+import queue
+import tempfile
+import shutil
+import threading
+from types import SimpleNamespace
+
+import pytest
+import pyinotify
+
+sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
+from file_watcher import EventCoalescer
+from file_watcher import FileQueue
+from file_watcher import FileWatcher
+from file_watcher import InotifyEvent
+from file_watcher import PollingWatcher
+from file_watcher import WatchService
+from utils.journal import Journal
+
+
+SOURCE = '/omniSyncSource'
+
+
+def make_event(path, type, watch_config, **kwargs):
+    return InotifyEvent(
+        None, watch_config,
+        source_absolute=path,
+        isdir=False,
+        type=type,
+        **kwargs
+    )
+
+
+def folder_key(event):
+    return event.source_absolute if event.isdir else event.base_path
+
+
+@pytest.fixture()
+def watch_config():
+    return {'source': SOURCE, 'target': '/omniSyncTarget',
+            'syncers': ['Rsync'], 'quiet_period': 10}
+
+
+@pytest.fixture()
+def temp_dir(request):
+    temp_dir = tempfile.mkdtemp()
+    # make sure temp files are cleaned.
+    request.addfinalizer(lambda: shutil.rmtree(temp_dir))
+    return temp_dir
+
+
+@pytest.fixture()
+def coalescer():
+    return EventCoalescer(queue.Queue())
+
+
+def emitted(coalescer):
+    coalescer.flush()
+    events = []
+    while not coalescer.queue.empty():
+        events.append(coalescer.queue.get())
+    return [(e.type, e.source_absolute) for e in events]
+
+
+class TestInotifyEvent():
+    def test_derived_paths(self, watch_config):
+        event = make_event(SOURCE + '/a/b', 'CREATE', watch_config)
+        assert event.file_name == 'b'
+        assert event.base_path == SOURCE + '/a'
+        assert event.source_relative == 'a/b'
+        assert event.target_absolute == '/omniSyncTarget/a/b'
+        assert event.target_base_dir_absolute == '/omniSyncTarget/a'
+        assert event.config is watch_config
+        root = make_event(
+            SOURCE, 'RESCAN', dict(watch_config, source=SOURCE + '/'))
+        assert root.source_relative == '.'
+
+    def test_immutable(self, watch_config):
+        event = make_event(SOURCE + '/a', 'CREATE', watch_config)
+        with pytest.raises(AttributeError):
+            event.type = 'DELETE'
+        modified = event.replace(type='MODIFY')
+        assert (event.type, modified.type) == ('CREATE', 'MODIFY')
+        # same path and syncers, same queue item
+        assert modified == event and hash(modified) == hash(event)
+        assert modified != make_event(SOURCE + '/b', 'CREATE', watch_config)
+
+    def test_config_is_not_kept(self, watch_config):
+        # plain dicts can not be referenced weakly
+        config = type('Config', (dict,), {})(watch_config)
+        reference = weakref.ref(config)
+        event = make_event(SOURCE + '/a', 'CREATE', config)
+        del config
+        assert reference() is event.config
+        del event
+        assert reference() is None
+
+
+class TestEventCoalescer():
+    def test_merges_modifications(self, coalescer, watch_config):
+        path = SOURCE + '/a'
+        for t in ['CREATE', 'MODIFY', 'ATTRIB', 'MODIFY']:
+            coalescer.put(make_event(path, t, watch_config))
+        assert emitted(coalescer) == [('CREATE', path)]
+        assert coalescer.raw_events == 4
+        assert coalescer.folded_events == 3
+
+    def test_attrib_only(self, coalescer, watch_config):
+        path = SOURCE + '/a'
+        for t in ['ATTRIB', 'ATTRIB']:
+            coalescer.put(make_event(path, t, watch_config))
+        assert emitted(coalescer) == [('ATTRIB', path)]
+
+    def test_create_delete_cancels(self, coalescer, watch_config):
+        path = SOURCE + '/a'
+        for t in ['CREATE', 'MODIFY', 'DELETE']:
+            coalescer.put(make_event(path, t, watch_config))
+        assert emitted(coalescer) == []
+        assert coalescer.folded_events == 3
+
+    def test_delete_create_is_modify(self, coalescer, watch_config):
+        path = SOURCE + '/a'
+        for t in ['DELETE', 'CREATE', 'MODIFY']:
+            coalescer.put(make_event(path, t, watch_config))
+        assert emitted(coalescer) == [('MODIFY', path)]
+
+    def test_rename(self, coalescer, watch_config):
+        old, new = SOURCE + '/a', SOURCE + '/b'
+        coalescer.put(make_event(old, 'MOVED_FROM', watch_config))
+        coalescer.put(make_event(
+            new, 'MOVED_TO', watch_config, moved_from_path=old))
+        coalescer.flush()
+        event = coalescer.queue.get()
+        assert coalescer.queue.empty()
+        assert (event.type, event.source_absolute) == ('MOVED_TO', new)
+        assert event.moved_from.source_absolute == old
+        assert event.moved_from.type == 'MOVED_FROM'
+
+    def test_rename_then_delete(self, coalescer, watch_config):
+        old, new = SOURCE + '/a', SOURCE + '/b'
+        coalescer.put(make_event(old, 'MOVED_FROM', watch_config))
+        coalescer.put(make_event(
+            new, 'MOVED_TO', watch_config, moved_from_path=old))
+        coalescer.put(make_event(new, 'DELETE', watch_config))
+        assert emitted(coalescer) == [('MOVED_FROM', old)]
+
+    def test_create_then_rename(self, coalescer, watch_config):
+        old, new = SOURCE + '/a', SOURCE + '/b'
+        coalescer.put(make_event(old, 'CREATE', watch_config))
+        coalescer.put(make_event(old, 'MOVED_FROM', watch_config))
+        coalescer.put(make_event(
+            new, 'MOVED_TO', watch_config, moved_from_path=old))
+        assert emitted(coalescer) == [('CREATE', new)]
+
+    def test_parents_first(self, coalescer, watch_config):
+        folder, file = SOURCE + '/d', SOURCE + '/d/a'
+        coalescer.put(make_event(folder, 'CREATE', watch_config))
+        coalescer.put(make_event(file, 'CREATE', watch_config))
+        # extends the quiet period of the folder beyond the one of the file
+        coalescer.put(make_event(folder, 'ATTRIB', watch_config))
+        coalescer.flush(file)
+        assert emitted(coalescer) == [('CREATE', folder), ('CREATE', file)]
+
+    def test_disabled(self, coalescer, watch_config):
+        watch_config['quiet_period'] = 0
+        path = SOURCE + '/a'
+        for t in ['CREATE', 'MODIFY']:
+            coalescer.put(make_event(path, t, watch_config))
+        assert coalescer.queue.qsize() == 2
+
+
+class TestFileQueue():
+    def restart(self, journal):
+        journal.close()
+        return Journal(journal.path)
+
+    def test_replay(self, temp_dir, watch_config):
+        journal = Journal(os.path.join(temp_dir, 'queue.db'))
+        file_queue = FileQueue(journal=journal)
+        paths = [SOURCE + '/' + name for name in ['b', 'a', 'c']]
+        for path in paths + paths[:1]:
+            file_queue.put(make_event(path, 'MODIFY', watch_config))
+        # finished items are not replayed
+        file_queue.task_done(file_queue.get())
+
+        journal = self.restart(journal)
+        file_queue = FileQueue(journal=journal)
+        file_queue.replay([watch_config])
+        assert file_queue.qsize() == 2
+        replayed = [file_queue.get() for _ in range(2)]
+        assert [e.source_absolute for e in replayed] == paths[1:]
+        assert replayed[0].type == 'MODIFY'
+        assert replayed[0].syncers == watch_config['syncers']
+
+    def test_taken_items_are_replayed(self, temp_dir, watch_config):
+        journal = Journal(os.path.join(temp_dir, 'queue.db'))
+        file_queue = FileQueue(journal=journal)
+        file_queue.put(make_event(SOURCE + '/a', 'CREATE', watch_config))
+        file_queue.get()  # crash while processing the item
+
+        file_queue = FileQueue(journal=self.restart(journal))
+        file_queue.replay([watch_config])
+        assert file_queue.qsize() == 1
+
+    def test_requeued_while_processing(self, temp_dir, watch_config):
+        journal = Journal(os.path.join(temp_dir, 'queue.db'))
+        file_queue = FileQueue(journal=journal)
+        event = make_event(SOURCE + '/a', 'CREATE', watch_config)
+        file_queue.put(event)
+        file_queue.get()
+        file_queue.put(event)
+        file_queue.task_done(event)
+
+        file_queue = FileQueue(journal=self.restart(journal))
+        file_queue.replay([watch_config])
+        assert file_queue.qsize() == 1
+
+    def test_put_before_replay(self, temp_dir, watch_config):
+        journal = Journal(os.path.join(temp_dir, 'queue.db'))
+        file_queue = FileQueue(journal=journal)
+        for path in ['/a', '/b']:
+            file_queue.put(make_event(SOURCE + path, 'CREATE', watch_config))
+
+        journal = self.restart(journal)
+        file_queue = FileQueue(journal=journal)
+        file_queue.put(make_event(SOURCE + '/a', 'MODIFY', watch_config))
+        file_queue.put(make_event(SOURCE + '/c', 'CREATE', watch_config))
+        file_queue.replay([watch_config])
+        assert file_queue.qsize() == 3
+        # the items put before the replay keep their records
+        file_queue = FileQueue(journal=self.restart(journal))
+        file_queue.replay([watch_config])
+        assert sorted((e.source_absolute, e.type) for e in
+                      [file_queue.get(block=False) for _ in range(3)]) == [
+            (SOURCE + '/a', 'MODIFY'), (SOURCE + '/b', 'CREATE'),
+            (SOURCE + '/c', 'CREATE')]
+
+    def test_removed_watch(self, temp_dir, watch_config):
+        journal = Journal(os.path.join(temp_dir, 'queue.db'))
+        file_queue = FileQueue(journal=journal)
+        file_queue.put(make_event(SOURCE + '/a', 'CREATE', watch_config))
+
+        file_queue = FileQueue(journal=self.restart(journal))
+        file_queue.replay([dict(watch_config, disabled=True)])
+        assert file_queue.qsize() == 0
+
+    def test_ordering_with_several_consumers(self, watch_config):
+        file_queue = FileQueue()
+        for path, t in [('/d', 'CREATE'), ('/d/a', 'CREATE'),
+                        ('/e', 'CREATE'), ('/d/a', 'MODIFY')]:
+            file_queue.put(make_event(SOURCE + path, t, watch_config))
+        folder = file_queue.get()
+        # content of a folder waits for the folder
+        assert file_queue.get().source_absolute == SOURCE + '/e'
+        with pytest.raises(queue.Empty):
+            file_queue.get(block=False)
+        file_queue.task_done(folder)
+        assert file_queue.get(timeout=1).source_absolute == SOURCE + '/d/a'
+
+    def test_blocked_events_wait_once(self, watch_config, monkeypatch):
+        file_queue = FileQueue()
+        file_queue.put(make_event(SOURCE + '/d', 'CREATE', watch_config))
+        for i in range(100):
+            for path in ['/d/%s' % i, '/e%s' % i]:
+                file_queue.put(make_event(SOURCE + path, 'CREATE',
+                                          watch_config))
+        folder = file_queue.get()
+        checks = []
+        blocked = file_queue._blocked
+        monkeypatch.setattr(file_queue, '_blocked',
+                            lambda event: checks.append(event) or
+                            blocked(event))
+        assert [file_queue.get(block=False).source_absolute
+                for _ in range(100)] == \
+            [SOURCE + '/e%s' % i for i in range(100)]
+        # every skipped event is looked at once, not on every get
+        assert len(checks) == 200
+        assert file_queue.qsize() == 100
+        with pytest.raises(queue.Empty):
+            file_queue.get(block=False)
+        file_queue.task_done(folder)
+        assert [file_queue.get(block=False).source_absolute
+                for _ in range(100)] == \
+            [SOURCE + '/d/%s' % i for i in range(100)]
+
+    def test_modified_while_processing(self, watch_config):
+        file_queue = FileQueue()
+        event = make_event(SOURCE + '/a', 'MODIFY', watch_config)
+        file_queue.put(event)
+        file_queue.get()
+        file_queue.put(event)
+        with pytest.raises(queue.Empty):
+            file_queue.get(timeout=0.01)
+        file_queue.task_done(event)
+        assert file_queue.get(block=False) == event
+
+    def test_dirty_while_processing(self, watch_config):
+        file_queue = FileQueue()
+        event = make_event(SOURCE + '/a', 'MODIFY', watch_config)
+        file_queue.put(event)
+        file_queue.get()
+        assert not file_queue.is_dirty(event)
+        file_queue.put(make_event(SOURCE + '/a', 'MODIFY', watch_config))
+        assert file_queue.is_dirty(event)
+        file_queue.task_done(event)
+        assert not file_queue.is_dirty(file_queue.get(block=False))
+
+    def test_overflow_collapses_subtree(self, temp_dir, watch_config):
+        journal = Journal(os.path.join(temp_dir, 'queue.db'))
+        file_queue = FileQueue(maxsize=3, journal=journal)
+        for path in ['/d/a', '/e', '/d/b', '/h']:
+            file_queue.put(make_event(SOURCE + path, 'CREATE', watch_config))
+        assert [(e.type, e.source_absolute) for e in file_queue.queue] == [
+            ('RESCAN', SOURCE + '/d'),
+            ('CREATE', SOURCE + '/e'),
+            ('CREATE', SOURCE + '/h'),
+        ]
+        # covered by the queued rescan
+        file_queue.put(make_event(SOURCE + '/d/f', 'CREATE', watch_config))
+        assert file_queue.qsize() == 3
+        # collapses up to the source of the watch
+        file_queue.put(make_event(SOURCE + '/g', 'CREATE', watch_config))
+        assert [(e.type, e.source_absolute) for e in file_queue.queue] == [
+            ('RESCAN', SOURCE),
+        ]
+        file_queue = FileQueue(journal=self.restart(journal))
+        file_queue.replay([watch_config])
+        assert [(e.type, e.source_absolute) for e in file_queue.queue] == [
+            ('RESCAN', SOURCE)]
+
+    def test_key_merges_folder(self, temp_dir, watch_config):
+        journal = Journal(os.path.join(temp_dir, 'queue.db'))
+        file_queue = FileQueue(journal=journal, key=folder_key)
+        for path in ['/d/a', '/e', '/d/b', '/d/c']:
+            file_queue.put(make_event(SOURCE + path, 'MODIFY', watch_config))
+        assert [(e.type, e.source_absolute) for e in file_queue.queue] == [
+            ('RESCAN_DIR', SOURCE + '/d'),
+            ('MODIFY', SOURCE + '/e'),
+        ]
+        assert file_queue.unfinished_tasks == 2
+        file_queue = FileQueue(journal=self.restart(journal), key=folder_key)
+        file_queue.replay([watch_config])
+        assert [(e.type, e.source_absolute) for e in file_queue.queue] == [
+            ('MODIFY', SOURCE + '/e'),
+            ('RESCAN_DIR', SOURCE + '/d'),
+        ]
+
+    def test_key_merge_keeps_rename(self, temp_dir, watch_config):
+        def key(event):
+            # like `Rsync.event_key`, renames have their own key
+            return event if event.moved_from is not None else \
+                folder_key(event)
+        journal = Journal(os.path.join(temp_dir, 'queue.db'))
+        file_queue = FileQueue(journal=journal, key=key)
+        file_queue.put(make_event(
+            SOURCE + '/d/x', 'MOVED_TO', watch_config,
+            moved_from=make_event(SOURCE + '/o/x', 'MOVED_FROM',
+                                  watch_config)))
+        file_queue.put(make_event(SOURCE + '/d/x', 'MODIFY', watch_config))
+        file_queue.put(make_event(SOURCE + '/d/y', 'CREATE', watch_config))
+        expected = [('MOVED_TO', SOURCE + '/d/x'),
+                    ('RESCAN_DIR', SOURCE + '/d')]
+        assert [(e.type, e.source_absolute)
+                for e in file_queue.queue] == expected
+        file_queue = FileQueue(journal=self.restart(journal), key=key)
+        file_queue.replay([watch_config])
+        assert [(e.type, e.source_absolute)
+                for e in file_queue.queue] == expected
+
+
+class TestWatchService():
+    def test_shared(self, temp_dir):
+        service = WatchService()
+        service.start()
+        threads = threading.active_count()
+        events = queue.Queue()
+        watchers = []
+        for name in ['a', 'b']:
+            os.makedirs(os.path.join(temp_dir, name, 'd'))
+            watchers.append(FileWatcher(events, {
+                'source': os.path.join(temp_dir, name), 'syncers': []
+            }, service))
+        assert threading.active_count() == threads
+        for watcher in watchers:
+            assert watcher.registered.wait(1)
+            # changes before the registration
+            assert events.get(block=False).type == 'RESCAN'
+        for name in ['a', 'b']:
+            open(os.path.join(temp_dir, name, 'd', 'f'), 'w').close()
+            # no read delay
+            event = events.get(timeout=1)
+            assert (event.type, event.source_relative) == ('CREATE', 'd/f')
+            assert event.source_base_dir == os.path.join(temp_dir, name)
+        watchers[0].stop()
+        open(os.path.join(temp_dir, 'a', 'd', 'g'), 'w').close()
+        open(os.path.join(temp_dir, 'b', 'g'), 'w').close()
+        assert events.get(timeout=1).source_relative == 'g'
+        service.stop()
+        assert events.empty()
+
+    def test_budget(self, temp_dir):
+        service = WatchService(budget=2, batch_size=1, rescan_interval=0.1)
+        service.start()
+        for i, name in enumerate(['a', 'b', 'c']):
+            os.makedirs(os.path.join(temp_dir, name, 'd'))
+            os.utime(os.path.join(temp_dir, name), (0, [1, 3, 2][i]))
+        events = queue.Queue()
+        watcher = FileWatcher(
+            events, {'source': temp_dir, 'syncers': []}, service)
+        assert watcher.registered.wait(1)
+        # the source and the most recently modified folder are watched
+        assert sorted(watcher.unwatched) == [
+            os.path.join(temp_dir, path) for path in ['a', 'b/d', 'c']]
+        assert events.get(block=False).type == 'RESCAN'
+        open(os.path.join(temp_dir, 'b', 'f'), 'w').close()
+        # the unwatched folders are rescanned
+        seen = set()
+        while len(seen) < 4:
+            event = events.get(timeout=1)
+            seen.add((event.type, event.source_relative))
+        assert seen == {('CREATE', 'b/f'), ('RESCAN', 'a'),
+                        ('RESCAN', 'b/d'), ('RESCAN', 'c')}
+        service.stop()
+
+    def test_overflow(self, temp_dir):
+        events = queue.Queue()
+        watcher = FileWatcher(events, {'source': temp_dir, 'syncers': []})
+        assert watcher.registered.wait(1)
+        assert events.get(block=False).type == 'RESCAN'
+        watcher.service._unwatched_event(
+            SimpleNamespace(mask=pyinotify.IN_Q_OVERFLOW))
+        event = events.get(timeout=1)
+        assert (event.type, event.source_absolute) == ('RESCAN', temp_dir)
+        watcher.stop()
+
+
+def polled(events, count):
+    """ Returns the next `count` events as (type, relative path), renames
+    with their old path.
+    """
+    result = set()
+    for _ in range(count):
+        event = events.get(timeout=2)
+        result.add((event.type, event.source_relative) +
+                   ((event.moved_from.source_relative,)
+                    if event.moved_from else ()))
+    return result
+
+
+class TestPollingWatcher():
+    def test_changes(self, temp_dir):
+        os.makedirs(os.path.join(temp_dir, 'd', 'e'))
+        for name in ['a', 'b', 'd/e/c']:
+            with open(os.path.join(temp_dir, name), 'w') as f:
+                f.write('x')
+        events = queue.Queue()
+        watcher = PollingWatcher(events, {
+            'source': temp_dir, 'syncers': [],
+            'poll_min_interval': 0.01, 'poll_max_interval': 0.05})
+        assert watcher.registered.wait(1)
+        assert events.get(timeout=1).type == 'RESCAN'
+        with open(os.path.join(temp_dir, 'd', 'e', 'c'), 'w') as f:
+            f.write('changed')
+        os.rename(os.path.join(temp_dir, 'a'), os.path.join(temp_dir, 'n'))
+        os.remove(os.path.join(temp_dir, 'b'))
+        os.makedirs(os.path.join(temp_dir, 'new'))
+        open(os.path.join(temp_dir, 'new', 'f'), 'w').close()
+        assert polled(events, 5) == {
+            ('MODIFY', 'd/e/c'), ('MOVED_TO', 'n', 'a'), ('DELETE', 'b'),
+            ('CREATE', 'new'), ('CREATE', 'new/f')}
+        os.rename(os.path.join(temp_dir, 'd'), os.path.join(temp_dir, 'm'))
+        assert polled(events, 1) == {('MOVED_TO', 'm', 'd')}
+        open(os.path.join(temp_dir, 'm', 'e', 'g'), 'w').close()
+        assert polled(events, 1) == {('CREATE', 'm/e/g')}
+        watcher.stop()
+        assert events.empty()
+
+    def test_coarse_mtime(self, temp_dir):
+        folder = os.path.join(temp_dir, 'd')
+        os.makedirs(folder)
+        mtime = os.stat(folder).st_mtime_ns
+        events = queue.Queue()
+        watcher = PollingWatcher(events, {
+            'source': temp_dir, 'syncers': [],
+            'poll_min_interval': 0.01, 'poll_max_interval': 0.05})
+        assert watcher.registered.wait(1)
+        assert events.get(timeout=1).type == 'RESCAN'
+        # created in the same tick as the listing
+        open(os.path.join(folder, 'f'), 'w').close()
+        os.utime(folder, ns=(mtime, mtime))
+        assert polled(events, 1) == {('CREATE', 'd/f')}
+        watcher.stop()
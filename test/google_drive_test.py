@@ -0,0 +1,393 @@
+import sys
+import os
+import re
+import json
+import hashlib
+import tempfile
+import shutil
+from email.parser import Parser
+from urllib.parse import urlparse, parse_qs
+
+import httplib2
+import pytest
+from apiclient import discovery
+
+sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
+from utils.files import write_random_file
+from utils.files import PART_SUFFIX
+import config
+from sync_index import SyncIndex
+from file_watcher import InotifyEvent
+from syncers.google_drive import GoogleDrive
+from syncers.google_drive import MIME_FOLDER
+
+
+class FakeDriveHttp():
+    """ Answers the Drive v2 requests of the syncer from memory.
+
+    Every http request (a whole batch counts as one) is recorded in
+    `requests`.
+    """
+
+    def __init__(self):
+        self.files = {'root': {'id': 'root', 'title': '', 'parents': []}}
+        self.contents = {}
+        self.requests = []
+        self.uploads = {}
+        self.on_upload = None  # called when the content of a file arrives
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        url = urlparse(uri)
+        self.requests.append((method, url.path))
+        if url.path == '/batch/drive/v2':
+            return self._batch(headers, body)
+        if url.netloc == 'download.test':
+            return self._download(url.path[1:], headers['Range'])
+        if hasattr(body, 'read'):  # a chunk of a resumable upload
+            body = body.read()
+        if isinstance(body, bytes):
+            body = body.decode('latin-1')
+        status, content, location = self._handle(
+            method, url.path, parse_qs(url.query), body)
+        response = httplib2.Response({'status': status})
+        if location is not None:
+            response['location'] = location
+        return response, json.dumps(content).encode('utf-8')
+
+    def _handle(self, method, path, query, body):
+        match = re.match(r'/drive/v2/files/([^/]+)/children$', path)
+        if match:
+            title = re.match(r'title = "(.*)"', query['q'][0]).group(1)
+            return 200, {'items': [
+                {'id': file['id']} for file in self.files.values()
+                if match.group(1) in file['parents'] and
+                file['title'] == title and not file.get('trashed')
+            ]}, None
+        match = re.match(r'/drive/v2/files/([^/]+)/trash$', path)
+        if match:
+            if match.group(1) not in self.files:
+                return 404, {'error': {'code': 404}}, None
+            self.files[match.group(1)]['trashed'] = True
+            return 200, self.files[match.group(1)], None
+        if path == '/drive/v2/files' and method == 'POST':
+            return 200, self._insert(json.loads(body)), None
+        match = re.match(r'/upload/drive/v2/files(/[^/]+)?$', path)
+        if match:  # start of a resumable upload
+            upload_id = str(len(self.uploads))
+            self.uploads[upload_id] = (
+                match.group(1) and match.group(1)[1:],
+                json.loads(body or '{}'))
+            return 200, {}, 'https://upload.test/' + upload_id
+        match = re.match(r'/(\d+)$', path)
+        if match:
+            file_id, metadata = self.uploads.pop(match.group(1))
+            if self.on_upload is not None:
+                self.on_upload()
+            if file_id is None:
+                file_id = self._insert(metadata)['id']
+            self.contents[file_id] = body.encode('latin-1')
+            self.files[file_id]['fileSize'] = str(len(body))
+            self.files[file_id]['md5Checksum'] = hashlib.md5(
+                self.contents[file_id]).hexdigest()
+            return 200, self.files[file_id], None
+        match = re.match(r'/drive/v2/files/([^/]+)/copy$', path)
+        if match:
+            copy = self._insert(json.loads(body))
+            self.contents[copy['id']] = self.contents[match.group(1)]
+            return 200, copy, None
+        match = re.match(r'/drive/v2/files/([^/]+)$', path)
+        if match and method == 'PATCH':
+            file = self.files[match.group(1)]
+            file['title'] = json.loads(body)['title']
+            file['parents'] = [
+                parent for parent in file['parents']
+                if parent not in query.get('removeParents', [])
+            ] + query.get('addParents', [])
+            return 200, file, None
+        if match and method == 'GET':
+            return 200, dict(
+                self.files[match.group(1)],
+                downloadUrl='https://download.test/' + match.group(1)
+            ), None
+        raise AssertionError('unexpected request %s %s' % (method, path))
+
+    def _insert(self, metadata):
+        file_id = 'id%s' % len(self.files)
+        self.files[file_id] = {
+            'id': file_id,
+            'title': metadata['title'],
+            'mimeType': metadata.get('mimeType'),
+            'parents': [parent['id'] for parent in metadata['parents']],
+        }
+        return self.files[file_id]
+
+    def _download(self, file_id, range):
+        start, end = map(int, re.match(r'bytes=(\d+)-(\d+)', range).groups())
+        return httplib2.Response({'status': 206}), \
+            self.contents[file_id][start:end + 1]
+
+    def _batch(self, headers, body):
+        message = Parser().parsestr(
+            'content-type: %s\r\n\r\n%s' % (headers['content-type'], body))
+        parts = []
+        for part in message.get_payload():
+            request = part.get_payload()
+            request_line, rest = request.split('\n', 1)
+            method, uri, _ = request_line.split(' ')
+            url = urlparse(uri)
+            status, content, _ = self._handle(
+                method, url.path, parse_qs(url.query),
+                rest.split('\n\n', 1)[-1].strip() or None)
+            parts.append(
+                '--BOUNDARY\r\nContent-Type: application/http\r\n'
+                'Content-ID: <response-%s\r\n\r\n'
+                'HTTP/1.1 %s OK\r\nContent-Type: application/json\r\n\r\n'
+                '%s\r\n' % (part['content-id'][1:], status,
+                            json.dumps(content)))
+        response = httplib2.Response({
+            'status': 200,
+            'content-type': 'multipart/mixed; boundary=BOUNDARY'})
+        return response, (''.join(parts) + '--BOUNDARY--').encode('utf-8')
+
+    def paths(self):
+        """ Returns the paths of all existing files, the content of a
+        trashed folder is trashed with it.
+        """
+        def path(file):
+            if file['id'] == 'root':
+                return ''
+            if file.get('trashed'):
+                return None
+            parent = path(self.files[file['parents'][0]])
+            return None if parent is None else parent + '/' + file['title']
+        return sorted(filter(None, (
+            path(file) for file in self.files.values()
+            if file['id'] != 'root')))
+
+
+@pytest.fixture()
+def temp_dir(request):
+    temp_dir = tempfile.mkdtemp()
+    # make sure temp files are cleaned.
+    request.addfinalizer(lambda: shutil.rmtree(temp_dir))
+    return temp_dir
+
+
+@pytest.fixture()
+def drive(monkeypatch):
+    monkeypatch.setattr(config, 'data', {'configuration': {'GoogleDrive': {}}})
+    drive = GoogleDrive()
+    drive.http = FakeDriveHttp()
+    drive.service = discovery.build('drive', 'v2', http=drive.http)
+    return drive
+
+
+def make_event(watch_dir, path, type='CREATE', isdir=False):
+    source_absolute = os.path.join(watch_dir, path)
+    if type != 'DELETE':
+        if isdir:
+            os.makedirs(source_absolute)
+        else:
+            write_random_file(source_absolute, 10)
+    return InotifyEvent(
+        None,
+        {'source': watch_dir, 'syncers': ['GoogleDrive'], 'target': '/t'},
+        source_absolute=source_absolute,
+        isdir=isdir,
+        type=type,
+    )
+
+
+class TestGoogleDrive():
+    def test_path_cache(self, drive, temp_dir):
+        drive.consume_item(make_event(temp_dir, 'a'))
+        requests = len(drive.http.requests)
+        drive.consume_item(make_event(temp_dir, 'b'))
+        # no lookups of '/t', only the file and its upload
+        assert len(drive.http.requests) - requests == 3
+        assert drive.http.paths() == ['/t', '/t/a', '/t/b']
+
+    def test_batch(self, drive, temp_dir):
+        drive.consume_batch([
+            make_event(temp_dir, 'd', isdir=True),
+            make_event(temp_dir, 'd/e', isdir=True),
+            make_event(temp_dir, 'f', isdir=True),
+        ])
+        assert drive.http.paths() == ['/t', '/t/d', '/t/d/e', '/t/f']
+        requests = len(drive.http.requests)
+        drive.consume_batch([make_event(temp_dir, 'd/e/%s' % i)
+                             for i in range(5)])
+        # one batch of lookups, then two requests per upload
+        assert len(drive.http.requests) - requests == 1 + 5 * 2
+        drive.consume_batch([
+            make_event(temp_dir, 'd/e/%s' % i, type='DELETE')
+            for i in range(5)
+        ] + [make_event(temp_dir, 'f', type='DELETE', isdir=True)])
+        assert drive.http.paths() == ['/t', '/t/d', '/t/d/e']
+        folder = drive.http.files[drive.path_cache.get('/t/d')]
+        assert folder['mimeType'] == MIME_FOLDER
+
+    def test_download(self, drive, temp_dir):
+        drive.download_chunk_size = 4
+        drive.consume_item(make_event(temp_dir, 'a'))
+        local = os.path.join(temp_dir, 'b')
+        drive.download(local, '/t/a')
+        assert open(local, 'rb').read() == open(
+            os.path.join(temp_dir, 'a'), 'rb').read()
+        content = open(local, 'rb').read()
+        # resume a partial download of the same version
+        with open(local + PART_SUFFIX, 'wb') as part:
+            part.write(content[:6])
+        with open(drive.version_file(local), 'w') as version:
+            version.write(hashlib.md5(content).hexdigest())
+        os.remove(local)
+        requests = len(drive.http.requests)
+        drive.download(local, '/t/a')
+        assert not os.path.exists(local + PART_SUFFIX)
+        assert not os.path.exists(drive.version_file(local))
+        assert open(local, 'rb').read() == content
+        # metadata and the chunks of the remaining 4 bytes
+        assert len(drive.http.requests) - requests == 1 + 1
+        # a partial download of another version starts over
+        with open(local + PART_SUFFIX, 'wb') as part:
+            part.write(b'x' * 6)
+        with open(drive.version_file(local), 'w') as version:
+            version.write('other')
+        requests = len(drive.http.requests)
+        drive.download(local, '/t/a')
+        assert open(local, 'rb').read() == content
+        assert len(drive.http.requests) - requests == 1 + 3
+
+    def test_cancel_outdated_upload(self, drive, temp_dir):
+        event = make_event(temp_dir, 'a')
+        drive.queue.put(event)
+        drive.queue.get()
+        # modified again while it is uploaded
+        drive.queue.put(event)
+        drive.consume_item(event)
+        assert drive.http.paths() == ['/t']
+        drive.queue.task_done(event)
+        drive.consume_item(drive.queue.get(block=False))
+        assert drive.http.paths() == ['/t', '/t/a']
+
+    def test_shortcuts(self, drive, temp_dir):
+        drive.index = SyncIndex(os.path.join(temp_dir, 'index.db'))
+        watch = os.path.join(temp_dir, 'w')
+        os.makedirs(watch)
+        a = make_event(watch, 'a')
+
+        def sync(*events):
+            batch = drive.prepare_batch(list(events))
+            if batch:
+                drive.consume_batch(batch)
+        sync(a)
+        requests = len(drive.http.requests)
+        # metadata change only
+        os.utime(a.source_absolute, (0, 0))
+        sync(a.replace(type='ATTRIB'))
+        assert len(drive.http.requests) == requests
+        # renamed
+        b = a.replace(source_absolute=os.path.join(watch, 'b'),
+                      type='MOVED_TO', moved_from=a.replace(type='MOVED_FROM'))
+        os.rename(a.source_absolute, b.source_absolute)
+        sync(b)
+        assert drive.http.paths() == ['/t', '/t/b']
+        assert ('PATCH', '/drive/v2/files/' + drive.path_cache.get('/t/b')) \
+            in drive.http.requests[requests:]
+        # same content as a synced file
+        drive.server_copy_min_size = 0
+        c = a.replace(source_absolute=os.path.join(watch, 'c'))
+        shutil.copy(b.source_absolute, c.source_absolute)
+        requests = len(drive.http.requests)
+        sync(c)
+        assert drive.http.paths() == ['/t', '/t/b', '/t/c']
+        assert not any(path.startswith('/upload')
+                       for _, path in drive.http.requests[requests:])
+        assert drive.http.contents[drive.path_cache.get('/t/c')] == \
+            open(c.source_absolute, 'rb').read()
+
+    def test_changed_during_upload(self, drive, temp_dir):
+        drive.index = SyncIndex(os.path.join(temp_dir, 'index.db'))
+        watch = os.path.join(temp_dir, 'w')
+        os.makedirs(watch)
+        a = make_event(watch, 'a')
+
+        def sync(event):
+            batch = drive.prepare_batch([event])
+            if batch:
+                drive.consume_batch(batch)
+
+        def modify():
+            drive.http.on_upload = None
+            write_random_file(a.source_absolute, 20)
+        drive.http.on_upload = modify
+        sync(a)
+        # the queued MODIFY uploads the new content
+        sync(a.replace(type='MODIFY'))
+        assert drive.http.contents[drive.path_cache.get('/t/a')] == \
+            open(a.source_absolute, 'rb').read()
+
+    def test_folder_rename(self, drive, temp_dir):
+        drive.index = SyncIndex(os.path.join(temp_dir, 'index.db'))
+        watch = os.path.join(temp_dir, 'w')
+        folder = make_event(watch, 'd', isdir=True)
+        for event in [folder, make_event(watch, 'd/a'),
+                      make_event(watch, 'd/b')]:
+            drive.consume_item(event)
+
+        def rename(old, new):
+            os.rename(old.source_absolute, os.path.join(watch, new))
+            return old.replace(
+                source_absolute=os.path.join(watch, new), type='MOVED_TO',
+                moved_from=old.replace(type='MOVED_FROM'))
+        e = rename(folder, 'e')
+        drive.consume_item(e)
+        # moved with its content
+        assert drive.http.paths() == ['/t', '/t/e', '/t/e/a', '/t/e/b']
+        assert sorted(drive.index.entries(drive.name, watch)) == [
+            'e', 'e/a', 'e/b']
+        # missing at the target, the local content is uploaded
+        drive.rm('/t/e')
+        drive.consume_item(rename(e, 'f'))
+        assert drive.http.paths() == ['/t', '/t/f', '/t/f/a', '/t/f/b']
+        assert drive.http.contents[drive.path_cache.get('/t/f/a')] == \
+            open(os.path.join(watch, 'f', 'a'), 'rb').read()
+        assert sorted(drive.index.entries(drive.name, watch)) == [
+            'f', 'f/a', 'f/b']
+
+    def test_batch_folder_rename(self, drive, temp_dir):
+        watch = os.path.join(temp_dir, 'w')
+        folder = make_event(watch, 'd', isdir=True)
+        drive.consume_batch([folder, make_event(watch, 'd/a'),
+                             make_event(watch, 'x')])
+        os.rename(folder.source_absolute, os.path.join(watch, 'e'))
+        drive.consume_batch([
+            folder.replace(source_absolute=os.path.join(watch, 'e'),
+                           type='MOVED_TO',
+                           moved_from=folder.replace(type='MOVED_FROM')),
+            make_event(watch, 'g')])
+        assert drive.http.paths() == ['/t', '/t/e', '/t/e/a', '/t/g', '/t/x']
+
+    def test_batch_retries_unsynced(self, drive, temp_dir, monkeypatch):
+        a = make_event(temp_dir, 'a')
+        drive.consume_item(a)
+        os.remove(a.source_absolute)
+        lookup = drive._lookup
+        lookups = []
+
+        def fail(paths, create_parents=False):
+            lookups.append(paths)
+            if len(lookups) == 2:  # the files to upload
+                raise IOError('lookup failed')
+            return lookup(paths, create_parents)
+        monkeypatch.setattr(drive, '_lookup', fail)
+        consumed = []
+        consume_item = drive.consume_item
+        monkeypatch.setattr(drive, 'consume_item', lambda event:
+                            consumed.append(event.file_name) or
+                            consume_item(event))
+        drive.consume_batch([a.replace(type='DELETE'),
+                             make_event(temp_dir, 'b')])
+        # the trashed file is not synced again
+        assert consumed == ['b']
+        assert drive.http.paths() == ['/t', '/t/b']
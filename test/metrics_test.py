@@ -0,0 +1,94 @@
+import sys
+import os
+import json
+import tempfile
+import shutil
+import time
+from urllib.request import urlopen
+
+import pytest
+
+sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
+from utils.containers import OrderedSetQueue
+from utils.metrics import Metrics
+from utils.metrics import MetricsExporter
+from utils.metrics import metrics as global_metrics
+from sync_api import QueueConsumer
+
+
+@pytest.fixture()
+def temp_dir(request):
+    temp_dir = tempfile.mkdtemp()
+    # make sure temp files are cleaned.
+    request.addfinalizer(lambda: shutil.rmtree(temp_dir))
+    return temp_dir
+
+
+@pytest.fixture()
+def metrics():
+    metrics = Metrics()
+    metrics.inc('events_total', {'syncer': 'Rsync'})
+    metrics.inc('events_total', {'syncer': 'Rsync'}, 2)
+    metrics.observe('wait_seconds', {'syncer': 'Rsync'}, 0.02)
+    metrics.observe('wait_seconds', {'syncer': 'Rsync'}, 100)
+    metrics.gauge_callback('queue_depth', {'syncer': 'Rsync'}, lambda: 7)
+    return metrics
+
+
+class TestMetrics():
+    def test_snapshot(self, metrics):
+        snapshot = metrics.snapshot()
+        assert snapshot['events_total'] == [
+            {'labels': {'syncer': 'Rsync'}, 'value': 3}]
+        assert snapshot['queue_depth'][0]['value'] == 7
+        histogram = snapshot['wait_seconds'][0]['value']
+        assert histogram['count'] == 2
+        assert histogram['buckets']['0.05'] == 1
+        assert histogram['buckets']['inf'] == 2
+
+    def test_prometheus(self, metrics):
+        lines = metrics.prometheus().splitlines()
+        assert '# TYPE events_total counter' in lines
+        assert 'events_total{syncer="Rsync"} 3' in lines
+        assert 'wait_seconds_bucket{le="+Inf",syncer="Rsync"} 2' in lines
+        assert 'wait_seconds_count{syncer="Rsync"} 2' in lines
+
+    def test_export(self, metrics, temp_dir):
+        path = os.path.join(temp_dir, 'metrics.json')
+        exporter = MetricsExporter(metrics, path=path, format='json', port=0)
+        port = exporter.server.server_address[1]
+        body = urlopen('http://127.0.0.1:%s/metrics' % port).read()
+        assert b'queue_depth{syncer="Rsync"} 7' in body
+        exporter.stop()
+        with open(path) as f:
+            assert json.load(f)['events_total'][0]['value'] == 3
+
+
+def test_enqueue_time():
+    queue = OrderedSetQueue()
+    queue.put('a')
+    queue.put('a')
+    item = queue.get()
+    assert queue.enqueue_time(item) is not None
+    assert queue.enqueue_time(item) is None
+
+
+def test_batch_timing():
+    class BatchConsumer(QueueConsumer):
+        batch_size = 10
+
+        def consume_batch(self, items):
+            time.sleep(0.05)
+    consumer = BatchConsumer()
+    for item in range(5):
+        consumer.queue.put(item)
+    consumer.queue.put(None)
+    consumer.work()
+    labels = {'syncer': 'BatchConsumer'}
+    # one observation for the batch, not one per item
+    snapshot = global_metrics.snapshot()['omnisync_sync_seconds']
+    timing = next(m['value'] for m in snapshot if m['labels'] == labels)
+    assert timing['count'] == 1
+    assert global_metrics.get('omnisync_events_total', labels) == 5
+    assert global_metrics.get(
+        'omnisync_event_latency_seconds', labels) >= 5 * 0.05
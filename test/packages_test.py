@@ -0,0 +1,27 @@
+import sys
+import os
+import pkgutil
+
+sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
+import syncers
+from sync_api import SyncBase
+from utils.packages import LazyModule
+
+
+def test_lazy_module():
+    assert 'colorsys' not in sys.modules
+    colorsys = LazyModule('colorsys')
+    assert 'colorsys' not in sys.modules
+    assert colorsys.rgb_to_hsv(0, 0, 0) == (0, 0, 0.0)
+    assert 'colorsys' in sys.modules
+    # submodules are imported on access
+    assert LazyModule('xml.dom').minidom.parseString('<a/>')
+    assert not hasattr(LazyModule('xml.dom'), 'missing')
+
+
+def test_all_syncers_are_declared():
+    assert sorted(syncers.SYNCERS.values()) == sorted(
+        'syncers.' + name for _, name, _ in
+        pkgutil.iter_modules(syncers.__path__))
+    for name in syncers.SYNCERS:
+        assert issubclass(syncers.syncer_class(name), SyncBase)
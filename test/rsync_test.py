@@ -0,0 +1,258 @@
+import sys
+import os
+import io
+import shutil
+import filecmp
+import socket
+import tempfile
+import subprocess
+import time
+
+import pytest
+
+sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
+from utils.files import write_random_file
+import config
+from file_watcher import InotifyEvent
+from sync_index import SyncIndex
+from syncers.rsync import Rsync
+from syncers.rsync import OutputParser
+from syncers.rsync import RsyncProgress
+from syncers.rsync import exclude_rule
+from syncers.rsync import parse_progress
+from syncers.rsync import parse_target
+
+needs_rsync = pytest.mark.skipif(
+    shutil.which('rsync') is None, reason='rsync is not installed')
+
+
+@pytest.fixture()
+def temp_dir(request):
+    temp_dir = tempfile.mkdtemp()
+    # make sure temp files are cleaned.
+    request.addfinalizer(lambda: shutil.rmtree(temp_dir))
+    return temp_dir
+
+
+def rsync_daemon(request, temp_dir, path):
+    """ Serves `path` as module 'target' of a local rsync daemon, a stand-in
+    for a remote target.
+
+    Returns:
+        str: rsync:// url of the module.
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    conf = os.path.join(temp_dir, 'rsyncd.conf')
+    with open(conf, 'w') as f:
+        f.write('use chroot = no\nuid = %s\ngid = %s\n'
+                '[target]\npath = %s\nread only = no\n'
+                % (os.getuid(), os.getgid(), path))
+    daemon = subprocess.Popen([
+        'rsync', '--daemon', '--no-detach', '--address=127.0.0.1',
+        '--port=%s' % port, '--config=' + conf])
+    request.addfinalizer(daemon.terminate)
+    for _ in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return 'rsync://127.0.0.1:%s/target' % port
+
+
+@pytest.fixture(params=['local', 'daemon'])
+def watch(request, temp_dir):
+    os.makedirs(os.path.join(temp_dir, 'source'))
+    os.makedirs(os.path.join(temp_dir, 'target'))
+    target = os.path.join(temp_dir, 'target')
+    if request.param == 'daemon':
+        target = rsync_daemon(request, temp_dir, target)
+    return {'source': os.path.join(temp_dir, 'source'),
+            'target': target,
+            'target_path': os.path.join(temp_dir, 'target'),
+            'syncers': ['Rsync']}
+
+
+@pytest.fixture()
+def rsync(monkeypatch):
+    monkeypatch.setattr(config, 'data', {
+        'configuration': {'Rsync': {'arguments': ['-a']}}, 'watches': []})
+    return Rsync()
+
+
+@pytest.fixture()
+def processes(monkeypatch):
+    """ Records the commands of all started processes. """
+    commands = []
+    popen = subprocess.Popen
+
+    def record(cmd, *args, **kwargs):
+        commands.append(cmd)
+        return popen(cmd, *args, **kwargs)
+    monkeypatch.setattr(subprocess, 'Popen', record)
+    return commands
+
+
+def make_event(watch, path, type='CREATE', isdir=False, **kwargs):
+    source_absolute = os.path.join(watch['source'], path)
+    return InotifyEvent(
+        None, watch,
+        source_absolute=source_absolute,
+        isdir=isdir,
+        type=type,
+        **kwargs
+    )
+
+
+def same_tree(a, b):
+    comparison = filecmp.dircmp(a, b)
+    return not (comparison.left_only or comparison.right_only or
+                comparison.diff_files) and \
+        all(same_tree(os.path.join(a, d), os.path.join(b, d))
+            for d in comparison.common_dirs)
+
+
+def test_parse_target():
+    assert parse_target('/a/b') == ('local', None)
+    assert parse_target('a/b:c') == ('local', None)
+    assert parse_target('user@host:a/b') == ('ssh', 'user@host')
+    assert parse_target('host::module/a') == ('daemon', 'host')
+    assert parse_target('rsync://host:873/module') == ('daemon', 'host:873')
+
+
+def test_exclude_rule():
+    assert exclude_rule('a/b', '/s/') == '/a/b'
+    # rsync transfers the folder itself
+    assert exclude_rule('a/b', '/s') == '/s/a/b'
+    assert exclude_rule('a', 'host:s') == '/s/a'
+    assert exclude_rule('a', 'rsync://host/module') == '/module/a'
+    assert exclude_rule('[a]*', '/s?') == '/s\\?/\\[a]\\*'
+
+
+def test_parse_progress():
+    assert parse_progress(
+        b'    1,234,567  45%   12.50MB/s    0:01:05 (xfr#3, to-chk=10/20)'
+    ) == RsyncProgress(1234567, 45, 12.5 * 1024 ** 2, 65, 10, 20)
+    assert parse_progress(b'     32,768  50%  100.00kB/s    0:00:00') == \
+        RsyncProgress(32768, 50, 102400.0, 0, None, None)
+    assert parse_progress(b'dir/100% done') is None
+
+
+def test_output_parser():
+    parser = OutputParser()
+    assert parser.feed(b'sending incremental file list\na') == [
+        b'sending incremental file list']
+    assert parser.feed(b'/b\n  0  0%\r  5 100%\r') == [
+        b'a/b', b'  0  0%', b'  5 100%']
+    assert parser.feed(b'tail') == []
+    assert parser.close() == [b'tail']
+
+
+class FakeProcess():
+    """ Stands in for rsync, records what it reads from stdin. """
+
+    def __init__(self, cmd, stdin=None, stdout=None):
+        self.cmd = cmd
+        self.input = []
+        self.stdin = io.BytesIO()
+        self.stdin.close = lambda: self.input.append(self.stdin.getvalue())
+        self.stdout = io.BufferedReader(io.BytesIO(b''))
+        self.returncode = 0
+
+    def wait(self):
+        return self.returncode
+
+
+@pytest.fixture()
+def fake_rsync(monkeypatch):
+    """ Replaces rsync by `FakeProcess`, returns the started processes. """
+    processes = []
+    monkeypatch.setattr(subprocess, 'Popen', lambda *args, **kwargs:
+                        processes.append(FakeProcess(*args, **kwargs)) or
+                        processes[-1])
+    return processes
+
+
+def test_fullsync_excluded_paths(rsync, fake_rsync, temp_dir):
+    source = os.path.join(temp_dir, 'source')
+    for path in ['keep/a', 'skip/a', 'b.tmp']:
+        os.makedirs(os.path.dirname(os.path.join(source, path)),
+                    exist_ok=True)
+        write_random_file(os.path.join(source, path), 10)
+    config.data['watches'] = [{
+        'source': source, 'target': os.path.join(temp_dir, 'target'),
+        'syncers': ['Rsync'], 'ignore': ['skip/', '*.tmp']}]
+    rsync.fullsync()
+    [process] = fake_rsync
+    assert process.cmd[-2:] == [source, os.path.join(temp_dir, 'target')]
+    # anchored below the transferred folder
+    assert sorted(process.input[0].splitlines()) == [
+        b'/source/b.tmp', b'/source/skip']
+
+
+def test_folder_content_is_indexed(rsync, fake_rsync, temp_dir):
+    rsync.index = SyncIndex(os.path.join(temp_dir, 'index.db'))
+    watch = {'source': os.path.join(temp_dir, 'source'),
+             'target': os.path.join(temp_dir, 'target'),
+             'syncers': ['Rsync']}
+    os.makedirs(os.path.join(watch['source'], 'd', 'e'))
+    for path in ['d/a', 'd/e/b']:
+        write_random_file(os.path.join(watch['source'], path), 10)
+    rsync.consume_batch([make_event(watch, 'd', isdir=True)])
+    assert sorted(rsync.index.entries(rsync.name, watch['source'])) == [
+        'd', 'd/a', 'd/e', 'd/e/b']
+    os.rename(os.path.join(watch['source'], 'd'),
+              os.path.join(watch['source'], 'f'))
+    rsync.consume_batch([make_event(
+        watch, 'f', type='MOVED_TO', isdir=True,
+        moved_from=make_event(watch, 'd', type='MOVED_FROM', isdir=True))])
+    assert sorted(rsync.index.entries(rsync.name, watch['source'])) == [
+        'f', 'f/a', 'f/e', 'f/e/b']
+
+
+@needs_rsync
+class TestRsync():
+    def test_batch(self, rsync, watch, processes):
+        source = watch['source']
+        os.makedirs(os.path.join(source, 'd', 'e'))
+        events = [make_event(watch, 'd', isdir=True),
+                  make_event(watch, 'd/e', isdir=True)]
+        for i in range(20):
+            write_random_file(os.path.join(source, 'd', str(i)), 10)
+            events.append(make_event(watch, 'd/%s' % i))
+        rsync.consume_batch(events)
+        assert same_tree(source, watch['target_path'])
+        # one call for all paths, including the content of new folders
+        assert len(processes) == 1
+
+    def test_delete_and_rename(self, rsync, watch, processes):
+        source = watch['source']
+        os.makedirs(os.path.join(source, 'd'))
+        write_random_file(os.path.join(source, 'd', 'a'), 10)
+        write_random_file(os.path.join(source, 'b'), 10)
+        rsync.consume_batch([make_event(watch, 'd', isdir=True),
+                             make_event(watch, 'b')])
+        os.rename(os.path.join(source, 'd'), os.path.join(source, 'e'))
+        os.remove(os.path.join(source, 'b'))
+        rsync.consume_batch([
+            make_event(watch, 'e', type='MOVED_TO', isdir=True,
+                       moved_from=make_event(
+                           watch, 'd', type='MOVED_FROM', isdir=True)),
+            make_event(watch, 'b', type='DELETE'),
+        ])
+        assert same_tree(source, watch['target_path'])
+
+    def test_fullsync_excludes(self, rsync, watch, processes):
+        source = watch['source']
+        for path in ['keep/a', 'skip/a', 'b.tmp']:
+            os.makedirs(os.path.dirname(os.path.join(source, path)),
+                        exist_ok=True)
+            write_random_file(os.path.join(source, path), 10)
+        watch['ignore'] = ['skip/', '*.tmp']
+        config.data['watches'] = [watch]
+        rsync.fullsync()
+        # the source folder itself is transferred
+        target = os.path.join(watch['target_path'], 'source')
+        assert sorted(os.listdir(target)) == ['keep']
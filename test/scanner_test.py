@@ -0,0 +1,36 @@
+import sys
+import os
+import tempfile
+import shutil
+
+import pytest
+
+sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
+from utils.files import write_random_file
+from scanner import scan
+
+
+@pytest.fixture()
+def temp_dir(request):
+    temp_dir = tempfile.mkdtemp()
+    # make sure temp files are cleaned.
+    request.addfinalizer(lambda: shutil.rmtree(temp_dir))
+    return temp_dir
+
+
+def test_scan(temp_dir):
+    expected = set()
+    for i in range(5):
+        folder = os.path.join(*['d%s' % j for j in range(i + 1)])
+        os.makedirs(os.path.join(temp_dir, folder, 'skip'))
+        write_random_file(os.path.join(temp_dir, folder, 'f'), 10)
+        write_random_file(os.path.join(temp_dir, folder, 'skip', 'f'), 10)
+        expected.update([folder, os.path.join(folder, 'f')])
+    os.symlink(os.path.join(temp_dir, 'd0'), os.path.join(temp_dir, 'link'))
+    expected.add('link')
+    state = scan(temp_dir, exclude=['.*/skip'], workers=4)
+    assert set(state) == expected
+    assert state == scan(temp_dir, exclude=['.*/skip'], workers=1)
+    assert state['d0/d1/f'][0] == 10
+    assert state['link'][2] is True
+    assert sorted(scan(temp_dir, recursive=False)) == ['d0', 'link']
@@ -0,0 +1,71 @@
+import sys
+import os
+import tempfile
+import shutil
+
+import pytest
+
+sys.path.append(os.path.abspath(sys.path[0] + os.sep + '..'))
+from utils.files import write_random_file
+from sync_index import IndexEntry
+from sync_index import SyncIndex
+from sync_index import changes
+from sync_index import local_state
+
+
+@pytest.fixture()
+def temp_dir(request):
+    temp_dir = tempfile.mkdtemp()
+    # make sure temp files are cleaned.
+    request.addfinalizer(lambda: shutil.rmtree(temp_dir))
+    return temp_dir
+
+
+@pytest.fixture()
+def index(request, temp_dir):
+    index = SyncIndex(os.path.join(temp_dir, 'index.db'))
+    request.addfinalizer(index.close)
+    return index
+
+
+def entry(size, mtime, isdir=False):
+    return IndexEntry(size, mtime, isdir, None, None)
+
+
+class TestSyncIndex():
+    def test_update(self, index):
+        index.update('Rsync', '/src', 'a', entry(1, 2))
+        index.update('Rsync', '/src', 'a', entry(3, 4))
+        index.update('Dropbox', '/src', 'b', entry(1, 2))
+        assert index.get('Rsync', '/src', 'a') == entry(3, 4)
+        assert index.get('Rsync', '/src', 'b') is None
+        assert list(index.entries('Rsync', '/src')) == ['a']
+
+    def test_remove_folder(self, index):
+        for path in ['d', 'd/a', 'd/e/a', 'd_a', 'e']:
+            index.update('Rsync', '/src', path, entry(1, 2))
+        index.remove('Rsync', '/src', 'd')
+        assert sorted(index.entries('Rsync', '/src')) == ['d_a', 'e']
+
+
+class TestChanges():
+    def test_local_state(self, temp_dir):
+        os.makedirs(os.path.join(temp_dir, 'd', 'skip'))
+        write_random_file(os.path.join(temp_dir, 'd', 'a'), 10)
+        write_random_file(os.path.join(temp_dir, 'd', 'skip', 'a'), 10)
+        state = local_state(temp_dir, exclude=['.*/skip'])
+        assert sorted(state) == ['d', 'd/a']
+        assert state['d/a'][0] == 10
+        assert state['d'][2] is True
+
+    def test_changes(self):
+        local = {'d': (0, 1, True), 'd/a': (10, 5, False),
+                 'd/b': (10, 5, False), 'n': (1, 1, False)}
+        indexed = {'d': entry(0, 0, True), 'd/a': entry(10, 5),
+                   'd/b': entry(10, 4), 'old': entry(0, 0, True),
+                   'old/a': entry(1, 1)}
+        assert list(changes(local, indexed)) == [
+            ('d/b', 'MODIFY', False),
+            ('n', 'CREATE', False),
+            ('old', 'DELETE', True),
+        ]
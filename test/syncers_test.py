@@ -84,8 +84,6 @@ class TestSyncer():
                     {'source': filesystem['root'],
                     'syncers': [syncer.__class__.__name__],
                     'target': REMOTE_ROOT},
-                    file_name=os.path.basename(f),
-                    base_path=os.path.dirname(f),
                     source_absolute=f,
                     isdir=os.path.isdir(f),
                     type=t,
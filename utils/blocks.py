@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+""" Checksums of the blocks of large files.
+
+Like rsync, every block of a file has a cheap weak checksum (adler32 and
+crc32, both computed by zlib) and a strong one (md5). When a file changed,
+its blocks are read again but only blocks with a different weak checksum
+are hashed with md5, so the changed byte ranges of e.g. a VM image are found
+without hashing the whole file. The content hash of a file is the md5 of the
+md5 digests of its blocks.
+
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+   http://sphinxcontrib-napoleon.readthedocs.org/en/latest/example_google.html
+"""
+import os
+import zlib
+import sqlite3
+import hashlib
+import threading
+from array import array
+from collections import namedtuple
+
+BLOCK_SIZE = 1024 * 1024
+_DIGEST_SIZE = hashlib.md5().digest_size
+
+BlockUpdate = namedtuple('BlockUpdate', [
+    'hash',     # content hash of the file, see `BlockIndex.update`
+    'changed',  # list of (offset, length) that changed since the last update
+    'read',     # bytes read
+    'hashed',   # bytes hashed with md5
+])
+
+
+def weak_checksum(block):
+    """ Returns the 64 bit weak checksum of a block: adler32 (the checksum
+    rsync rolls) and crc32, so that a collision needs both to collide.
+    """
+    return zlib.adler32(block) << 32 | zlib.crc32(block)
+
+
+class BlockIndex():
+    """ Persistent block checksums of files, one record per file.
+
+    Args:
+        path (str): SQLite database file.
+        block_size (Optional[int]): Size of the blocks, changing it makes
+            the recorded checksums useless.
+    """
+
+    def __init__(self, path, block_size=BLOCK_SIZE):
+        self.path = path
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # the checksums can always be recomputed
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS blocks ('
+            'path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, '
+            'block_size INTEGER, weak BLOB, strong BLOB, hash TEXT)'
+        )
+
+    def _record(self, path):
+        with self._lock:
+            return self._db.execute(
+                'SELECT size, mtime, block_size, weak, strong, hash '
+                'FROM blocks WHERE path = ?', (path,)
+            ).fetchone()
+
+    def update(self, path, stat=None):
+        """ Brings the checksums of a file up to date.
+
+        Files with the recorded size and mtime are not read at all.
+
+        Args:
+            path (str): The file.
+            stat (Optional[os.stat_result]): Stat of the file if known.
+        Returns:
+            BlockUpdate
+        Raises:
+            OSError: The file can not be read.
+        """
+        stat = stat or os.stat(path)
+        record = self._record(path)
+        if record is not None and record[2] != self.block_size:
+            record = None
+        if record is not None and \
+                record[:2] == (stat.st_size, stat.st_mtime_ns):
+            return BlockUpdate(record[5], [], 0, 0)
+        old_weak, old_strong = array('Q'), b''
+        if record is not None:
+            old_weak.frombytes(record[3])
+            old_strong = record[4]
+        weak, strong = array('Q'), []
+        changed = []
+        read = hashed = 0
+        buffer = bytearray(self.block_size)
+        view = memoryview(buffer)
+        with open(path, 'rb', buffering=0) as f:
+            for size in iter(lambda: f.readinto(buffer), 0):
+                block = view[:size]
+                index = len(weak)
+                offset = index * self.block_size
+                read += size
+                weak.append(weak_checksum(block))
+                # a shorter last block has a different checksum anyway
+                if index < len(old_weak) and old_weak[index] == weak[-1]:
+                    strong.append(old_strong[
+                        index * _DIGEST_SIZE:(index + 1) * _DIGEST_SIZE])
+                    continue
+                strong.append(hashlib.md5(block).digest())
+                hashed += size
+                if changed and sum(changed[-1]) == offset:
+                    changed[-1] = (changed[-1][0], changed[-1][1] + size)
+                else:
+                    changed.append((offset, size))
+        if record is not None and record[0] > read:
+            changed.append((read, record[0] - read))  # truncated
+        strong = b''.join(strong)
+        content_hash = hashlib.md5(strong).hexdigest()
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (path, stat.st_size, stat.st_mtime_ns, self.block_size,
+                 weak.tobytes(), strong, content_hash)
+            )
+        return BlockUpdate(content_hash, changed, read, hashed)
+
+    def remove(self, path):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM blocks WHERE path = ?', (path,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -1,5 +1,12 @@
 #!/usr/bin/env python3
-import collections
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from collections.abc import MutableSet
+except ImportError:
+    from collections import MutableSet
 
 try:
     import queue
@@ -49,17 +56,38 @@ class OrderedSetQueue(queue.Queue):
                     def __hash__(self):
                             return hash(self._key())
 
+    Instead of the items themselves, the result of a `key` function can
+    decide which items are duplicates, e.g. one item per folder.
+
     :url: http://stackoverflow.com/questions/1581895/how-check-if-a-task-is-already-in-python-queue
+
+    Args:
+        maxsize (Optional[int]): See :class:`queue.Queue`.
+        key (Optional[callable]): Returns the hashable key of an item.
+            Defaults to the item.
     """
 
+    def __init__(self, maxsize=0, key=None):
+        self.key = key
+        queue.Queue.__init__(self, maxsize)
+
     def _init(self, maxsize):
         queue.Queue._init(self, maxsize)
-        self._set_of_items = set()
+        self._set_of_items = {}  # key -> queued item
+        self._enqueued = {}  # key -> time it was put into the queue
+        self._taken = {}  # key -> enqueue time, until `enqueue_time`
+
+    def _item_key(self, item):
+        if self.key is None or item is None:
+            return item
+        return self.key(item)
 
     def _put(self, item):
-        if item not in self._set_of_items:
+        key = self._item_key(item)
+        if key not in self._set_of_items:
             queue.Queue._put(self, item)
-            self._set_of_items.add(item)
+            self._set_of_items[key] = item
+            self._enqueued[key] = time.monotonic()
         else:
             # `put` increments `unfinished_tasks` even if we did not put
             # anything into the queue here
@@ -67,13 +95,191 @@ class OrderedSetQueue(queue.Queue):
 
     def _get(self):
         item = queue.Queue._get(self)
-        self._set_of_items.remove(item)
+        key = self._item_key(item)
+        del self._set_of_items[key]
+        self._taken[key] = self._enqueued.pop(key, None)
         return item
 
+    def enqueue_time(self, item):
+        """Returns the time (:func:`time.monotonic`) a taken item was put
+        into the queue, once.
+        """
+        with self.mutex:
+            return self._taken.pop(self._item_key(item), None)
+
+    def task_done(self, item=None):
+        """Like :meth:`queue.Queue.task_done`, additionally takes the
+        finished item so that subclasses can keep track of it.
+        """
+        with self.mutex:
+            self._done(item)
+        queue.Queue.task_done(self)
+
+    def _done(self, item):
+        pass
+
+
+class PersistentOrderedSetQueue(OrderedSetQueue):
+    """:class:`OrderedSetQueue` that records its items in a
+    :class:`utils.journal.Journal`, so they survive a restart.
+
+    An item is removed from the journal when it is marked as done with
+    :meth:`task_done`, not when it is taken from the queue. Items that were
+    being processed during a crash are therefore replayed as well.
+
+    Subclasses implement :meth:`_serialize`, :meth:`_deserialize` and
+    :meth:`_journal_key` (a string that identifies duplicates).
+
+    Args:
+        maxsize (Optional[int]): See :class:`queue.Queue`.
+        journal (Optional[Journal]): Without a journal the queue behaves like
+            an :class:`OrderedSetQueue`.
+        name (Optional[str]): Identifies the queue inside the journal.
+        key (Optional[callable]): See :class:`OrderedSetQueue`.
+    """
+
+    def __init__(self, maxsize=0, journal=None, name=None, key=None):
+        self.journal = journal
+        self.name = name or self.__class__.__name__
+        self._seq = 0
+        self._replay_seq = None
+        OrderedSetQueue.__init__(self, maxsize, key)
+        if journal is not None:
+            journal.register(self.name, self._serialize)
+            # items put before `replay` must not reuse recorded numbers
+            self._seq = journal.last_seq(self.name)
+
+    def _init(self, maxsize):
+        OrderedSetQueue._init(self, maxsize)
+        self._seqs = {}  # journal key -> seq of the record in the journal
+
+    def _put(self, item):
+        if item is None or self.journal is None:
+            return OrderedSetQueue._put(self, item)
+        if self._item_key(item) in self._set_of_items:
+            if self._replay_seq is not None:
+                # the recorded item is merged into the queued one
+                self.journal.remove(
+                    self.name, self._journal_key(item), self._replay_seq)
+            return OrderedSetQueue._put(self, item)
+        journal_key = self._journal_key(item)
+        if self._replay_seq is None:
+            self._seq += 1
+            seq = self._seq
+            self.journal.append(self.name, journal_key, seq, item)
+        else:
+            seq = self._replay_seq
+        self._seqs[journal_key] = seq
+        OrderedSetQueue._put(self, item)
+
+    def _done(self, item):
+        if item is None or self.journal is None:
+            return
+        journal_key = self._journal_key(item)
+        seq = self._seqs.pop(journal_key, None)
+        queued = self._set_of_items.get(self._item_key(item))
+        if seq is not None and (
+                queued is None or self._journal_key(queued) != journal_key):
+            self.journal.remove(self.name, journal_key, seq)
+        elif seq is not None:
+            # the item was queued again while being processed
+            self._seqs[journal_key] = seq
+
+    def replay(self, *args):
+        """Puts all items recorded in the journal back into the queue.
+
+        Args:
+            *args: Passed to :meth:`_deserialize`.
+        """
+        if self.journal is None:
+            return
+        for key, seq, payload in self.journal.records(self.name):
+            item = self._deserialize(payload, *args)
+            if item is None:
+                self.journal.remove(self.name, key, seq)
+                continue
+            with self.not_empty:
+                if self._seqs.get(key) == seq:
+                    continue  # recorded by a `put` before the replay
+                self._seq = max(self._seq, seq)
+                self._replay_seq = seq
+                # same bookkeeping as `put`, without waiting for a free slot
+                self.unfinished_tasks += 1
+                self._put(item)
+                self._replay_seq = None
+                self.not_empty.notify()
+
+    def save(self):
+        """Writes pending journal records to disk."""
+        if self.journal is not None:
+            self.journal.flush()
+
+    def _serialize(self, item): raise NotImplementedError
+
+    def _deserialize(self, payload, *args): raise NotImplementedError
+
+    def _journal_key(self, item): raise NotImplementedError
+
+
+class LRUCache():
+    """Thread-safe mapping that holds at most `maxsize` items.
+
+    When full, the least recently used item is evicted.
+
+    Args:
+        maxsize (Optional[int]): Maximum number of items.
+        items (Optional[iterable]): Initial (key, value) pairs.
+    """
+
+    def __init__(self, maxsize=1000, items=()):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        for key, value in items:
+            self[key] = value
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def discard_prefix(self, prefix):
+        """Removes all items whose key starts with `prefix`."""
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[key]
+
+    def items(self):
+        """Returns a list of the (key, value) pairs, least recently used
+        first."""
+        with self._lock:
+            return list(self._data.items())
+
 
 KEY, PREV, NEXT = range(3)
 
-class OrderedSet(collections.MutableSet):
+class OrderedSet(MutableSet):
     """
     Implementation based on a doubly-linked link and an internal dictionary.
     This design gives :class:`OrderedSet` the same big-Oh running times as
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+""" Exclude rules of a watch.
+
+A watch excludes paths with:
+    - `exclude`: regular expressions of absolute paths (e.g. '.*/cache'),
+    - `ignore`: patterns with the syntax of .gitignore files, relative to
+      the source,
+    - `.omnisyncignore` files: .gitignore patterns relative to their folder.
+
+All patterns that apply to a folder are compiled together (see `Rules`),
+regular expressions have the alternatives in reverse order so the first
+matching one is the last pattern (which wins, like in git), `lastgroup`
+tells which pattern it was. Patterns of deeper `.omnisyncignore` files come
+after the patterns of their parents. The content of an excluded folder is
+excluded, walkers prune it without looking into it.
+
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+   http://sphinxcontrib-napoleon.readthedocs.org/en/latest/example_google.html
+"""
+import os
+import re
+import weakref
+
+from utils.files import PART_PATTERN
+
+IGNORE_FILE = '.omnisyncignore'
+
+
+def _parse(pattern):
+    """ Returns (glob, negated, dir_only, anchored) of a .gitignore line or
+    None for blank lines and comments.
+    """
+    pattern = pattern.rstrip('\n')
+    # trailing spaces are ignored unless they are escaped
+    stripped = pattern.rstrip(' ')
+    if stripped.endswith('\\') and len(stripped) < len(pattern):
+        stripped += ' '
+    pattern = stripped
+    if not pattern or pattern.startswith('#'):
+        return None
+    negated = pattern.startswith('!')
+    if negated:
+        pattern = pattern[1:]
+    elif pattern.startswith(('\\!', '\\#')):
+        pattern = pattern[1:]
+    dir_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    if not pattern:
+        return None
+    # a slash at the start or in the middle anchors the pattern to its folder
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    if pattern.startswith('**/') and '/' not in pattern[3:]:
+        pattern, anchored = pattern[3:], False
+    return pattern, negated, dir_only, anchored
+
+
+def _regex(glob):
+    """ Translates the wildcards of a glob. """
+    regex = []
+    i, n = 0, len(glob)
+    while i < n:
+        if glob.startswith('**/', i) and (i == 0 or glob[i - 1] == '/'):
+            regex.append('(?:.*/)?')
+            i += 3
+        elif glob.startswith('**', i) and i + 2 == n and \
+                (i == 0 or glob[i - 1] == '/'):
+            # 'a/**' is the content of a, not a itself
+            regex.append('.+')
+            i += 2
+        elif glob[i] == '*':
+            regex.append('[^/]*')
+            i += 1
+        elif glob[i] == '?':
+            regex.append('[^/]')
+            i += 1
+        elif glob[i] == '[':
+            end = glob.find(']', i + 2)
+            if end < 0:
+                regex.append('\\[')
+                i += 1
+                continue
+            content = glob[i + 1:end]
+            negate = content[0] in '!^'
+            if negate:
+                content = content[1:]
+            content = content.replace('\\', '\\\\').replace('^', '\\^')
+            regex.append('[%s%s]' % ('^/' if negate else '', content))
+            i = end + 1
+        elif glob[i] == '\\' and i + 1 < n:
+            regex.append(re.escape(glob[i + 1]))
+            i += 2
+        else:
+            regex.append(re.escape(glob[i]))
+            i += 1
+    return ''.join(regex)
+
+
+def translate(pattern):
+    """ Translates a .gitignore pattern.
+
+    Args:
+        pattern (str): A line of a .gitignore file.
+    Returns:
+        tuple: (regex, negated) or None for blank lines and comments. The
+            regex matches paths relative to the folder of the pattern,
+            folders with a trailing '/'.
+    """
+    parsed = _parse(pattern)
+    if parsed is None:
+        return None
+    glob, negated, dir_only, anchored = parsed
+    regex = _regex(glob)
+    if not anchored:
+        regex = '(?:.*/)?' + regex
+    return regex + ('/' if dir_only else '/?'), negated
+
+
+_WILDCARDS = re.compile(r'[*?[\\]')
+
+
+class Rules():
+    """ Compiled .gitignore patterns.
+
+    Python regular expressions backtrack through the alternatives, so
+    patterns are split by what they need: literal names and '*.suffix'
+    patterns are dict lookups, other patterns without a slash are one
+    regular expression for the name and the remaining ones one for the
+    path. The highest matching pattern wins.
+
+    Args:
+        patterns (list): (folder, pattern) pairs, folder relative to the
+            source ('' for the source), later patterns take precedence.
+            The rules are used for paths below all these folders.
+    """
+    __slots__ = ('patterns', '_names', '_suffixes', '_name_match',
+                 '_path_match', '_negated', '_last_name', '_last_path')
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self._names = {}  # name -> [(index, dir_only)], highest index first
+        self._suffixes = {}  # '.suffix' -> [(index, dir_only)]
+        self._negated = []
+        names, paths = [], []
+        self._last_name = self._last_path = -1
+        for folder, pattern in patterns:
+            parsed = _parse(pattern)
+            if parsed is None:
+                continue
+            glob, negated, dir_only, anchored = parsed
+            index = len(self._negated)
+            self._negated.append(negated)
+            end = '/' if dir_only else '/?'
+            if anchored:
+                prefix = re.escape(folder + '/') if folder else ''
+                paths.append('(?P<p%s>%s%s%s)' % (
+                    index, prefix, _regex(glob), end))
+                self._last_path = index
+            elif not _WILDCARDS.search(glob):
+                self._names.setdefault(glob, []).insert(0, (index, dir_only))
+            elif glob.startswith('*.') and \
+                    not _WILDCARDS.search(glob, 1) and '.' not in glob[2:]:
+                self._suffixes.setdefault(glob[1:], []).insert(
+                    0, (index, dir_only))
+            else:
+                names.append('(?P<p%s>%s%s)' % (index, _regex(glob), end))
+                self._last_name = index
+        # reversed: the first matching alternative is the last pattern
+        self._name_match = names and re.compile(
+            '|'.join(reversed(names)), re.DOTALL).fullmatch
+        self._path_match = paths and re.compile(
+            '|'.join(reversed(paths)), re.DOTALL).fullmatch
+
+    def excluded(self, path, isdir):
+        """ Tells if the last matching pattern excludes a path.
+
+        Args:
+            path (str): Path relative to the source.
+            isdir (bool): True for folders.
+        """
+        name = path[path.rfind('/') + 1:]
+        best = -1
+        for index, dir_only in self._names.get(name, ()):
+            if isdir or not dir_only:
+                best = index
+                break
+        dot = name.rfind('.')
+        if dot >= 0:
+            for index, dir_only in self._suffixes.get(name[dot:], ()):
+                if index > best and (isdir or not dir_only):
+                    best = index
+                    break
+        if self._last_name > best:
+            match = self._name_match(name + '/' if isdir else name)
+            if match is not None:
+                best = max(best, int(match.lastgroup[1:]))
+        if self._last_path > best:
+            match = self._path_match(path + '/' if isdir else path)
+            if match is not None:
+                best = max(best, int(match.lastgroup[1:]))
+        return best >= 0 and not self._negated[best]
+
+
+class Excludes():
+    """ Exclude rules of a watch, see the module docstring.
+
+    Args:
+        source (str): Source of the watch.
+        regexes (Optional[list]): Regular expressions of absolute paths.
+        patterns (Optional[list]): .gitignore patterns relative to `source`.
+        ignore_files (Optional[bool]): False to ignore `IGNORE_FILE`s.
+    """
+
+    def __init__(self, source, regexes=None, patterns=None,
+                 ignore_files=True):
+        self.source = source.rstrip(os.sep) or os.sep
+        self._regex = re.compile(
+            '|'.join((regexes or []) + [PART_PATTERN])).match
+        self._ignore_files = ignore_files
+        self._root = Rules([('', pattern) for pattern in patterns or []])
+        self._rules = {}  # folder relative to source -> Rules
+
+    def _relative(self, path):
+        if path.startswith(self.source + os.sep):
+            return path[len(self.source) + 1:]
+        if self.source == os.sep:
+            return path[1:]
+        return None
+
+    def rules(self, folder):
+        """ Returns the `Rules` for the content of a folder.
+
+        Args:
+            folder (str): Path relative to the source, '' for the source.
+        """
+        rules = self._rules.get(folder)
+        if rules is not None:
+            return rules
+        rules = self._root if not folder else \
+            self.rules(os.path.dirname(folder))
+        patterns = self._read(folder)
+        if patterns:
+            rules = Rules(rules.patterns + [
+                (folder, pattern) for pattern in patterns])
+        self._rules[folder] = rules
+        return rules
+
+    def _read(self, folder):
+        if not self._ignore_files:
+            return []
+        try:
+            with open(os.path.join(self.source, folder, IGNORE_FILE),
+                      encoding='utf-8', errors='replace') as f:
+                return f.read().splitlines()
+        except OSError:
+            return []
+
+    def excluded(self, path, isdir):
+        """ Tells if a path is excluded. Its parent folders are not
+        checked, walkers do not enter excluded folders.
+
+        Args:
+            path (str): Absolute path below the source.
+            isdir (bool): True for folders.
+        """
+        if self._regex(path):
+            return True
+        relative = self._relative(path)
+        if not relative:
+            return False  # the source itself
+        return self.rules(os.path.dirname(relative)).excluded(
+            relative, isdir)
+
+    def excluded_folder(self, path):
+        """ `excluded` for folders, e.g. as `exclude_filter` of pyinotify.
+        """
+        return self.excluded(path, True)
+
+    def changed(self, path):
+        """ Forgets the rules below the folder of a changed `IGNORE_FILE`.
+
+        Args:
+            path (str): Absolute path of the file.
+        """
+        folder = self._relative(os.path.dirname(path))
+        if folder is None:
+            folder = ''
+        for cached in list(self._rules):
+            if not folder or cached == folder or \
+                    cached.startswith(folder + '/'):
+                self._rules.pop(cached, None)
+
+
+# id(watch config) -> Excludes, as long as a watcher or syncer uses it
+_watch_excludes = weakref.WeakValueDictionary()
+
+
+def watch_excludes(watch_config):
+    """ Returns the `Excludes` of a watch, shared by everything that walks
+    or watches its source.
+    """
+    excludes = _watch_excludes.get(id(watch_config))
+    if excludes is None or excludes.config is not watch_config:
+        excludes = Excludes(
+            watch_config['source'], watch_config.get('exclude'),
+            watch_config.get('ignore'))
+        # the config lives as long as the entry, so its id is not reused
+        excludes.config = watch_config
+        _watch_excludes[id(watch_config)] = excludes
+    return excludes
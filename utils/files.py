@@ -1,6 +1,50 @@
 #!/usr/bin/env python3
 import os
+import json
+import hashlib
+
+# suffix of unfinished downloads, they are never synced
+PART_SUFFIX = '.omnisync-part'
+PART_PATTERN = '.*\\' + PART_SUFFIX + '$'
 
 def write_random_file(path, size_kb):
     with open(path, 'wb') as f:
         f.write(os.urandom(size_kb))
+
+
+def file_hash(path, block_size=1024 * 1024):
+    """ Hashes the file block by block, reusing one buffer. `hashlib`
+    releases the GIL for large blocks, so several threads can hash in
+    parallel.
+
+    Returns:
+        str: md5 hex digest of the content (same as Google Drive's
+            `md5Checksum`).
+    """
+    md5 = hashlib.md5()
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        for size in iter(lambda: f.readinto(buffer), 0):
+            md5.update(view[:size])
+    return md5.hexdigest()
+
+
+def load_json(path, default=None):
+    """ Returns the content of a json file or `default` if there is none.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+
+def save_json(path, data):
+    """ Replaces the file atomically, a crash leaves either the old or the
+    new content.
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
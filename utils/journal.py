@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+import sqlite3
+import itertools
+import threading
+from operator import itemgetter
+
+from builtins import super
+
+_PUT, _REMOVE = range(2)
+
+
+class Journal(threading.Thread):
+    """Durable log of queue operations backed by a SQLite file in WAL mode.
+
+    `append` and `remove` only buffer the operation, a background thread
+    serializes the items and commits the buffer in one transaction every
+    `flush_interval` seconds (one fsync per batch). This keeps the threads
+    that put items into a queue (e.g. the inotify notifier) off the disk.
+
+    Records are keyed by queue name and item key. Every record carries a
+    sequence number, which defines the replay order and makes sure removing
+    a finished item does not remove a newer record for the same key.
+
+    Args:
+        path (str): SQLite database file.
+        flush_interval (Optional[float]): Seconds between commits.
+        max_batch (Optional[int]): Number of buffered operations that
+            trigger an early commit.
+    """
+
+    def __init__(self, path, flush_interval=0.5, max_batch=10000):
+        super().__init__(daemon=True)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._serializers = {}
+        self._ops = []
+        self._ops_lock = threading.Lock()
+        self._db_lock = threading.RLock()
+        self._wakeup = threading.Event()
+        self._running = True
+        self._db = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=FULL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS queue ('
+            'queue TEXT, key TEXT, seq INTEGER, payload TEXT, '
+            'PRIMARY KEY (queue, key))'
+        )
+
+    def register(self, name, serialize):
+        """
+        Args:
+            name (str): Name of the queue.
+            serialize (callable): Converts an item of the queue to a string.
+        """
+        self._serializers[name] = serialize
+
+    def append(self, name, key, seq, item):
+        self._buffer((_PUT, name, key, seq, item))
+
+    def remove(self, name, key, seq):
+        self._buffer((_REMOVE, name, key, seq, None))
+
+    def _buffer(self, op):
+        with self._ops_lock:
+            self._ops.append(op)
+            if len(self._ops) >= self.max_batch:
+                self._wakeup.set()
+
+    def records(self, name):
+        """ Returns (key, seq, payload) of all records of a queue in the
+        order they were appended.
+        """
+        with self._db_lock:
+            self.flush()
+            return self._db.execute(
+                'SELECT key, seq, payload FROM queue WHERE queue = ? '
+                'ORDER BY seq', (name,)
+            ).fetchall()
+
+    def last_seq(self, name):
+        """ Returns the highest sequence number of a queue, 0 if it has no
+        records.
+        """
+        with self._db_lock:
+            self.flush()
+            return self._db.execute(
+                'SELECT MAX(seq) FROM queue WHERE queue = ?', (name,)
+            ).fetchone()[0] or 0
+
+    def flush(self):
+        """ Writes all buffered operations to disk.
+        """
+        with self._db_lock:
+            with self._ops_lock:
+                ops, self._ops = self._ops, []
+            if not ops:
+                return
+            self._db.execute('BEGIN')
+            for kind, group in itertools.groupby(ops, key=itemgetter(0)):
+                if kind == _PUT:
+                    self._db.executemany(
+                        'INSERT OR REPLACE INTO queue VALUES (?, ?, ?, ?)',
+                        [(name, key, seq, self._serializers[name](item))
+                         for _, name, key, seq, item in group]
+                    )
+                else:
+                    self._db.executemany(
+                        'DELETE FROM queue '
+                        'WHERE queue = ? AND key = ? AND seq = ?',
+                        [(name, key, seq) for _, name, key, seq, _ in group]
+                    )
+            self._db.execute('COMMIT')
+
+    def run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if not self._running:
+                break  # `close` does the last flush
+            self.flush()
+
+    def close(self):
+        self._running = False
+        self._wakeup.set()
+        with self._db_lock:
+            self.flush()
+            self._db.close()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+""" Counters, gauges and histograms of the syncing process.
+
+All parts of omniSync record into the module level `metrics`. Snapshots can
+be exported in the Prometheus text format or as json, see
+`MetricsExporter`.
+
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+   http://sphinxcontrib-napoleon.readthedocs.org/en/latest/example_google.html
+"""
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+from utils.log import log
+
+# upper bounds of the histogram buckets (seconds)
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, float('inf'))
+
+
+class _Histogram():
+    __slots__ = ('buckets', 'count', 'sum')
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+
+class Metrics():
+    """ Thread-safe collection of metrics.
+
+    A metric is identified by its name and labels (a dict of strings).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._callbacks = {}
+        self._help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def describe(self, name, text):
+        """ Sets the help text of a metric. """
+        self._help[name] = text
+
+    def inc(self, name, labels=None, value=1):
+        """ Increments a counter. """
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, labels=None, value=0):
+        """ Sets a gauge. """
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def gauge_callback(self, name, labels, callback):
+        """ Registers a gauge whose value is `callback()` at export time,
+        e.g. the size of a queue.
+        """
+        with self._lock:
+            self._callbacks[self._key(name, labels)] = callback
+
+    def observe(self, name, labels=None, value=0.0):
+        """ Adds a value to a histogram. """
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = _Histogram()
+            self._histograms[key].observe(value)
+
+    def get(self, name, labels=None):
+        """ Returns the value of a counter or gauge or the sum of a
+        histogram, 0 if it was not set.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key].sum
+            return self._counters.get(key, self._gauges.get(key, 0))
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: name -> list of {'labels': ..., 'value': ...}, histogram
+                values are dicts with count, sum and buckets.
+        """
+        with self._lock:
+            gauges = dict(self._gauges)
+            callbacks = list(self._callbacks.items())
+            metrics = [(key, value) for key, value in
+                       list(self._counters.items()) + list(gauges.items())]
+            metrics += [(key, {
+                'count': h.count, 'sum': h.sum,
+                'buckets': dict(zip(map(str, BUCKETS), h.buckets))
+            }) for key, h in self._histograms.items()]
+        for key, callback in callbacks:
+            try:
+                metrics.append((key, callback()))
+            except Exception as e:
+                log.debug('metric %s failed: %s' % (key[0], e))
+        snapshot = {}
+        for (name, labels), value in sorted(metrics, key=lambda m: m[0]):
+            snapshot.setdefault(name, []).append(
+                {'labels': dict(labels), 'value': value})
+        return snapshot
+
+    def prometheus(self):
+        """ Returns the metrics in the Prometheus text format. """
+        with self._lock:
+            types = {name: 'counter' for name, _ in self._counters}
+            types.update({name: 'gauge' for name, _ in self._gauges})
+            types.update({name: 'gauge' for name, _ in self._callbacks})
+            types.update({name: 'histogram' for name, _ in self._histograms})
+        lines = []
+        for name, values in self.snapshot().items():
+            if name in self._help:
+                lines.append('# HELP %s %s' % (name, self._help[name]))
+            lines.append('# TYPE %s %s' % (name, types[name]))
+            for metric in values:
+                labels = metric['labels']
+                if types[name] != 'histogram':
+                    lines.append('%s%s %s' % (
+                        name, _format_labels(labels), metric['value']))
+                    continue
+                for bound, count in metric['value']['buckets'].items():
+                    lines.append('%s_bucket%s %s' % (
+                        name,
+                        _format_labels(dict(labels, le=bound.replace(
+                            'inf', '+Inf'))),
+                        count))
+                lines.append('%s_sum%s %s' % (
+                    name, _format_labels(labels), metric['value']['sum']))
+                lines.append('%s_count%s %s' % (
+                    name, _format_labels(labels), metric['value']['count']))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in sorted(labels.items()))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsExporter(threading.Thread):
+    """ Exports `metrics` regularly to a file and/or serves them over http
+    on localhost (`/metrics` in the Prometheus format, `/metrics.json` as
+    json).
+
+    Args:
+        metrics (Metrics): The exported metrics.
+        path (Optional[str]): File that is rewritten every `interval`
+            seconds.
+        format (Optional[str]): 'prometheus' or 'json', format of the file.
+        port (Optional[int]): Port of the http server.
+        interval (Optional[float]): Seconds between two writes of the file.
+    """
+
+    def __init__(self, metrics, path=None, format='prometheus', port=None,
+                 interval=10):
+        self.metrics = metrics
+        self.path = path and os.path.expanduser(path)
+        self.format = format
+        self.interval = interval
+        self.server = None
+        if port is not None:
+            self.server = _ThreadingHTTPServer(
+                ('127.0.0.1', port), self._handler())
+            threading.Thread(
+                target=self.server.serve_forever, daemon=True).start()
+        self._stopped = threading.Event()
+        super().__init__(daemon=True)
+
+    def render(self, format):
+        if format == 'json':
+            return json.dumps(self.metrics.snapshot())
+        return self.metrics.prometheus()
+
+    def write(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(self.render(self.format))
+        os.replace(temp_path, self.path)
+
+    def run(self):
+        while self.path and not self._stopped.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        self._stopped.set()
+        if self.path:
+            self.write()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def _handler(self):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ['/metrics', '/metrics.json']:
+                    self.send_error(404)
+                    return
+                json_format = self.path.endswith('.json')
+                body = exporter.render(
+                    'json' if json_format else 'prometheus').encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json'
+                                 if json_format else 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        return Handler
+
+
+metrics = Metrics()
+metrics.describe(
+    'omnisync_events_total', 'Events taken from the queue by a syncer.')
+metrics.describe(
+    'omnisync_events_synced_total', 'Events that were synced successfully.')
+metrics.describe(
+    'omnisync_uploaded_bytes_total', 'Size of the synced files.')
+metrics.describe(
+    'omnisync_uploads_avoided_total',
+    'Changed files that were skipped, moved or copied at the target.')
+metrics.describe(
+    'omnisync_downloaded_bytes_total', 'Bytes written by downloads.')
+metrics.describe(
+    'omnisync_queue_wait_seconds', 'Time from enqueueing to processing.')
+metrics.describe(
+    'omnisync_sync_seconds', 'Processing time of a batch of events.')
+metrics.describe(
+    'omnisync_event_latency_seconds',
+    'Time from enqueueing to the end of processing.')
+metrics.describe('omnisync_queue_depth', 'Number of queued events.')
+metrics.describe(
+    'omnisync_throughput_bytes_per_second',
+    'Uploaded bytes per second of processing time.')
@@ -1,12 +1,37 @@
 #!/usr/bin/env python3
-import pkgutil
-import pyclbr
-
-def find_modules_with_super_class(pkg, super_class):
-    for importer, modname, ispkg in pkgutil.walk_packages(pkg.__path__):
-        if ispkg: continue
-        import_path = "%s.%s" % (pkg.__name__, modname)
-        module = pyclbr.readmodule(import_path)
-        for item, val in module.items():
-            if super_class.__name__ in val.super:
-                yield item, import_path
+from importlib import import_module
+
+
+class LazyModule():
+    """ Imports a module when one of its attributes is used first, e.g. the
+    SDK of a syncer that is only needed once the syncer runs.
+
+    Submodules are imported on access as well (`LazyModule('a').b.c` is
+    `c` of `import a.b`).
+
+    Args:
+        name (str): Name of the module.
+    """
+
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attribute):
+        if self.__module is None:
+            self.__module = import_module(self.__name)
+        try:
+            return getattr(self.__module, attribute)
+        except AttributeError:
+            pass
+        name = '%s.%s' % (self.__name, attribute)
+        try:
+            return import_module(name)
+        except ModuleNotFoundError as e:
+            if e.name != name:
+                raise
+            raise AttributeError(
+                'module %r has no attribute %r' % (self.__name, attribute))
+
+    def __repr__(self):
+        return '<lazy module %r>' % self.__name